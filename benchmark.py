@@ -0,0 +1,342 @@
+'''
+Micro-benchmarks for the simulation's hot functions.
+Each benchmark builds a fleet of n items and returns a function that runs the benchmarked call once per item, and
+optionally a function restoring the fleet between timed runs. Pairwise functions (check_collision,
+oriented_box_collisions, the segment distances, conflict_times) are timed over n random pairs.
+'''
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import contextlib
+import statistics
+import numpy as np
+
+from kalman import KalmanFilter, CarSystemKF
+from models.Basics import GameObject, Vector2, check_collision, oriented_box_collisions, segments_distance, \
+    segments_intersect, point_segment_distance
+from models.CarManager import Car, CarManager
+from models.Environment import Environment
+from models.Prediction import ClosestApproachPredictor
+from models.Sensor import ObjectSensor, SensorBank
+from models.Spatial import UniformGrid, SweepAndPrune
+from models.World import World
+
+
+def random_car(rng, world):
+    position = Vector2(rng.uniform(0, world.window_size[0]), rng.uniform(0, world.window_size[1]))
+    velocity = Vector2(rng.uniform(-5, 5), rng.uniform(-5, 5))
+    return Car(position, velocity, rotation_angle=rng.uniform(0, 2 * np.pi), scale=world.scale)
+
+
+def random_segment(rng, world):
+    return tuple((rng.uniform(0, world.window_size[0]), rng.uniform(0, world.window_size[1])) for _ in range(2))
+
+
+def fleet_world(n):
+    # grow the world with the fleet to keep a constant density of cars
+    side = max(1.0, np.sqrt(n / 10))
+    return World(window_size=(int(1200 * side), int(800 * side)))
+
+
+def make_filters(n):
+    A, B, H, P, Q, R = CarSystemKF.get_model(0.05, 1)
+    rng = np.random.default_rng(0)
+    filters = []
+    for _ in range(n):
+        kf = KalmanFilter(A, B, H, Q, R)
+        kf.last_mean = rng.normal(size=(6, 1))
+        kf.last_sigma = P
+        filters.append(kf)
+    return filters, rng.normal(size=(n, 6, 1))
+
+
+def bench_kf_predict(n):
+    filters, _ = make_filters(n)
+    ut = np.zeros((1, 1))
+
+    def run():
+        for kf in filters:
+            kf.predict(ut)
+    return run
+
+
+def bench_kf_update(n):
+    filters, measures = make_filters(n)
+    ut = np.zeros((1, 1))
+    predictions = [kf.predict(ut) for kf in filters]
+
+    def run():
+        for kf, zt, (predicted_mean, predicted_sigma) in zip(filters, measures, predictions):
+            kf.update(zt, predicted_mean, predicted_sigma)
+    return run
+
+
+def bench_kf_step(n):
+    filters, measures = make_filters(n)
+    ut = np.zeros((1, 1))
+
+    def run():
+        for kf, zt in zip(filters, measures):
+            kf.step(ut, zt)
+    return run
+
+
+def bench_car_system_kf_update(n):
+    env = Environment(World())
+    car_mngs = [CarManager(env=env, randomize=True, measurement_noise=1) for _ in range(n)]
+    measures = [car_mng.sensor.measure() for car_mng in car_mngs]
+
+    def run():
+        for car_mng, measure in zip(car_mngs, measures):
+            car_mng.kalman_filter.update(measure)
+    return run
+
+
+def bench_check_collision(n):
+    world = World()
+    rng = random.Random(0)
+    pairs = [(random_car(rng, world), random_car(rng, world)) for _ in range(n)]
+
+    def run():
+        for car_a, car_b in pairs:
+            check_collision(car_a, car_b)
+    return run
+
+
+def bench_oriented_box_collisions(n):
+    world = World()
+    rng = random.Random(0)
+    cars = [random_car(rng, world) for _ in range(2 * n)]
+    centers = np.array([car.position.get() for car in cars])
+    angles = np.array([car.rotation_angle for car in cars])
+    sizes = np.array([car.size for car in cars], dtype=float)
+    pairs = np.arange(2 * n).reshape(n, 2)
+
+    def run():
+        oriented_box_collisions(centers, angles, sizes, pairs)
+    return run
+
+
+def moving_fleet(n):
+    # a fleet with a constant density of cars, moving each run like cars do between frames
+    world = fleet_world(n)
+    rng = random.Random(0)
+    cars = [random_car(rng, world) for _ in range(n)]
+
+    def move():
+        for car in cars:
+            car.position.x += rng.uniform(-2, 2)
+            car.position.y += rng.uniform(-2, 2)
+    return cars, move
+
+
+def bench_grid_candidate_pairs(n):
+    cars, move = moving_fleet(n)
+    grid = UniformGrid()
+
+    def run():
+        grid.candidate_pairs(cars)
+    return run, move
+
+
+def bench_sweep_and_prune_candidate_pairs(n):
+    cars, move = moving_fleet(n)
+    keys = list(range(n))
+    sweep_and_prune = SweepAndPrune()
+    # the first call inserts every box, later ones only update them
+    sweep_and_prune.candidate_pairs(cars, keys)
+
+    def run():
+        sweep_and_prune.candidate_pairs(cars, keys)
+    return run, move
+
+
+def bench_segments_distance(n):
+    world = World()
+    rng = random.Random(0)
+    pairs = [(random_segment(rng, world), random_segment(rng, world)) for _ in range(n)]
+
+    def run():
+        for seg1, seg2 in pairs:
+            segments_distance(seg1, seg2)
+    return run
+
+
+def bench_segments_intersect(n):
+    world = World()
+    rng = random.Random(0)
+    pairs = [(random_segment(rng, world), random_segment(rng, world)) for _ in range(n)]
+
+    def run():
+        for seg1, seg2 in pairs:
+            segments_intersect(seg1, seg2)
+    return run
+
+
+def bench_point_segment_distance(n):
+    world = World()
+    rng = random.Random(0)
+    pairs = [(random_segment(rng, world)[0], random_segment(rng, world)) for _ in range(n)]
+
+    def run():
+        for point, segment in pairs:
+            point_segment_distance(point, segment)
+    return run
+
+
+def bench_closest_approach(n):
+    world = World()
+    rng = np.random.default_rng(0)
+    predictor = ClosestApproachPredictor(CarSystemKF.get_model(1, 1)[0], look_ahead_time=10, steps=10)
+    spread = np.array([world.window_size[0], 5, 0.1, world.window_size[1], 5, 0.1])
+    means = rng.normal(size=(2 * n, 6, 1)) * spread[:, np.newaxis]
+    pairs = np.arange(2 * n).reshape(n, 2)
+    radii = np.full(2 * n, 5.0 * world.scale)
+
+    def run():
+        predictor.conflict_times(predictor.trajectories(means), pairs, radii)
+    return run
+
+
+def bench_sensor_measure(n):
+    world = World()
+    rng = random.Random(0)
+    sensors = [ObjectSensor(random_car(rng, world), measurement_noise=1) for _ in range(n)]
+
+    def run():
+        for sensor in sensors:
+            sensor.measure()
+    return run
+
+
+def bench_sensor_bank_measure(n):
+    world = World()
+    rng = random.Random(0)
+    bank = SensorBank(seed=0)
+    sensors = [ObjectSensor(random_car(rng, world), measurement_noise=1) for _ in range(n)]
+    for sensor in sensors:
+        sensor.attach(bank)
+    true_positions = np.array([sensor.obj.position.get() for sensor in sensors])
+
+    def run():
+        bank.measure(true_positions)
+    return run
+
+
+def bench_game_object_update(n):
+    rng = random.Random(0)
+    objects = [GameObject(Vector2(rng.uniform(0, 1200), rng.uniform(0, 800)), Vector2(1, 1),
+                          accel=0.1, steering_angle=0.01) for _ in range(n)]
+
+    def run():
+        for obj in objects:
+            obj.update()
+    return run
+
+
+def bench_environment_update_all(n):
+    random.seed(0)
+    np.random.seed(0)
+    env = Environment(fleet_world(n), target_n_cars=n)
+
+    def reset():
+        # replace the cars that crashed or left the world during the last run
+        env.spawn_cars(measurement_noise=1, randomize=True)
+
+    def run():
+        env.update_all()
+        env.frame += 1
+    return run, reset
+
+
+BENCHMARKS = {
+    'KalmanFilter.predict': bench_kf_predict,
+    'KalmanFilter.update': bench_kf_update,
+    'KalmanFilter.step': bench_kf_step,
+    'CarSystemKF.update': bench_car_system_kf_update,
+    'check_collision': bench_check_collision,
+    'oriented_box_collisions': bench_oriented_box_collisions,
+    'UniformGrid.candidate_pairs': bench_grid_candidate_pairs,
+    'SweepAndPrune.candidate_pairs': bench_sweep_and_prune_candidate_pairs,
+    'segments_distance': bench_segments_distance,
+    'segments_intersect': bench_segments_intersect,
+    'point_segment_distance': bench_point_segment_distance,
+    'ClosestApproachPredictor.conflict_times': bench_closest_approach,
+    'ObjectSensor.measure': bench_sensor_measure,
+    'SensorBank.measure': bench_sensor_bank_measure,
+    'GameObject.update': bench_game_object_update,
+    'Environment.update_all': bench_environment_update_all,
+}
+
+
+def time_benchmark(factory, n, warmup, repeat):
+    bench = factory(n)
+    run, reset = bench if isinstance(bench, tuple) else (bench, None)
+
+    times = []
+    # keep the simulation's own prints out of the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(warmup + repeat):
+            if reset is not None:
+                reset()
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            if i >= warmup:
+                times.append(elapsed)
+
+    median = statistics.median(times)
+    return {
+        'n': n,
+        'warmup': warmup,
+        'repeat': repeat,
+        'times': times,
+        'min': min(times),
+        'median': median,
+        'mean': statistics.mean(times),
+        'median_per_item': median / n,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Collision predictor benchmarks',
+        description='Time the simulation hot functions at several fleet sizes'
+    )
+    parser.add_argument('-b', '--benchmark', action='append',
+                        help=f"benchmark to run (repeatable), defaults to all: {', '.join(BENCHMARKS)}")
+    parser.add_argument('-n', '--sizes', default='1,10,100,1000,10000', help='comma separated fleet sizes')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed runs before timing')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs')
+    parser.add_argument('-o', '--output', help='JSON results file, defaults to stdout')
+    args = parser.parse_args()
+
+    names = args.benchmark or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name}")
+            sys.exit()
+    sizes = [int(n) for n in args.sizes.split(',')]
+
+    results = []
+    for name in names:
+        for n in sizes:
+            result = {'benchmark': name}
+            result.update(time_benchmark(BENCHMARKS[name], n, args.warmup, args.repeat))
+            results.append(result)
+            print(f"{name:<26} n={n:<6} median {result['median'] * 1e3:10.3f} ms"
+                  f"\t{result['median_per_item'] * 1e6:10.3f} us/item", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+'''
+Calibrate the Kalman Filter covariance matrices of CarSystemKF from simulated cars.
+A fleet of cars is stepped headless, each one measured by a noisy and by a noiseless SensorBank. For every measurement
+noise and dt of the config's calibration section, two covariances are accumulated online, without keeping any history:
+- R, of the measurement error: measured state minus true state
+- Q, of the process error: true state minus its prediction by the model's A matrix from the previous frame
+P, the covariance of the first estimate of a filter, is R since filters start from their first measurement.
+The covariances between the x and y axes are set to zero, as the model takes the axes as independent.
+The matrices are written to a YAML file, loaded by CarSystemKF when sim.kf_calibration points to it.
+'''
+import math
+import random
+import argparse
+import yaml
+import numpy as np
+
+from main import load_config
+from kalman import CarSystemKF
+from models.Basics import Vector2
+from models.CarManager import StateCar
+from models.Sensor import ObjectSensor, SensorBank
+from models.Statistics import StreamingCovariance
+from models.World import World
+from models.WorldState import WorldState
+
+# frames before the sensors have the three measurements velocity and acceleration are derived from
+WARMUP_FRAMES = 3
+
+
+def decouple_axes(covariance):
+    '''
+    Symmetric covariance without the terms between the (x, vx, ax) and (y, vy, ay) axes. The model takes the axes as
+    independent, so their sample estimates are only noise, and would keep the filters off their axis-decoupled path.
+    '''
+    covariance = (covariance + covariance.T) / 2
+    covariance[:3, 3:] = 0
+    covariance[3:, :3] = 0
+    return covariance
+
+
+def calibrate(world: World, measurement_noise: float, dt: float, cars: int, frames: int, seed=None):
+    '''
+    :return: P, Q, R, and the number of samples they were estimated from
+    '''
+    if measurement_noise <= 0:
+        raise ValueError(f"Calibration needs a positive measurement noise, got {measurement_noise}")
+    rng = random.Random(seed)
+    world_state = WorldState(capacity=cars)
+    bank, truth = SensorBank(capacity=cars, seed=seed), SensorBank(capacity=cars)
+    for _ in range(cars):
+        # spawned as randomized CarManager cars are
+        position = Vector2(rng.randint(1, world.window_size[0]), rng.randint(1, world.window_size[1]))
+        car = StateCar(world_state, position, Vector2(0, 0), accel=1, steering_angle=rng.random() * 2 * math.pi,
+                       scale=world.scale)
+        ObjectSensor(car, measurement_noise=measurement_noise).attach(bank)
+        ObjectSensor(car, measurement_noise=0).attach(truth)
+
+    A = CarSystemKF.get_model(dt, measurement_noise)[0]
+    measurement_error, process_error = StreamingCovariance(6), StreamingCovariance(6)
+    last_true_states = None
+    for frame in range(frames):
+        world_state.step()
+        true_positions = np.column_stack((world_state['x'][:cars], world_state['y'][:cars]))
+        measured_states = CarSystemKF.get_states_from_measures(*bank.measure(true_positions))[:, :, 0]
+        true_states = CarSystemKF.get_states_from_measures(*truth.measure(true_positions))[:, :, 0]
+        if frame < WARMUP_FRAMES - 1:
+            continue
+        measurement_error.add(measured_states - true_states)
+        if last_true_states is not None:
+            process_error.add(true_states - last_true_states @ A.T)
+        last_true_states = true_states
+
+    R = decouple_axes(measurement_error.covariance)
+    return R, decouple_axes(process_error.covariance), R, measurement_error.count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Collision predictor calibration',
+        description='Estimate the Kalman Filter P, Q and R matrices for each measurement noise and dt'
+    )
+    parser.add_argument('-c', '--config', help='config with a calibration section, merged over default.yaml')
+    parser.add_argument('--seed', type=int, help='seed for the cars and the sensor noise')
+    parser.add_argument('-o', '--output', help='YAML file to write, defaults to calibration.output')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    calibration_config = config['calibration']
+    world = World.from_config(config)
+    output = args.output if args.output else calibration_config['output']
+
+    np.set_printoptions(precision=3, suppress=True)
+    calibrations = []
+    for dt in calibration_config['dt']:
+        for measurement_noise in calibration_config['measurement_noise']:
+            P, Q, R, samples = calibrate(world, measurement_noise, dt, cars=calibration_config['cars'],
+                                         frames=calibration_config['frames'], seed=args.seed)
+            print(f"dt: {dt}\t measurement noise: {measurement_noise}\t samples: {samples}\nQ:\n{Q}\nR:\n{R}")
+            calibrations.append({'dt': dt, 'measurement_noise': measurement_noise, 'samples': samples,
+                                 'P': P.tolist(), 'Q': Q.tolist(), 'R': R.tolist()})
+
+    with open(output, 'w') as f:
+        yaml.safe_dump({'calibrations': calibrations}, f, default_flow_style=None)
+    print(f"Calibration written to {output}")
+
+
+if __name__ == "__main__":
+    main()
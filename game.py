@@ -1,29 +1,64 @@
 import sys
+import math
 import time
+import queue
+import threading
 import pygame
+import numpy as np
 from models.Environment import Environment
+from models.CarManager import Car, CarManager
+from models.Snapshot import SnapshotBuffer
+from models.Sprites import CarSprite, asset_cache
+from models.Trails import TrailLayer
+from models.World import World
 from pygame.locals import *
 
 
+BACKGROUND_COLOR = (200, 200, 200)
+# above this fraction of the screen, one full display update is cheaper than updating the dirty rects one by one
+MAX_DIRTY_FRACTION = 0.5
+
+
 class Game:
-    def __init__(self, config):
-        self.env = Environment(game=self, target_n_cars=config['sim']['target_n_cars'])
+    def __init__(self, config, world: World = None):
+        '''
+        :param world: defaults to the config's
+        '''
+        self.world = world if world is not None else World.from_config(config)
+        self.env = Environment.from_config(config, world=self.world)
         self.config = config
-        self.windowSize = config['game']['windowSize']
-        self.interval = config['game']['interval']
-        self.scale = config['game']['scale']
-        self.last_refresh_time = 0
+        self.windowSize = self.world.window_size
+        self.interval = self.world.interval
+        self.scale = self.world.scale
         self.controls = {
-            K_UP: None,
-            K_DOWN: None,
-            K_RIGHT: None,
-            K_LEFT: None,
-            K_b: None,
-            K_q: lambda: sys.exit()
+            K_UP: lambda car: car.control('UP'),
+            K_DOWN: lambda car: car.control('DOWN'),
+            K_RIGHT: lambda car: car.control('RIGHT'),
+            K_LEFT: lambda car: car.control('LEFT'),
+            K_b: lambda car: car.control('BRAKE'),
+            K_q: lambda car: sys.exit()
         }
-        self.frame = 0
-        self.sensor_history = []
-        self.kf_history = []
+        self.sensor_trails: TrailLayer = None
+        self.kf_trails: TrailLayer = None
+        self.render_mode = config['game']['render_mode']
+        if self.render_mode not in ('full', 'dirty'):
+            raise ValueError(f"Unknown render mode: {self.render_mode}")
+        # rects drawn on in the last frame, whose background is restored before the next one in dirty mode
+        self.dirty_rects = None
+        self.viewport = pygame.Rect((0, 0), self.windowSize)
+        # a car is drawn while its center is this close to the viewport: enough for its largest, rotated, sprite
+        self.viewport_margin = math.ceil(max(Car.size_for(self.scale, crashed=True)) * math.sqrt(2) / 2)
+        # threaded mode: the simulation steps in its own thread, publishing snapshots the main thread renders, and
+        # receives the keyboard controls through control_queue
+        self.threaded = config['game']['threaded']
+        self.snapshots = SnapshotBuffer()
+        self.control_queue = queue.Queue()
+        self.stop_simulation = threading.Event()
+        self.simulation_thread: threading.Thread = None
+        # handle of the car the keyboard controls
+        self.controlled = None
+        # sprites of the recorded cars drawn by draw_records(), by color
+        self.record_sprites = dict()
         pygame.init()
 
     def setup(self):
@@ -31,73 +66,320 @@ class Game:
         self.CAPTION = pygame.display.set_caption('Collision detection')
         self.SCREEN = pygame.display.get_surface()
         pygame.key.set_repeat(200, 200)
+        trail_length = self.config['game']['show']['trail_length']
+        self.sensor_trails = TrailLayer(self.windowSize, (0, 0, 0), length=trail_length)
+        self.kf_trails = TrailLayer(self.windowSize, (0, 0, 255), length=trail_length)
+        asset_cache.rotation_resolution = self.config['game']['rotation_resolution']
+        asset_cache.rotation_cache_size = self.config['game']['rotation_cache_size']
+        asset_cache.preload(self.scale)
         pygame.display.update()
 
     def update(self):
-        self.env.update_all()
+        self.env.step()
+        if self.env.frame % self.config['sim']['report_frame_interval'] == 0:
+            asset_cache.get_report()
+
+    def trail_layers(self):
+        show = self.config['game']['show']
+        layers = ((self.sensor_trails, show['pos_hist']), (self.kf_trails, show['kf_mean_hist']))
+        return [layer for layer, shown in layers if shown]
+
+    def update_trails(self, sensor_points, kf_points):
+        '''
+        Add the newest point of every car, as {car id: point} functions of nothing, to the trails shown.
+        :return: the rects where the trails changed, or None if any was redrawn from scratch
+        '''
+        rects = []
+        if self.config['game']['show']['pos_hist']:
+            changed = self.sensor_trails.update(sensor_points())
+            rects = None if changed is None else rects + changed
+        if self.config['game']['show']['kf_mean_hist']:
+            changed = self.kf_trails.update(kf_points())
+            rects = None if changed is None or rects is None else rects + changed
+        return rects
+
+    def draw_trails(self, areas=None):
+        # trails go under everything else
+        for layer in self.trail_layers():
+            layer.draw(self.SCREEN, areas)
+
+    def is_visible(self, x, y):
+        return -self.viewport_margin <= x <= self.viewport.width + self.viewport_margin and \
+            -self.viewport_margin <= y <= self.viewport.height + self.viewport_margin
 
     def draw(self):
-        for car_mng in self.env.car_mngs:
-            if self.config['game']['show']['car']:
-                car_mng.car.draw_sprite(self.SCREEN)
-            if self.config['game']['show']['pos']:
-                pygame.draw.circle(self.SCREEN, (0, 0, 0), car_mng.sensor.last_position, 3)
-            if self.config['game']['show']['kf_mean_hist']:
-                self.sensor_history.append(car_mng.sensor.last_position)
-                if len(self.sensor_history) > 2:
-                    pygame.draw.lines(self.SCREEN, (0, 0, 0), False, self.sensor_history, 3)
-            if self.config['game']['show']['vel']:
-                pygame.draw.line(self.SCREEN, (0, 0, 255), car_mng.car.position.get(),
-                                 car_mng.car.position.get() +
-                                 self.config['game']['show']['vel_multiplier'] * car_mng.sensor.last_velocity, 3)
-            if self.config['game']['show']['acc']:
-                pygame.draw.line(self.SCREEN, (255, 0, 0), car_mng.car.position.get(),
-                                 car_mng.car.position.get() +
-                                 self.config['game']['show']['acc_multiplier'] * car_mng.sensor.last_acceleration, 3)
-
-        for car_kf_repr in self.env.cars_kf_repr:
-            kf_center, kf_rect = car_kf_repr
-            if self.config['game']['show']['kf_mean']:
-                pygame.draw.circle(self.SCREEN, (0, 0, 255), kf_center, 3)
-            if self.config['game']['show']['kf_mean_hist']:
-                self.kf_history.append(kf_center)
-                if len(self.kf_history) > 2:
-                    pygame.draw.lines(self.SCREEN, (0, 0, 255), False, self.kf_history, 3)
-            if self.config['game']['show']['kf_var']:
-                pygame.draw.rect(self.SCREEN, (0, 0, 255), kf_rect, 3)
+        '''
+        Draw every car in the viewport, with what the config shows of its sensor and Kalman Filter.
+        :return: the rects drawn on
+        '''
+        show = self.config['game']['show']
+        rects = []
+        visible = [self.is_visible(car_mng.car.position.x, car_mng.car.position.y) for car_mng in self.env.car_mngs]
+        for car_mng, car_visible in zip(self.env.car_mngs, visible):
+            if not car_visible:
+                continue
+            if show['car']:
+                if car_mng.car.sprite is None:
+                    car_mng.car.sprite = CarSprite(car_mng.car.color, scale=self.scale)
+                rects.extend(car_mng.car.sprite.draw(self.SCREEN, car_mng.car))
+            if show['pos']:
+                rects.append(pygame.draw.circle(self.SCREEN, (0, 0, 0), car_mng.sensor.last_position, 3))
+            if show['vel']:
+                rects.append(pygame.draw.line(self.SCREEN, (0, 0, 255), car_mng.car.position.get(),
+                                              car_mng.car.position.get() +
+                                              show['vel_multiplier'] * car_mng.sensor.last_velocity, 3))
+            if show['acc']:
+                rects.append(pygame.draw.line(self.SCREEN, (255, 0, 0), car_mng.car.position.get(),
+                                              car_mng.car.position.get() +
+                                              show['acc_multiplier'] * car_mng.sensor.last_acceleration, 3))
+
+        for car_mng, car_visible in zip(self.env.car_mngs, visible):
+            if not car_visible or car_mng.kf_center is None:
+                continue
+            if show['kf_mean']:
+                rects.append(pygame.draw.circle(self.SCREEN, (0, 0, 255), car_mng.kf_center, 3))
+            if show['kf_var']:
+                rects.append(pygame.draw.rect(self.SCREEN, (0, 0, 255), car_mng.kf_rect, 3))
+        return rects
+
+    def handle_event(self, event):
+        if event.type == QUIT:
+            if self.simulation_thread is not None:
+                self.stop_simulation.set()
+                self.simulation_thread.join()
+            self.env.close()
+            pygame.quit()
+            sys.exit()
+        elif event.type == KEYDOWN:
+            keys = pygame.key.get_pressed()
+            if self.config['game']['enable_control']:
+                for control_key, control in self.controls.items():
+                    if keys[control_key]:
+                        if self.threaded:
+                            self.control_queue.put(control)
+                        else:
+                            self.apply_control(control)
+
+    def apply_control(self, control):
+        # keep controlling the same car while it lives, then take over another one
+        car_mng = self.env.car_mngs.get(self.controlled)
+        if car_mng is None and len(self.env.car_mngs) > 0:
+            car_mng = self.env.car_mngs[0]
+            self.controlled = car_mng.handle
+        if car_mng is not None:
+            control(car_mng.car)
+
+    def render(self):
+        # with a render_interval other than the interval, the loop may have slept since the last phase of the frame
+        self.env.profiler.skip()
+        trail_rects = self.update_trails(
+            lambda: {car_mng.id: car_mng.sensor.last_position for car_mng in self.env.car_mngs},
+            lambda: {car_mng.id: car_mng.kf_center for car_mng in self.env.car_mngs
+                     if car_mng.kf_center is not None})
+        self.present(self.draw, trail_rects)
+
+    def render_snapshot(self):
+        '''
+        Threaded counterpart of render(): draw the latest snapshot published by the simulation thread.
+        '''
+        snapshot = self.snapshots.latest()
+        if snapshot is None:
+            return
+        rows = snapshot.rows
+        trail_rects = self.update_trails(
+            lambda: {car_id: measured[[0, 3]] for car_id, measured in zip(rows['car_id'], rows['measured'])},
+            lambda: {car_id: kf_mean[[0, 3]] for car_id, kf_mean in zip(rows['car_id'], rows['kf_mean'])})
+        self.present(lambda: self.draw_records(rows), trail_rects)
+
+    def present(self, draw, trail_rects=()):
+        '''
+        Draw a frame with draw(), which returns the rects it drew on, and push it to the display.
+        In full mode the whole screen is cleared and uploaded. In dirty mode only the rects drawn on in the last frame
+        are restored to background and trails, and only those, the ones drawn on now and trail_rects are uploaded.
+        :param trail_rects: rects where the trails changed since the last frame, None to redraw everything
+        '''
+        areas = None
+        if self.render_mode == 'dirty' and self.dirty_rects is not None and trail_rects is not None:
+            areas = self.dirty_rects + list(trail_rects)
+            for area in areas:
+                self.SCREEN.fill(BACKGROUND_COLOR, area)
+            self.draw_trails(areas)
+        else:
+            self.SCREEN.fill(BACKGROUND_COLOR)
+            self.draw_trails()
+        self.dirty_rects = draw()
+        # the profiler times the simulation thread's frames in threaded mode
+        if not self.threaded:
+            self.env.profiler.mark('draw')
+
+        if areas is not None:
+            areas += self.dirty_rects
+            dirty_area = sum(area.width * area.height for area in areas)
+            if dirty_area > MAX_DIRTY_FRACTION * self.viewport.width * self.viewport.height:
+                areas = None
+        if areas is None:
+            pygame.display.update()
+        else:
+            pygame.display.update(areas)
+        if not self.threaded:
+            self.env.profiler.mark('display_update')
+
+    def run_due_steps(self, accumulator, max_catch_up_steps, step):
+        '''
+        Run step() once per whole interval in accumulator, up to max_catch_up_steps times.
+        :return: the time left in accumulator
+        '''
+        steps = 0
+        while accumulator >= self.interval and steps < max_catch_up_steps:
+            step()
+            accumulator -= self.interval
+            steps += 1
+        if accumulator >= self.interval:
+            # too far behind to catch up, drop the backlog instead of falling further behind
+            accumulator %= self.interval
+        return accumulator
 
     def loop(self):
+        '''
+        Fixed-timestep loop: the simulation advances in steps of `interval` seconds of accumulated wall-clock time,
+        up to max_catch_up_steps per iteration when running late, and the screen is redrawn every render_interval.
+        In between, the loop sleeps in pygame.event.wait until the next deadline or the next input event.
+        With game.threaded, the simulation steps in its own thread instead, see threaded_loop().
+        '''
+        if self.threaded:
+            return self.threaded_loop()
         print("Starting Main Loop")
+        render_interval = self.config['game']['render_interval'] or self.interval
+        max_catch_up_steps = self.config['game']['max_catch_up_steps']
+
+        accumulator = 0
+        previous = time.perf_counter()
+        next_render = previous
         while True:
             # Event Detection
             for event in pygame.event.get():
-                if event.type == QUIT:
-                    pygame.quit()
-                    sys.exit()
-                elif event.type == KEYDOWN:
-                    keys = pygame.key.get_pressed()
-                    if self.config['game']['enable_control'] and len(self.env.car_mngs) > 0:
-                        for control_key in self.controls.keys():
-                            if keys[control_key]:
-                                self.env.car_mngs[0].car.controls[control_key]()
-            now = time.time()
-            if now - self.last_refresh_time > self.interval:
-                self.frame += 1
-                self.SCREEN.fill((200, 200, 200))
-
-                if self.frame % self.config['sim']['spawn_frame_interval'] == 0:
-                    if self.config['sim']['enable_collision_avoidance']:
-                        self.env.spawn_self_driving_cars(measurement_noise=self.config['sim']['measurement_noise'],
-                                                         randomize=self.config['sim']['randomize'])
-                    else:
-                        self.env.spawn_cars(measurement_noise=self.config['sim']['measurement_noise'],
-                                            randomize=self.config['sim']['randomize'])
-
-
-                if self.frame % self.config['sim']['report_frame_interval'] == 0:
-                    self.env.get_report()
-
-                self.update()
-                self.draw()
-                pygame.display.update()
-                self.last_refresh_time = now
+                self.handle_event(event)
+
+            now = time.perf_counter()
+            accumulator += now - previous
+            previous = now
+            accumulator = self.run_due_steps(accumulator, max_catch_up_steps, self.update)
+
+            now = time.perf_counter()
+            if now >= next_render:
+                self.render()
+                next_render = self.next_render_time(next_render, now, render_interval)
+
+            # sleep until the next simulation step or render is due, waking up early on input
+            now = time.perf_counter()
+            next_step = now + self.interval - accumulator - (now - previous)
+            self.wait_events(min(next_step, next_render) - now)
+
+    def next_render_time(self, next_render, now, render_interval):
+        next_render += render_interval
+        if next_render < now:
+            next_render = now + render_interval
+        return next_render
+
+    def wait_events(self, timeout):
+        if timeout > 0:
+            event = pygame.event.wait(max(1, int(timeout * 1000)))
+            if event.type != NOEVENT:
+                self.handle_event(event)
+
+    def threaded_loop(self):
+        '''
+        The simulation runs the fixed-timestep loop in a worker thread and publishes a snapshot of the cars after each
+        step. This thread handles input, queueing the controls for the simulation thread, and renders the latest
+        snapshot every render_interval, so a slow render doesn't slow the simulation down and vice versa.
+        '''
+        print("Starting Main Loop, with the simulation in its own thread")
+        render_interval = self.config['game']['render_interval'] or self.interval
+        self.simulation_thread = threading.Thread(target=self.simulate, name='simulation', daemon=True)
+        self.simulation_thread.start()
+
+        next_render = time.perf_counter()
+        while True:
+            for event in pygame.event.get():
+                self.handle_event(event)
+
+            now = time.perf_counter()
+            if now >= next_render:
+                self.render_snapshot()
+                next_render = self.next_render_time(next_render, now, render_interval)
+
+            self.wait_events(next_render - time.perf_counter())
+
+    def simulate(self):
+        '''
+        Simulation thread of threaded_loop(), stepping until stop_simulation is set.
+        '''
+        max_catch_up_steps = self.config['game']['max_catch_up_steps']
+        accumulator = 0
+        previous = time.perf_counter()
+        while not self.stop_simulation.is_set():
+            now = time.perf_counter()
+            accumulator += now - previous
+            previous = now
+            accumulator = self.run_due_steps(accumulator, max_catch_up_steps, self.simulation_step)
+
+            now = time.perf_counter()
+            self.stop_simulation.wait(max(0, self.interval - accumulator - (now - previous)))
+
+    def simulation_step(self):
+        while not self.control_queue.empty():
+            control = self.control_queue.get()
+            try:
+                self.apply_control(control)
+            except SystemExit:
+                # quitting from the keyboard, hand it over to the main thread
+                pygame.event.post(pygame.event.Event(QUIT))
+                self.stop_simulation.set()
+                return
+        self.update()
+        self.snapshots.publish(self.env)
+
+    def draw_records(self, rows):
+        '''
+        Draw one recorded frame (rows of a Replay or of a FrameSnapshot).
+        :return: the rects drawn on
+        '''
+        show = self.config['game']['show']
+        rects = []
+        for row in rows:
+            if not self.is_visible(row['x'], row['y']):
+                continue
+            position = np.array((row['x'], row['y']))
+            if show['car']:
+                color = Car.color_options[row['color']]
+                if color not in self.record_sprites:
+                    self.record_sprites[color] = CarSprite(color, scale=self.scale)
+                size = Car.size_for(self.scale, crashed=row['crashed'])
+                rects.extend(self.record_sprites[color].draw_at(self.SCREEN, row['x'], row['y'], row['rotation_angle'],
+                                                                size, row['crashed'], row['is_braking']))
+            if show['pos']:
+                rects.append(pygame.draw.circle(self.SCREEN, (0, 0, 0), row['measured'][[0, 3]], 3))
+            if show['vel']:
+                rects.append(pygame.draw.line(self.SCREEN, (0, 0, 255), position,
+                                              position + show['vel_multiplier'] * row['measured'][[1, 4]], 3))
+            if show['acc']:
+                rects.append(pygame.draw.line(self.SCREEN, (255, 0, 0), position,
+                                              position + show['acc_multiplier'] * row['measured'][[2, 5]], 3))
+            if show['kf_mean']:
+                rects.append(pygame.draw.circle(self.SCREEN, (0, 0, 255), row['kf_mean'][[0, 3]], 3))
+            if show['kf_var']:
+                _, kf_rect = CarManager.make_repr(row['kf_mean'][:, np.newaxis], np.diag(row['kf_var']))
+                rects.append(pygame.draw.rect(self.SCREEN, (0, 0, 255), kf_rect, 3))
+        return rects
+
+    def replay(self, replay, start=None, end=None):
+        '''
+        Play back a recorded run at the simulation rate, without running physics or filters.
+        '''
+        print("Starting Replay")
+        clock = pygame.time.Clock()
+        for frame, rows in replay.frames(start, end):
+            for event in pygame.event.get():
+                self.handle_event(event)
+            self.present(lambda: self.draw_records(rows))
+            clock.tick(1 / self.interval)
@@ -0,0 +1,28 @@
+import time
+import random
+import numpy as np
+from models.Environment import Environment
+from sharding import run_sharded
+
+
+def run_headless(config, frames: int, seed=None):
+    '''
+    Step the simulation back to back, with no rendering and no waiting between frames.
+    :param seed: if given, seeds the random and numpy.random generators before the run, and the sensor noise
+    :return: the Environment after the last frame and the achieved frames per second
+    '''
+    if config.get('sharding') and config['sharding']['tiles']:
+        return run_sharded(config, frames, seed=seed)
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+    env = Environment.from_config(config, seed=seed)
+
+    start = time.perf_counter()
+    for _ in range(frames):
+        env.step()
+    elapsed = time.perf_counter() - start
+    env.close()
+
+    fps = frames / elapsed if elapsed > 0 else float('inf')
+    return env, fps
@@ -1,9 +1,55 @@
+import yaml
 import numpy as np
 from numpy.linalg import inv, LinAlgError
 
 
+# a filter switches to its steady-state gain once its covariance is this close to the steady one, switching any
+# earlier lets its means drift from the full recursion by more than about 1e-11
+STEADY_STATE_TOLERANCE = 1e-12
+
+
+def steady_state(A, H, Q, R, initial_sigma, tolerance=1e-13, max_iterations=100000):
+    '''
+    Iterate the covariance (Riccati) recursion of a time-invariant Kalman Filter until it stops changing.
+    :return: steady-state gain, predicted covariance and updated covariance
+    '''
+    sigma = initial_sigma
+    identity = np.identity(A.shape[0])
+    for _ in range(max_iterations):
+        predicted_sigma = A @ sigma @ A.transpose() + Q
+        Kt = predicted_sigma @ H.transpose() @ inv(H @ predicted_sigma @ H.transpose() + R)
+        updated_sigma = (identity - Kt @ H) @ predicted_sigma
+        if np.allclose(updated_sigma, sigma, rtol=tolerance, atol=tolerance):
+            return Kt, predicted_sigma, updated_sigma
+        sigma = updated_sigma
+    raise LinAlgError("Kalman Filter covariance did not converge")
+
+
+def covariance_schedule(A, H, Q, R, initial_sigma, tolerance=1e-12, max_iterations=100000):
+    '''
+    Covariances and gains of a time-invariant Kalman Filter at each step from its start until they reach the steady
+    state, which the last entries hold. They don't depend on the measurements, so every filter started from
+    initial_sigma goes through the same ones.
+    :return: predicted covariances, gains and updated covariances, stacked by step
+    '''
+    sigma = initial_sigma
+    identity = np.identity(A.shape[0])
+    predicted_sigmas, gains, updated_sigmas = [], [], []
+    for _ in range(max_iterations):
+        predicted_sigma = A @ sigma @ A.transpose() + Q
+        Kt = predicted_sigma @ H.transpose() @ inv(H @ predicted_sigma @ H.transpose() + R)
+        updated_sigma = (identity - Kt @ H) @ predicted_sigma
+        predicted_sigmas.append(predicted_sigma)
+        gains.append(Kt)
+        updated_sigmas.append(updated_sigma)
+        if np.allclose(updated_sigma, sigma, rtol=tolerance, atol=tolerance):
+            return np.stack(predicted_sigmas), np.stack(gains), np.stack(updated_sigmas)
+        sigma = updated_sigma
+    raise LinAlgError("Kalman Filter covariance did not converge")
+
+
 class KalmanFilter:
-    def __init__(self, A: np.array, B: np.array, H: np.array, Q: np.array, R: np.array):
+    def __init__(self, A: np.array, B: np.array, H: np.array, Q: np.array, R: np.array, steady=None):
         '''
         :param A: Matrix that represents how the state evolves from t-1 to t, without control or noise
         :param B: Matrix that represents how the control changes the state from t-1 to t
@@ -11,6 +57,8 @@ class KalmanFilter:
         :param Q: Covariance matrix that represents the uncertainty gained from time propagation
         :param R: Covariance matrix that represents the uncertainty gained from observation/measurement
         :param dt: standard time interval
+        :param steady: optional (gain, predicted sigma, updated sigma) from steady_state(). Once the covariance reaches
+            it, the filter stops propagating the covariance and applies the fixed gain.
         '''
         self.A: np.array = A
         self.B: np.array = B
@@ -23,6 +71,8 @@ class KalmanFilter:
         self.last_sigma: np.array = None
 
         self.dimension = A.shape[0]
+        self.steady = steady
+        self.converged = False
 
     def predict(self, ut, last_mean=None, last_sigma=None):
         # boilerplate for checking last_mean
@@ -41,17 +91,36 @@ class KalmanFilter:
 
         # actual calculation
         predicted_mean = self.A @  last_mean + self.B @ ut
-        predicted_sigma = self.A @ last_sigma @ self.A.transpose() + self.Q
+        if self.converged and last_sigma is self.last_sigma:
+            return predicted_mean, self.steady[1]
+        predicted_sigma = self.propagate_sigma(last_sigma)
         # print(f"predicted_mean:\n {predicted_mean}\n predicted_sigma:\n {predicted_sigma}")
 
         return predicted_mean, predicted_sigma
 
-    def update(self, zt, predicted_mean, predicted_sigma):
-        # calculation
+    def propagate_sigma(self, last_sigma):
+        return self.A @ last_sigma @ self.A.transpose() + self.Q
+
+    def correct(self, zt, predicted_mean, predicted_sigma):
         den = inv(self.H @ predicted_sigma @ self.H.transpose() + self.R)
         Kt = predicted_sigma @ self.H.transpose() @ den
         updated_mean = predicted_mean + Kt @ (zt - self.H @ predicted_mean)
         updated_sigma = (np.identity(self.dimension) - Kt @ self.H) @ predicted_sigma
+        return updated_mean, updated_sigma
+
+    def update(self, zt, predicted_mean, predicted_sigma):
+        if self.converged:
+            Kt, _, updated_sigma = self.steady
+            updated_mean = predicted_mean + Kt @ (zt - self.H @ predicted_mean)
+            self.last_mean = updated_mean
+            return updated_mean, updated_sigma
+
+        # calculation
+        updated_mean, updated_sigma = self.correct(zt, predicted_mean, predicted_sigma)
+        if self.steady is not None and np.allclose(updated_sigma, self.steady[2], rtol=STEADY_STATE_TOLERANCE,
+                                                   atol=STEADY_STATE_TOLERANCE):
+            self.converged = True
+            updated_sigma = self.steady[2]
 
         # saving state for next run
         self.last_mean = updated_mean
@@ -65,11 +134,329 @@ class KalmanFilter:
         return self.update(zt, predicted_mean, predicted_sigma)
 
 
+def is_axis_decoupled(A, B, H, Q, R):
+    '''
+    Whether a 6-state model is two independent 3-state axes: (x, vx, ax) and (y, vy, ay), observed directly.
+    '''
+    if A.shape != (6, 6) or H.shape != (6, 6) or not np.array_equal(H, np.identity(6)):
+        return False
+    return all(not matrix[..., :3, 3:].any() and not matrix[..., 3:, :3].any() for matrix in (A, Q, R))
+
+
+def split_axes(matrix):
+    '''
+    (..., 6, 6) block diagonal matrix to its (..., 2, 3, 3) diagonal blocks.
+    '''
+    return np.stack((matrix[..., :3, :3], matrix[..., 3:, 3:]), axis=-3)
+
+
+def join_axes(blocks):
+    '''
+    Inverse of split_axes().
+    '''
+    matrix = np.zeros(blocks.shape[:-3] + (6, 6))
+    matrix[..., :3, :3] = blocks[..., 0, :, :]
+    matrix[..., 3:, 3:] = blocks[..., 1, :, :]
+    return matrix
+
+
+def inv_3x3(M):
+    '''
+    Closed-form inverse (adjugate over determinant) of a stack of 3x3 matrices.
+    '''
+    a, b, c = M[..., 0, 0], M[..., 0, 1], M[..., 0, 2]
+    d, e, f = M[..., 1, 0], M[..., 1, 1], M[..., 1, 2]
+    g, h, i = M[..., 2, 0], M[..., 2, 1], M[..., 2, 2]
+    adjugate = np.empty_like(M)
+    adjugate[..., 0, 0] = e * i - f * h
+    adjugate[..., 0, 1] = c * h - b * i
+    adjugate[..., 0, 2] = b * f - c * e
+    adjugate[..., 1, 0] = f * g - d * i
+    adjugate[..., 1, 1] = a * i - c * g
+    adjugate[..., 1, 2] = c * d - a * f
+    adjugate[..., 2, 0] = d * h - e * g
+    adjugate[..., 2, 1] = b * g - a * h
+    adjugate[..., 2, 2] = a * e - b * d
+    determinant = a * adjugate[..., 0, 0] + b * adjugate[..., 1, 0] + c * adjugate[..., 2, 0]
+    return adjugate / determinant[..., np.newaxis, np.newaxis]
+
+
+def axis_correct(zt, predicted_mean, predicted_sigma_axes, R_axes):
+    '''
+    Measurement update of axis-decoupled filters with H the identity, on (..., 6, 1) means and (..., 2, 3, 3)
+    covariance blocks.
+    '''
+    Kt = predicted_sigma_axes @ inv_3x3(predicted_sigma_axes + R_axes)
+    shape = predicted_mean.shape[:-2] + (2, 3, 1)
+    innovation = (zt - predicted_mean).reshape(shape)
+    updated_mean = predicted_mean + (Kt @ innovation).reshape(predicted_mean.shape)
+    updated_sigma_axes = predicted_sigma_axes - Kt @ predicted_sigma_axes
+    return updated_mean, updated_sigma_axes
+
+
+class AxisDecoupledKalmanFilter(KalmanFilter):
+    '''
+    KalmanFilter for 6-state models made of two independent 3-state axes, see is_axis_decoupled().
+    Both axes run as one batched 3-state filter with closed-form 3x3 solves. Means and covariances keep the 6-state
+    layout, so it is a drop-in replacement giving the same results as KalmanFilter.
+    '''
+    def __init__(self, A: np.array, B: np.array, H: np.array, Q: np.array, R: np.array, steady=None):
+        if not is_axis_decoupled(A, B, H, Q, R):
+            raise ValueError("Model is not axis decoupled")
+        super().__init__(A, B, H, Q, R, steady=steady)
+        self.A_axes = split_axes(A)
+        self.Q_axes = split_axes(Q)
+        self.R_axes = split_axes(R)
+
+    def propagate_sigma(self, last_sigma):
+        sigma_axes = split_axes(last_sigma)
+        return join_axes(self.A_axes @ sigma_axes @ self.A_axes.swapaxes(-1, -2) + self.Q_axes)
+
+    def correct(self, zt, predicted_mean, predicted_sigma):
+        updated_mean, updated_sigma_axes = axis_correct(zt, predicted_mean, split_axes(predicted_sigma), self.R_axes)
+        return updated_mean, join_axes(updated_sigma_axes)
+
+
+class KalmanFilterBank:
+    '''
+    Steps the Kalman filters of a whole fleet at once.
+    All filters share A, B, H and Q, while R is kept per filter. Means, covariances and R are stacked as
+    (N, dim, 1), (N, dim, dim) and (N, m, m) arrays. The live filters always occupy the first `size` rows: removing
+    one moves the last row into its place, and the stacks only grow (doubling) when they are full.
+    '''
+    def __init__(self, A: np.array, B: np.array, H: np.array, Q: np.array, capacity: int = 16,
+                 steady_state=False):
+        '''
+        :param steady_state: once a filter's covariance reaches its steady state, skip the covariance recursion for it
+            and apply its fixed steady-state gain. Filters must then be added with their steady() solution.
+        '''
+        self.A: np.array = A
+        self.B: np.array = B
+        self.H: np.array = H
+        self.Q: np.array = Q
+        self.dimension = A.shape[0]
+        self.measurement_dimension = H.shape[0]
+        self.steady_state = steady_state
+
+        self.size = 0
+        d, m = self.dimension, self.measurement_dimension
+        self.means = np.zeros((capacity, d, 1))
+        self.sigmas = np.zeros((capacity, d, d))
+        self.R = np.zeros((capacity, m, m))
+        # steady-state gain and covariance of each filter, and whether it already reached them
+        self.steady_gains = np.zeros((capacity, d, m))
+        self.steady_sigmas = np.zeros((capacity, d, d))
+        self.converged = np.zeros(capacity, dtype=bool)
+        # rows without a measurement yet, seeded with their first one
+        self.started = np.zeros(capacity, dtype=bool)
+        self.owners = [None] * capacity
+
+        # the axis-decoupled fast path holds while every R added is block diagonal as well
+        self.axis_decoupled = is_axis_decoupled(A, B, H, Q, np.zeros((6, 6))) if d == 6 else False
+        if self.axis_decoupled:
+            self.A_axes = split_axes(A)
+            self.Q_axes = split_axes(Q)
+
+    row_arrays = ('means', 'sigmas', 'R', 'steady_gains', 'steady_sigmas', 'converged', 'started')
+
+    @property
+    def capacity(self):
+        return self.means.shape[0]
+
+    def accepts(self, A, B, H, Q):
+        return np.array_equal(self.A, A) and np.array_equal(self.B, B) and \
+            np.array_equal(self.H, H) and np.array_equal(self.Q, Q)
+
+    def _grow(self):
+        capacity = 2 * self.capacity
+        for name in self.row_arrays:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+        self.owners.extend([None] * (capacity - len(self.owners)))
+
+    def add(self, owner, mean, sigma, R, steady=None):
+        '''
+        Add a filter to the bank. The owner's `bank_slot` attribute is kept pointing at its row.
+        :param steady: (gain, predicted sigma, updated sigma) from steady_state(), required in steady_state mode
+        '''
+        if self.steady_state and steady is None:
+            raise ValueError("KalmanFilterBank in steady_state mode needs the filter's steady state")
+        if self.size == self.capacity:
+            self._grow()
+        slot = self.size
+        self.means[slot] = mean
+        self.sigmas[slot] = sigma
+        self.R[slot] = R
+        if self.axis_decoupled and not is_axis_decoupled(self.A, self.B, self.H, self.Q, R):
+            self.axis_decoupled = False
+        if steady is not None:
+            self.steady_gains[slot] = steady[0]
+            self.steady_sigmas[slot] = steady[2]
+        self.converged[slot] = False
+        self.started[slot] = owner.started
+        self.owners[slot] = owner
+        owner.bank_slot = slot
+        self.size += 1
+        return slot
+
+    def get_row(self, slot):
+        '''
+        State of a filter, to move it to another bank with set_row().
+        '''
+        return {name: getattr(self, name)[slot].copy() for name in self.row_arrays}
+
+    def set_row(self, slot, state):
+        for name in self.row_arrays:
+            getattr(self, name)[slot] = state[name]
+
+    def remove(self, slot):
+        last = self.size - 1
+        owner = self.owners[slot]
+        if slot != last:
+            for name in self.row_arrays:
+                array = getattr(self, name)
+                array[slot] = array[last]
+            self.owners[slot] = self.owners[last]
+            self.owners[slot].bank_slot = slot
+        self.owners[last] = None
+        owner.bank_slot = None
+        self.size = last
+
+    def predict(self, ut):
+        last_mean = self.means[:self.size]
+        last_sigma = self.sigmas[:self.size]
+        predicted_mean = self.A @ last_mean + self.B @ ut
+        return predicted_mean, self.propagate_sigma(last_sigma)
+
+    def propagate_sigma(self, last_sigma):
+        if self.axis_decoupled:
+            return join_axes(self.A_axes @ split_axes(last_sigma) @ self.A_axes.swapaxes(-1, -2) + self.Q_axes)
+        return self.A @ last_sigma @ self.A.transpose() + self.Q
+
+    def correct(self, zt, predicted_mean, predicted_sigma, R):
+        if self.axis_decoupled:
+            updated_mean, updated_sigma_axes = axis_correct(zt, predicted_mean, split_axes(predicted_sigma),
+                                                            split_axes(R))
+            return updated_mean, join_axes(updated_sigma_axes)
+
+        # K = P H^T S^-1 is the transpose of S^-T H P^T, so a batched solve replaces the inverse. S is only symmetric
+        # up to rounding, and solving with S instead of S^T lets that asymmetry grow in P until the filter diverges
+        S = self.H @ predicted_sigma @ self.H.transpose() + R
+        Kt = np.linalg.solve(S.transpose(0, 2, 1), self.H @ predicted_sigma.transpose(0, 2, 1)).transpose(0, 2, 1)
+        updated_mean = predicted_mean + Kt @ (zt - self.H @ predicted_mean)
+        updated_sigma = predicted_sigma - Kt @ self.H @ predicted_sigma
+        return updated_mean, updated_sigma
+
+    def update(self, zt, predicted_mean, predicted_sigma):
+        n = self.size
+        updated_mean, updated_sigma = self.correct(zt, predicted_mean, predicted_sigma, self.R[:n])
+
+        # saving state for next run
+        self.means[:n] = updated_mean
+        self.sigmas[:n] = updated_sigma
+
+        return updated_mean, updated_sigma
+
+    def step(self, ut, zt):
+        '''
+        :param ut: control, either shared by all filters or stacked as (size, ...)
+        :param zt: measurements stacked as (size, m, 1), in row order. Rows that never had a measurement start from it.
+        '''
+        started = self.started[:self.size]
+        if not started.all():
+            new_rows = np.flatnonzero(~started)
+            self.means[new_rows] = zt[new_rows]
+            started[new_rows] = True
+            for row in new_rows:
+                self.owners[row].started = True
+        if self.steady_state:
+            return self.step_steady_state(ut, zt)
+        predicted_mean, predicted_sigma = self.predict(ut)
+        return self.update(zt, predicted_mean, predicted_sigma)
+
+    def step_steady_state(self, ut, zt):
+        '''
+        step() for steady_state mode: converged rows only get the mean update with their fixed gain, the others run
+        the full recursion and are marked converged once their covariance reaches the steady state.
+        '''
+        n = self.size
+        predicted_mean = self.A @ self.means[:n] + self.B @ ut
+        updated_mean = np.empty_like(predicted_mean)
+
+        converged = self.converged[:n]
+        rows = np.flatnonzero(converged)
+        if rows.size > 0:
+            innovation = zt[rows] - self.H @ predicted_mean[rows]
+            updated_mean[rows] = predicted_mean[rows] + self.steady_gains[rows] @ innovation
+
+        rows = np.flatnonzero(~converged)
+        if rows.size > 0:
+            predicted_sigma = self.propagate_sigma(self.sigmas[rows])
+            updated_mean[rows], updated_sigma = self.correct(zt[rows], predicted_mean[rows], predicted_sigma,
+                                                             self.R[rows])
+
+            steady_sigma = self.steady_sigmas[rows]
+            reached = np.all(np.isclose(updated_sigma, steady_sigma, rtol=STEADY_STATE_TOLERANCE,
+                                        atol=STEADY_STATE_TOLERANCE), axis=(1, 2))
+            updated_sigma[reached] = steady_sigma[reached]
+            self.sigmas[rows] = updated_sigma
+            self.converged[rows[reached]] = True
+
+        self.means[:n] = updated_mean
+        return updated_mean, self.sigmas[:n].copy()
+
+
 class CarSystemKF:
-    def __init__(self, manager, dt: float = 1):
+    # model matrices and steady-state solutions, keyed by (dt, measurement noise, calibration)
+    models = {}
+    # calibrated P, Q and R matrices of each calibration file, keyed by (dt, measurement noise), see load_calibration()
+    calibrations = {}
+
+    def __init__(self, manager, dt: float = 1, steady_state=False, calibration=None):
+        '''
+        :param calibration: path of a file written by calibrate.py to take the P, Q and R matrices from, see get_model()
+        '''
         self.mng = manager
+        self.calibration = calibration
+        self.started = False
+        self.bank: KalmanFilterBank = None
+        self.bank_slot: int = None
+        self.dt = dt
+        self.measurement_noise = self.mng.sensor.measurement_noise
+
+        A, B, H, P, Q, R = self.get_model(dt, self.measurement_noise, calibration)
+        steady = self.get_steady_state(dt, self.measurement_noise, calibration) if steady_state else None
+        if is_axis_decoupled(A, B, H, Q, R):
+            self.kf = AxisDecoupledKalmanFilter(A, B, H, Q, R, steady=steady)
+        else:
+            self.kf = KalmanFilter(A, B, H, Q, R, steady=steady)
+
+        # initialize sigma
+        self.reset()
+
+    def reset(self):
+        '''
+        Back to the state of a filter that has not seen any measure yet.
+        '''
         self.started = False
-        mea = self.mng.sensor.measurement_noise
+        self.kf.last_mean = None
+        # initial_sigma = np.identity(6)
+        initial_sigma = self.get_model(self.dt, self.measurement_noise, self.calibration)[3]
+        self.kf.last_sigma = initial_sigma
+        self.kf.converged = False
+
+    @classmethod
+    def get_model(cls, dt, mea, calibration=None):
+        '''
+        A, B, H, P, Q and R matrices for a time step and measurement noise, built once and shared (read-only).
+        :param calibration: path of a file written by calibrate.py, read on first use: its P, Q and R matrices are used
+            for the (dt, measurement noise) pairs it calibrated, the built-in ones for any other
+        '''
+        key = (dt, mea, calibration)
+        if key in cls.models:
+            return cls.models[key]['matrices']
 
         # Kalman Filter parameters:
         A = np.array(
@@ -82,7 +469,15 @@ class CarSystemKF:
         )
         B = np.array([[0], [0], [1], [0], [0], [1]])  # control effects acceleration, basically
         H = np.identity(n=6)
-        # this covariance matrix come from experimentations with covariance_lab.py
+        if calibration is not None:
+            if calibration not in cls.calibrations:
+                cls.load_calibration(calibration)
+            if (dt, mea) in cls.calibrations[calibration]:
+                P, Q, R = cls.calibrations[calibration][(dt, mea)]
+                return cls.store_model(key, (A, B, H, P, Q, R))
+
+        # this covariance matrix is the one of the sensor's measurement error for a unit noise variance, calibrate.py
+        # estimates the actual P, Q and R from simulated cars
         P = np.array(
                             [[1, 1, 1, 0, 0, 0],
                              [1, 2, 3, 0, 0, 0],
@@ -94,13 +489,52 @@ class CarSystemKF:
         R = P * mea * dt
         Q = P * dt * 2
         # Q = np.zeros((6, 6))
-        self.kf = KalmanFilter(A, B, H, Q, R)
 
-        # initialize sigma
-        if not self.started:
-            # initial_sigma = np.identity(6)
-            initial_sigma = P
-            self.kf.last_sigma = initial_sigma
+        return cls.store_model(key, (A, B, H, P, Q, R))
+
+    @classmethod
+    def store_model(cls, key, matrices):
+        for matrix in matrices:
+            matrix.setflags(write=False)
+        cls.models[key] = {'matrices': matrices, 'steady': None}
+        return matrices
+
+    @classmethod
+    def load_calibration(cls, path):
+        '''
+        Read, or read again, the P, Q and R matrices of a file written by calibrate.py, used by the filters given that
+        calibration. The models built from an older read of the file are dropped.
+        '''
+        calibrations = {}
+        with open(path) as f:
+            for calibration in yaml.safe_load(f)['calibrations']:
+                key = (calibration['dt'], calibration['measurement_noise'])
+                calibrations[key] = tuple(np.array(calibration[name], dtype=float) for name in ('P', 'Q', 'R'))
+        cls.calibrations[path] = calibrations
+        cls.models = {key: model for key, model in cls.models.items() if key[2] != path}
+
+    @classmethod
+    def get_steady_state(cls, dt, mea, calibration=None):
+        '''
+        Steady-state gain, predicted and updated covariance of the model, which every car converges to since they all
+        start from the same P.
+        '''
+        A, B, H, P, Q, R = cls.get_model(dt, mea, calibration)
+        model = cls.models[(dt, mea, calibration)]
+        if model['steady'] is None:
+            steady = steady_state(A, H, Q, R, P)
+            for matrix in steady:
+                matrix.setflags(write=False)
+            model['steady'] = steady
+        return model['steady']
+
+    @staticmethod
+    def get_states_from_measures(position, velocity, accel):
+        '''
+        Batched get_state_from_measure(): (n, 2) positions, velocities and accelerations to (n, 6, 1) state vectors.
+        '''
+        return np.stack((position[:, 0], velocity[:, 0], accel[:, 0],
+                         position[:, 1], velocity[:, 1], accel[:, 1]), axis=1)[:, :, np.newaxis]
 
     def get_state_from_measure(self, measure):
         assert len(measure) == 3
@@ -131,3 +565,23 @@ class CarSystemKF:
 
         return result
 
+    def attach(self, bank: KalmanFilterBank):
+        '''
+        Hand the filter state over to a KalmanFilterBank, which then steps it together with the rest of the fleet.
+        '''
+        if not bank.accepts(self.kf.A, self.kf.B, self.kf.H, self.kf.Q):
+            raise ValueError("KalmanFilterBank model does not match this filter's A, B, H and Q")
+        last_mean = self.kf.last_mean if self.kf.last_mean is not None else np.zeros((bank.dimension, 1))
+        steady = self.get_steady_state(self.dt, self.measurement_noise, self.calibration) if bank.steady_state else None
+        bank.add(self, last_mean, self.kf.last_sigma, self.kf.R, steady=steady)
+        self.bank = bank
+
+    def detach(self):
+        if self.bank is not None and self.bank_slot is not None:
+            self.bank.remove(self.bank_slot)
+        self.bank = None
+
+    def set_state(self, mean, sigma):
+        self.kf.last_mean = mean
+        self.kf.last_sigma = sigma
+
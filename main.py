@@ -2,6 +2,8 @@ import sys
 import yaml
 import argparse
 from game import Game
+from headless import run_headless
+from models.Recorder import Replay
 
 
 def update_configs(default: dict, custom: dict):
@@ -14,7 +16,10 @@ def update_configs(default: dict, custom: dict):
             default[k] = custom[k]
 
 
-def main():
+def load_config(config_path=None):
+    '''
+    Load default.yaml, merged with the config file at config_path if given.
+    '''
     try:
         with open('config/default.yaml') as dcf:
             config = yaml.safe_load(dcf)
@@ -22,18 +27,51 @@ def main():
         print("Default config missing")
         sys.exit()
 
+    # Open and load the config file
+    if config_path:
+        with open(config_path) as cf:
+            custom_config = yaml.safe_load(cf)
+            update_configs(config, custom_config)
+
+    return config
+
+
+def main():
+
     parser = argparse.ArgumentParser(
         prog='Collision predictor',
         description='Example project for learning Kalman filters'
     )
     parser.add_argument('-c', '--config')
+    parser.add_argument('--headless', action='store_true', help='run without a window, as fast as possible')
+    parser.add_argument('--frames', type=int, default=1000, help='number of frames to run in headless mode')
+    parser.add_argument('--seed', type=int, help='seed for the random number generators, headless mode only')
+    parser.add_argument('--replay', help='recording directory to play back instead of simulating')
+    parser.add_argument('--start', type=int, help='first frame to replay')
+    parser.add_argument('--end', type=int, help='last frame to replay')
+    parser.add_argument('--analyse', action='store_true', help='print stats of the replayed frames, no window')
     args = parser.parse_args()
 
-    # Open and load the config file
-    if args.config:
-        with open(args.config) as cf:
-            custom_config = yaml.safe_load(cf)
-            update_configs(config, custom_config)
+    config = load_config(args.config)
+
+    if args.replay:
+        replay = Replay(args.replay)
+        if args.analyse:
+            replay.get_report(args.start, args.end)
+            return
+        # nothing is recorded while playing back, so the recording being read is left as it is
+        config['recorder']['path'] = None
+        # played back in the world it was recorded in, at its speed and car sizes
+        game = Game(config, world=replay.world(config))
+        game.setup()
+        game.replay(replay, args.start, args.end)
+        return
+
+    if args.headless:
+        env, fps = run_headless(config, args.frames, seed=args.seed)
+        env.get_report()
+        print(f"{args.frames} frames at {fps:.1f} frames/sec")
+        return
 
     game = Game(config)
     game.setup()
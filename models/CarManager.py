@@ -1,14 +1,13 @@
 import math
-import time
 import random
+import itertools
+from dataclasses import fields, MISSING
 import numpy as np
 
-import pygame
-from pygame.locals import *
-
 from kalman import CarSystemKF
 from models.Basics import GameObject, Vector2, segments_distance
 from models.Sensor import ObjectSensor
+from models.WorldState import StateBacked
 
 
 class Car(GameObject):
@@ -19,35 +18,23 @@ class Car(GameObject):
     max_accel: float = 0.5
     max_steering_angle: float = math.pi / 4
     
-    def __init__(self, *args, scale=10, **kwargs):
+    def __init__(self, *args, scale=10, color=None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.init_car(scale, color)
+
+    def init_car(self, scale, color=None):
         self.crashed = False
-        self.crashed_time = None
+        self.crashed_frame = None
         self.scale = scale
-        color = random.choice(self.color_options)
-        # load car sprite
-        self.img = pygame.image.load(f"assets/{color}_car.png").convert_alpha()
-        self.img = pygame.transform.scale(self.img, (3*scale, 5*scale))
-        # load brake sprite
-        self.brake_sprite = pygame.image.load(f"assets/brake.png").convert_alpha()
-        self.brake_sprite = pygame.transform.scale(self.brake_sprite, (4*scale, 4*scale))
+        self.color = color if color is not None else random.choice(self.color_options)
+        self.size = self.size_for(scale)
         self.is_braking = False
-
-        self.controls = {
-            K_UP: lambda: self.control('UP'),
-            K_DOWN: lambda: self.control('DOWN'),
-            K_RIGHT: lambda: self.control('RIGHT'),
-            K_LEFT: lambda: self.control('LEFT'),
-            K_b: lambda: self.control('BRAKE')
-        }
+        # set by the renderer, if any
+        self.sprite = None
 
     def __repr__(self):
         return f"{self.edges}"
 
-    @property
-    def size(self):
-        return self.img.get_size()
-
     @property
     def edges(self):
         return (
@@ -64,21 +51,6 @@ class Car(GameObject):
             (self.position.y + self.size[1] / 2, self.position.y - self.size[1] / 2)
         )
 
-    def draw_sprite(self, surface):
-        rot_img = pygame.transform.rotate(self.img, math.degrees(-self.rotation_angle - math.pi/2))
-        surface.blit(rot_img, (
-                                    self.position.x - self.size[0]/2,
-                                    self.position.y - self.size[1]/2,
-                                ) )
-        if self.is_braking:
-            self.draw_brake_symbol(surface)
-
-    def draw_brake_symbol(self, surface):
-        surface.blit(self.brake_sprite, (
-            self.position.x - self.size[0] / 2,
-            self.position.y - self.size[1] / 2,
-        ))
-    
     def control(self, command: str):
         if command == 'UP':
             if self.speed > 0:
@@ -105,23 +77,80 @@ class Car(GameObject):
             elif self.speed < 0:
                 self.accel += self.brake_accel
 
-    def update_collision(self):
+    def reset(self, position, velocity, **kwargs):
+        '''
+        Put the car back in the state of a just built one, for reuse. Takes the same arguments as the constructor.
+        '''
+        for field in fields(GameObject):
+            if field.default is not MISSING:
+                setattr(self, field.name, kwargs.get(field.name, field.default))
+        self.position = position
+        self.velocity = velocity
+        self.init_car(kwargs.get('scale', self.scale), kwargs.get('color'))
+
+    @staticmethod
+    def size_for(scale, crashed=False):
+        if crashed:
+            return 8 * scale, 8 * scale
+        return 3 * scale, 5 * scale
+
+    @property
+    def crash_size(self):
+        return self.size_for(self.scale, crashed=True)
+
+    def update_collision(self, frame):
         if not self.crashed:
             self.crashed = True
-            self.crashed_time = time.time()
-            self.img = pygame.image.load(f"assets/crash.png").convert_alpha()
-            self.img = pygame.transform.scale(self.img, (8 * self.scale, 8 * self.scale))
+            self.crashed_frame = frame
+            self.size = self.crash_size
+
+
+class StateCar(StateBacked, Car):
+    '''
+    Car whose physics state is a row of a WorldState, stepped for the whole fleet by WorldState.step().
+    '''
+    pass
 
 
 class CarManager:
-    def __init__(self, env, randomize=False, interval=1/20, measurement_noise=5):
+    # seconds a crashed car stays on screen before being removed
+    crash_linger_time = 0.4
+
+    def __init__(self, env, randomize=False, interval=None, measurement_noise=5, spawn=None):
+        '''
+        :param spawn: position, velocity, acceleration, steering angle and color of the car, drawn by draw_spawn() when
+            not given
+        '''
         self.env = env
+        # set by the environment
+        self.id = None
+        self.handle = None
+        self.retired = False
         self.kf_center = None
         self.kf_rect = None
+        if interval is None:
+            interval = env.world.interval
+
+        position, velocity, accel, steering_angle, color = spawn if spawn is not None else \
+            self.draw_spawn(env.world, randomize)
+        if env.world_state is not None:
+            self.car = StateCar(env.world_state, position, velocity, accel=accel, steering_angle=steering_angle,
+                                scale=env.world.scale, color=color)
+        else:
+            self.car = Car(position, velocity, accel=accel, steering_angle=steering_angle, scale=env.world.scale,
+                           color=color)
+        self.sensor = ObjectSensor(self.car, measurement_noise=measurement_noise)
+        self.kalman_filter = CarSystemKF(self, dt=interval, steady_state=env.kf_steady_state,
+                                         calibration=env.kf_calibration)
 
+    @staticmethod
+    def draw_spawn(world, randomize):
+        '''
+        :return: position, velocity, acceleration, steering angle and color of a new car
+        '''
         if randomize:
-            position = Vector2(random.randint(1, env.game.windowSize[0]),
-                               random.randint(1, env.game.windowSize[1]))
+            position = Vector2(random.randint(1, world.window_size[0]),
+                               random.randint(1, world.window_size[1]))
             velocity = Vector2(0, 0)
             accel = 1
             steering_angle = random.random() * 2 * math.pi
@@ -130,34 +159,78 @@ class CarManager:
             velocity = Vector2(0, 0)
             accel = 0
             steering_angle = 0
+        color = random.choice(Car.color_options)
+        return position, velocity, accel, steering_angle, color
 
-        self.car = Car(position, velocity, accel=accel, steering_angle=steering_angle, scale=env.game.scale)
-        self.sensor = ObjectSensor(self.car, measurement_noise=measurement_noise)
-        self.kalman_filter = CarSystemKF(self, dt=interval)
+    def reset(self, randomize=False, interval=None, measurement_noise=5, spawn=None):
+        '''
+        Bring a retired manager back as a new car, reusing its car, sensor and Kalman Filter.
+        Takes the same arguments as the constructor and draws the same random numbers, in the same order.
+        '''
+        self.id = None
+        self.retired = False
+        self.kf_center = None
+        self.kf_rect = None
+        if interval is None:
+            interval = self.env.world.interval
+
+        position, velocity, accel, steering_angle, color = spawn if spawn is not None else \
+            self.draw_spawn(self.env.world, randomize)
+        if isinstance(self.car, StateBacked):
+            self.car.acquire(self.env.world_state)
+        self.car.reset(position, velocity, accel=accel, steering_angle=steering_angle, scale=self.env.world.scale,
+                       color=color)
+        if measurement_noise == self.sensor.measurement_noise and interval == self.kalman_filter.dt:
+            self.sensor.reset()
+            self.kalman_filter.reset()
+        else:
+            self.sensor = ObjectSensor(self.car, measurement_noise=measurement_noise)
+            self.kalman_filter = CarSystemKF(self, dt=interval, steady_state=self.env.kf_steady_state,
+                                             calibration=self.env.kf_calibration)
 
     def update(self):
+        self.check_retirement()
+        self.car.update()
+        measure = self.sensor.measure()
+        mean, var = self.kalman_filter.update(measure)
+        kf_repr = self.finish_update(mean, var)
+        self.react()
+        return kf_repr
+
+    def check_retirement(self):
+        '''
+        First part of update(): deletes the car if it crashed a while ago or left the window.
+        '''
         # check for collision
-        if self.car.crashed and time.time() - self.car.crashed_time > 0.4:
+        if self.car.crashed and \
+                self.env.frame - self.car.crashed_frame > self.crash_linger_time / self.env.world.interval:
             self.delete()
 
         # check for leaving the window
         car_edges_x = self.car.edges_split[0]
         car_edges_y = self.car.edges_split[1]
         if max(car_edges_x) < 0 or \
-                min(car_edges_x) > self.env.game.windowSize[0] or \
+                min(car_edges_x) > self.env.world.window_size[0] or \
                 max(car_edges_y) < 0 or \
-                min(car_edges_y) > self.env.game.windowSize[1]:
+                min(car_edges_y) > self.env.world.window_size[1]:
+            self.env.left_window_count += 1
             self.delete()
 
-        self.car.update()
-        measure = self.sensor.measure()
-        mean, var = self.kalman_filter.update(measure)
-
+    def finish_update(self, mean, var):
+        '''
+        Second half of update(), run once the Kalman Filter has been stepped with the last measure.
+        '''
         # Make Kalman Filter result representation:
         kf_repr = self.make_repr(mean, var)
 
         return kf_repr
 
+    def react(self):
+        '''
+        Last part of update(), run once every car in the environment has finished its update.
+        '''
+        pass
+
     @staticmethod
     def make_repr(mean, var, var_multiplier=30):
         center = (mean[0][0], mean[3][0])
@@ -168,12 +241,26 @@ class CarManager:
         return point, rect
 
     def delete(self):
-        self.env.alive_cars_count -= 1
-        if self in self.env.car_mngs:
-            self.env.car_mngs.remove(self)
+        '''
+        Retire the car. It stays in the environment until the end of the frame, see Environment.retire().
+        '''
+        self.env.retire(self)
+
+    def release(self):
+        '''
+        Leave the environment's state, sensor and filter banks, keeping the objects for reuse.
+        '''
+        self.kalman_filter.detach()
+        self.sensor.detach()
+        if isinstance(self.car, StateBacked):
+            self.car.release()
 
 
 class SelfDrivingCarManager(CarManager):
+    # closest-approach prediction knows when cars meet, not only where their paths cross: keep room for the error of
+    # the predicted timing by counting a conflict at this many times the car's largest dimension
+    conflict_distance_factor = 2
+
     def __init__(self, *args, look_ahead_time: float = 10, **kwargs):
         super().__init__(*args,  **kwargs)
         '''
@@ -181,11 +268,21 @@ class SelfDrivingCarManager(CarManager):
         It's not used to update with current measures since that's already done by the regular Kalman Filter on the
         parent object.
         '''
-        self.predictor_kf: CarSystemKF = CarSystemKF(self, dt=look_ahead_time)
+        self.predictor_kf: CarSystemKF = CarSystemKF(self, dt=look_ahead_time, calibration=self.env.kf_calibration)
+        self.future_position = None
+        # earliest predicted conflict, in the time units of look_ahead_time, set by the environment when using
+        # closest-approach prediction
+        self.conflict_time = None
+
+    def reset(self, *args, look_ahead_time: float = 10, **kwargs):
+        super().reset(*args, **kwargs)
+        if look_ahead_time != self.predictor_kf.dt:
+            self.predictor_kf = CarSystemKF(self, dt=look_ahead_time, calibration=self.env.kf_calibration)
         self.future_position = None
+        self.conflict_time = None
 
-    def update(self):
-        super().update()
+    def finish_update(self, mean, var):
+        super().finish_update(mean, var)
         ut = np.zeros((1, 1))
         last_mean, last_sigma = self.kalman_filter.kf.last_mean, self.kalman_filter.kf.last_sigma
         predicted_mean, predicted_sigma = self.predictor_kf.kf.predict(ut, last_mean=last_mean, last_sigma=last_sigma)
@@ -196,15 +293,23 @@ class SelfDrivingCarManager(CarManager):
         # Save state
         self.future_position, _ = future_repr
 
+        return future_repr
+
+    @property
+    def conflict_distance(self):
+        return self.conflict_distance_factor * max(self.car.size)
+
+    def react(self):
         # Check for collisions
-        collision = self.predict_collisions()
+        if self.env.collision_prediction == 'closest_approach':
+            collision = self.conflict_time is not None
+        else:
+            collision = self.predict_collisions()
         if collision:
             self.car.control('BRAKE')
         else:
             self.car.is_braking = False
 
-        return future_repr
-
     def predict_collisions(self) -> bool:
         '''
             Predict collision between this car and other cars.
@@ -217,10 +322,11 @@ class SelfDrivingCarManager(CarManager):
 
         this_car_segment = (self.car.position.get(), self.future_position)
 
-        # TODO: Be more selective when picking other cars for this loop, e.g., segmenting the simulation space with
-        #  quad-trees
-        # Get all other cars in the environment
-        other_cars = self.env.car_mngs
+        # Get the other cars whose trajectories come close to this one, or all of them without an index
+        if self.env.trajectory_index is not None:
+            other_cars = self.env.trajectory_index.query(this_car_segment, margin=max(self.car.size))
+        else:
+            other_cars = itertools.chain(self.env.car_mngs, self.env.ghosts)
 
         # check for future collisions:
         for other_car_mng in other_cars:
@@ -1,18 +1,146 @@
-from models.Basics import segments_distance, check_collision
+import heapq
+import itertools
+import numpy as np
+
+from kalman import CarSystemKF, KalmanFilterBank
+from models.Basics import check_collision, oriented_box_collisions
 from models.CarManager import CarManager, SelfDrivingCarManager
+from models.Pool import SlotTable
+from models.Prediction import ClosestApproachPredictor
+from models.Profiler import FrameProfiler
+from models.Recorder import Recorder
+from models.Sensor import SensorBank
+from models.Spatial import SegmentGrid, SweepAndPrune, UniformGrid, brute_force_pairs
+from models.World import World
+from models.WorldState import WorldState
 
 
 class Environment:
-    def __init__(self, game, target_n_cars=0):
-        self.game = game
+    def __init__(self, world: World, target_n_cars=0, sim_config: dict = None, broadphase='grid',
+                 use_world_state=False, kf_steady_state=False, profiler: FrameProfiler = None,
+                 recorder: Recorder = None, seed=None, collision_prediction='segment', prediction_steps=10,
+                 sensor_noise='stream', narrow_phase='aabb', kf_calibration=None):
+        '''
+        :param broadphase: how check_collisions picks the pairs of cars to test, 'grid', 'sap' (sweep and prune, kept
+            from one frame to the next) or 'brute' (every pair)
+        :param use_world_state: keep car physics in a WorldState and step it for all cars at once
+        :param kf_steady_state: switch each car's Kalman Filter to its fixed steady-state gain once converged
+        :param profiler: times the phases of each frame, disabled if not given
+        :param recorder: if given, records the state of every car after each step()
+        :param seed: seeds the sensor noise of the whole fleet
+        :param collision_prediction: how self-driving cars foresee collisions, 'segment' (each car tests its straight
+            predicted segment against the others) or 'closest_approach' (earliest conflict time of every car, solved
+            for the whole fleet at once)
+        :param prediction_steps: sub-horizons the look-ahead window is split in by 'closest_approach'
+        :param sensor_noise: 'stream' (drawn for the whole fleet from one seeded generator) or 'counter' (a function of
+            the seed, car id and frame only, so the same for a car whatever the other cars measured with it)
+        :param narrow_phase: how the candidate pairs of cars are tested for collision, 'aabb' (as unrotated boxes,
+            one pair at a time) or 'obb' (as boxes turned by their rotation angles, all pairs at once)
+        :param kf_calibration: path of a file written by calibrate.py with the P, Q and R matrices of the cars' Kalman
+            Filters, the built-in matrices are used if not given
+        '''
+        if broadphase not in ('grid', 'sap', 'brute'):
+            raise ValueError(f"Unknown broadphase: {broadphase}")
+        if collision_prediction not in ('segment', 'closest_approach'):
+            raise ValueError(f"Unknown collision prediction: {collision_prediction}")
+        if sensor_noise not in ('stream', 'counter'):
+            raise ValueError(f"Unknown sensor noise: {sensor_noise}")
+        if narrow_phase not in ('aabb', 'obb'):
+            raise ValueError(f"Unknown narrow phase: {narrow_phase}")
+        self.world = world
         self.target_n_cars = target_n_cars
-        self.car_mngs = list()
-        self.cars_kf_repr = list()
+        self.sim_config = sim_config
+        self.frame = 0
+        self.car_mngs = SlotTable()
+        # retired managers, removed at the end of the frame and then kept in the pool of their class for reuse
+        self.retired = list()
+        self.pools = dict()
+        self.kf_bank: KalmanFilterBank = None
+        self.sensor_bank = SensorBank(seed=seed, counter_noise=sensor_noise == 'counter')
+        self.kf_steady_state = kf_steady_state
+        self.kf_calibration = kf_calibration
+        self.profiler = profiler if profiler is not None else FrameProfiler()
+        self.recorder = recorder
+        self.next_car_id = 0
+        self.world_state: WorldState = WorldState() if use_world_state else None
+        self.broadphase = broadphase
+        self.narrow_phase = narrow_phase
+        self.collision_grid = UniformGrid(rotated=narrow_phase == 'obb')
+        self.sweep_and_prune = SweepAndPrune(rotated=narrow_phase == 'obb')
+        self.trajectory_index: SegmentGrid = None
+        self.collision_prediction = collision_prediction
+        self.prediction_steps = prediction_steps
+        self.conflict_predictor: ClosestApproachPredictor = None
+        # cars simulated elsewhere (by another shard) that the collision predictions of these ones must account for
+        self.ghosts = list()
         # Stats:
         self.alive_cars_count = 0
         self.total_cars_count = 0
         self.collision_count = 0
-    
+        self.left_window_count = 0
+
+    @classmethod
+    def from_config(cls, config: dict, world: World = None, seed=None):
+        if world is None:
+            world = World.from_config(config)
+        return cls(world=world, target_n_cars=config['sim']['target_n_cars'], sim_config=config['sim'],
+                   broadphase=config['sim']['broadphase'], use_world_state=config['sim']['world_state'],
+                   kf_steady_state=config['sim']['kf_steady_state'],
+                   profiler=FrameProfiler.from_config(config.get('profiler')),
+                   recorder=Recorder.from_config(config.get('recorder'), world=world), seed=seed,
+                   collision_prediction=config['sim']['collision_prediction'],
+                   prediction_steps=config['sim']['prediction_steps'], sensor_noise=config['sim']['sensor_noise'],
+                   narrow_phase=config['sim']['narrow_phase'], kf_calibration=config['sim']['kf_calibration'])
+
+    def add_car_mng(self, car_mng, car_id=None):
+        '''
+        :param car_id: id of a car coming from another environment, a new one is assigned if not given
+        '''
+        car_kf = car_mng.kalman_filter.kf
+        if self.kf_bank is None:
+            self.kf_bank = KalmanFilterBank(car_kf.A, car_kf.B, car_kf.H, car_kf.Q, steady_state=self.kf_steady_state)
+        car_mng.kalman_filter.attach(self.kf_bank)
+        car_mng.sensor.attach(self.sensor_bank)
+        if car_id is None:
+            car_id = self.next_car_id
+            self.next_car_id += 1
+        car_mng.id = car_id
+        self.car_mngs.add(car_mng)
+
+    def make_car_mng(self, cls, **kwargs):
+        '''
+        A manager of class cls, reused from the pool if one is there.
+        '''
+        pool = self.pools.get(cls)
+        if pool:
+            car_mng = pool.pop()
+            car_mng.reset(**kwargs)
+            return car_mng
+        return cls(env=self, **kwargs)
+
+    def retire(self, car_mng):
+        '''
+        Take a car out of the simulation at the end of the frame. It is counted out right away.
+        '''
+        if car_mng.retired:
+            return
+        car_mng.retired = True
+        self.alive_cars_count -= 1
+        self.retired.append(car_mng)
+
+    def remove_retired(self):
+        for car_mng in self.retired:
+            self.remove_car_mng(car_mng)
+        self.retired.clear()
+
+    def remove_car_mng(self, car_mng):
+        '''
+        Take a manager out of the environment and keep it in the pool of its class. Use retire() to end a car.
+        '''
+        car_mng.release()
+        self.car_mngs.remove(car_mng)
+        self.pools.setdefault(type(car_mng), []).append(car_mng)
+
     def spawn_cars(self, n_cars=None, **kwargs):
         if n_cars is None:
             n_cars = self.target_n_cars - self.alive_cars_count
@@ -20,7 +148,7 @@ class Environment:
             kwargs['randomize'] = True
 
         for _ in range(n_cars):
-            self.car_mngs.append(CarManager(env=self, **kwargs))
+            self.add_car_mng(self.make_car_mng(CarManager, **kwargs))
         self.alive_cars_count += n_cars
         self.total_cars_count += n_cars
 
@@ -31,25 +159,238 @@ class Environment:
             kwargs['randomize'] = True
 
         for _ in range(n_cars):
-            self.car_mngs.append(SelfDrivingCarManager(env=self, **kwargs))
+            self.add_car_mng(self.make_car_mng(SelfDrivingCarManager, **kwargs))
         self.alive_cars_count += n_cars
         self.total_cars_count += n_cars
 
     def check_collisions(self):
-        cars = [car_mng.car for car_mng in self.car_mngs]
-        for i in range(len(cars)):
-            for j in range(i+1, len(cars)):
-                if check_collision(cars[i], cars[j]):
-                    if not cars[i].crashed and not cars[j].crashed:
-                        self.collision_count += 1
-                        print(f"{self.collision_count} collisions")
-                    cars[i].update_collision()
-                    cars[j].update_collision()
+        # pairs are visited by (lower id, higher id), whatever the order of car_mngs, so the collision count is
+        # canonical: which pair of an accident chain gets counted depends on the order they are visited in
+        car_mngs = sorted(self.car_mngs, key=lambda car_mng: car_mng.id)
+        cars = [car_mng.car for car_mng in car_mngs]
+        if self.broadphase == 'grid':
+            pairs = self.collision_grid.candidate_pairs(cars)
+        elif self.broadphase == 'sap':
+            pairs = self.sweep_and_prune.candidate_pairs(cars, [car_mng.id for car_mng in car_mngs])
+        else:
+            pairs = brute_force_pairs(len(cars))
+        self.resolve_collisions(cars, pairs)
+
+    def resolve_collisions(self, cars, pairs):
+        '''
+        Test the candidate pairs (i, j) of cars in order, crashing the cars that collide and counting the collisions.
+        '''
+        if self.narrow_phase == 'obb':
+            self.resolve_oriented_collisions(cars, pairs)
+            return
+        for i, j in pairs:
+            if check_collision(cars[i], cars[j]):
+                self.crash(cars[i], cars[j])
+
+    def resolve_oriented_collisions(self, cars, pairs):
+        '''
+        resolve_collisions() with the pairs tested as rotated boxes, all at once by oriented_box_collisions().
+        A car that crashes grows to its crash size in the middle of the pass, so the pairs it is part of further on are
+        tested again with its new size, to give the same results as testing the pairs one by one.
+        '''
+        pairs = np.array(list(pairs), dtype=int).reshape(-1, 2)
+        # pairs of cars both crashed already can't change the count, nor any car
+        crashed = np.array([car.crashed for car in cars], dtype=bool)
+        pairs = pairs[~(crashed[pairs[:, 0]] & crashed[pairs[:, 1]])]
+        if len(pairs) == 0:
+            return
+        centers = np.array([car.position.get() for car in cars])
+        angles = np.array([car.rotation_angle for car in cars])
+        sizes = np.array([car.size for car in cars], dtype=float)
+        colliding, _ = oriented_box_collisions(centers, angles, sizes, pairs)
+
+        # indices of the pairs of each car, in ascending order
+        order = np.argsort(pairs.ravel(), kind='stable')
+        bounds = np.searchsorted(pairs.ravel()[order], np.arange(len(cars) + 1))
+        hits = np.flatnonzero(colliding).tolist()
+        while hits:
+            index = heapq.heappop(hits)
+            if not colliding[index]:
+                continue
+            i, j = pairs[index].tolist()
+            grown = [k for k in (i, j) if not cars[k].crashed]
+            self.crash(cars[i], cars[j])
+            if not grown:
+                continue
+            sizes[grown] = [cars[k].size for k in grown]
+            later = np.concatenate([order[bounds[k]:bounds[k + 1]] // 2 for k in grown])
+            later = later[later > index]
+            was_colliding = colliding[later]
+            colliding[later] = oriented_box_collisions(centers, angles, sizes, pairs[later])[0]
+            for new_hit in later[colliding[later] & ~was_colliding].tolist():
+                heapq.heappush(hits, new_hit)
+
+    def crash(self, car_a, car_b):
+        if not car_a.crashed and not car_b.crashed:
+            self.collision_count += 1
+            print(f"{self.collision_count} collisions")
+        car_a.update_collision(self.frame)
+        car_b.update_collision(self.frame)
 
     def update_all(self):
         self.check_collisions()
+        self.profiler.mark('check_collisions')
         if len(self.car_mngs) > 0:
-            self.cars_kf_repr = [car_mng.update() for car_mng in self.car_mngs]
+            self.update_cars()
+            self.react_all()
+
+        # cars retired during the frame only leave now, so car_mngs never changes in the middle of a pass
+        self.remove_retired()
+
+    def update_cars(self):
+        '''
+        Retire the cars that are done, then step the physics, sensors and Kalman Filters of every car.
+        '''
+        for car_mng in self.car_mngs:
+            car_mng.check_retirement()
+
+        if self.world_state is not None:
+            self.world_state.step()
+        else:
+            for car_mng in self.car_mngs:
+                car_mng.car.update()
+        self.profiler.mark('physics')
+
+        # step every car's Kalman Filter in one batched call, rows ordered by bank slot
+        # cars join and leave the world state, sensor and filter banks together, so their rows line up
+        if self.world_state is not None:
+            n = self.world_state.size
+            true_positions = np.column_stack((self.world_state['x'][:n], self.world_state['y'][:n]))
+        else:
+            true_positions = np.array([car_mng.car.position.get() for car_mng in self.car_mngs])
+            true_positions = true_positions[np.argsort([car_mng.sensor.bank_row for car_mng in self.car_mngs])]
+        keys = None
+        if self.sensor_bank.counter_noise:
+            keys = np.empty(len(self.car_mngs), dtype=np.uint64)
+            for car_mng in self.car_mngs:
+                keys[car_mng.sensor.bank_row] = car_mng.id
+        position, velocity, accel = self.sensor_bank.measure(true_positions, keys=keys, frame=self.frame)
+        zt = CarSystemKF.get_states_from_measures(position, velocity, accel)
+        means, sigmas = self.kf_bank.step(np.zeros((1, 1)), zt)
+
+        # each manager keeps its own repr, so it stays with its car when remove_retired() reorders car_mngs
+        for car_mng in self.car_mngs:
+            slot = car_mng.kalman_filter.bank_slot
+            car_mng.kalman_filter.set_state(means[slot], sigmas[slot])
+            car_mng.kf_center, car_mng.kf_rect = car_mng.finish_update(means[slot], sigmas[slot])
+        self.profiler.mark('sensor_kf')
+
+    def react_all(self):
+        '''
+        Predict collisions from this frame's Kalman Filter means and let every car react to them.
+        '''
+        if self.collision_prediction == 'closest_approach':
+            self.predict_conflicts(self.kf_bank.means[:self.kf_bank.size])
+        elif self.broadphase != 'brute':
+            self.index_trajectories()
+        for car_mng in self.car_mngs:
+            car_mng.react()
+        self.profiler.mark('predict_collisions')
+
+    def index_trajectories(self):
+        '''
+        Index every car's predicted trajectory segment (current position to future position) for this frame.
+        '''
+        if self.trajectory_index is None:
+            self.trajectory_index = SegmentGrid()
+
+        items, segments = [], []
+        for car_mng in itertools.chain(self.car_mngs, self.ghosts):
+            future_position = getattr(car_mng, 'future_position', None)
+            if future_position is None:
+                continue
+            items.append(car_mng)
+            segments.append((car_mng.car.position.get(), future_position))
+
+        min_cell_size = max((max(car_mng.car.size) for car_mng in items), default=1)
+        self.trajectory_index.rebuild(items, segments, min_cell_size=min_cell_size)
+
+    def predict_conflicts(self, means):
+        '''
+        Set the earliest predicted conflict time of every self-driving car, from the Kalman Filter means of this frame.
+        '''
+        car_mngs = [car_mng for car_mng in self.car_mngs if isinstance(car_mng, SelfDrivingCarManager)]
+        if len(car_mngs) == 0:
+            return
+        trajectories = self.predict_trajectories(car_mngs, means)
+        radii = np.array([car_mng.conflict_distance for car_mng in car_mngs], dtype=float)
+        if self.ghosts:
+            ghost_means = np.stack([ghost.kf_mean for ghost in self.ghosts])
+            trajectories = np.concatenate((trajectories, self.conflict_predictor.trajectories(ghost_means)))
+            radii = np.concatenate((radii, [ghost.conflict_distance for ghost in self.ghosts]))
+        pairs = self.trajectory_pairs(trajectories, radii)
+        conflict_times = self.conflict_predictor.conflict_times(trajectories, pairs, radii)
+        for car_mng, conflict_time in zip(car_mngs, conflict_times):
+            car_mng.conflict_time = conflict_time if np.isfinite(conflict_time) else None
+
+    def predict_trajectories(self, car_mngs, means):
+        '''
+        (n, steps + 1, 2) sampled trajectories of self-driving car_mngs over the look-ahead window.
+        '''
+        if self.conflict_predictor is None:
+            predictor_kf = car_mngs[0].predictor_kf
+            A_step = CarSystemKF.get_model(predictor_kf.dt / self.prediction_steps, predictor_kf.measurement_noise)[0]
+            self.conflict_predictor = ClosestApproachPredictor(A_step, predictor_kf.dt, self.prediction_steps)
+        slots = np.array([car_mng.kalman_filter.bank_slot for car_mng in car_mngs])
+        return self.conflict_predictor.trajectories(means[slots])
+
+    def trajectory_pairs(self, trajectories, radii):
+        '''
+        Candidate pairs (i, j), i < j, of sampled trajectories that may come within conflict distance, as a (p, 2)
+        array.
+        '''
+        n = len(trajectories)
+        if self.broadphase == 'brute':
+            return np.column_stack(np.triu_indices(n, k=1))
+
+        if self.trajectory_index is None:
+            self.trajectory_index = SegmentGrid()
+        # the diagonal of a trajectory's bounding box has the same bounding box
+        lower, upper = trajectories.min(axis=1), trajectories.max(axis=1)
+        diagonals = [(tuple(low), tuple(high)) for low, high in zip(lower.tolist(), upper.tolist())]
+        margin = radii.max()
+        self.trajectory_index.rebuild(list(range(n)), diagonals, min_cell_size=margin)
+        pairs = [(i, j) for i, diagonal in enumerate(diagonals)
+                 for j in self.trajectory_index.query(diagonal, margin=margin) if j > i]
+        return np.array(pairs, dtype=int).reshape(-1, 2)
+
+    def step(self):
+        '''
+        Advance the simulation by one frame: spawn cars, report stats and update every car, as set by sim_config.
+        '''
+        self.frame += 1
+        self.profiler.begin_frame(self.frame)
+
+        if self.frame % self.sim_config['spawn_frame_interval'] == 0:
+            if self.sim_config['enable_collision_avoidance']:
+                self.spawn_self_driving_cars(measurement_noise=self.sim_config['measurement_noise'],
+                                             randomize=self.sim_config['randomize'])
+            else:
+                self.spawn_cars(measurement_noise=self.sim_config['measurement_noise'],
+                                randomize=self.sim_config['randomize'])
+
+        self.profiler.mark('spawn')
+
+        if self.frame % self.sim_config['report_frame_interval'] == 0:
+            self.get_report()
+            self.profiler.get_report()
+            self.profiler.mark('report')
+
+        self.update_all()
+
+        if self.recorder is not None:
+            self.recorder.record(self)
+            self.profiler.mark('record')
+
+    def close(self):
+        self.profiler.close()
+        if self.recorder is not None:
+            self.recorder.close()
 
     def get_report(self):
         print(f"cars alive: {self.alive_cars_count}\t total spawned cars: {self.total_cars_count}\t collisions: {self.collision_count}")
@@ -0,0 +1,64 @@
+class SlotTable:
+    '''
+    Unordered list of live objects with O(1) add and remove.
+    Items are kept dense, removing one moves the last item into its place, and each item gets a `handle`: a
+    (slot, generation) pair that stays valid while it is in the table. Slots are recycled, with their generation
+    bumped, so a handle kept after its item left the table never resolves to the item that took its slot.
+    '''
+    def __init__(self):
+        self.items = []
+        # item index of every slot, and slot of every item
+        self.slot_index = []
+        self.item_slot = []
+        self.generations = []
+        self.free_slots = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def __contains__(self, item):
+        return self.get(getattr(item, 'handle', None)) is item
+
+    def add(self, item):
+        if self.free_slots:
+            slot = self.free_slots.pop()
+        else:
+            slot = len(self.generations)
+            self.generations.append(0)
+            self.slot_index.append(None)
+        self.slot_index[slot] = len(self.items)
+        self.items.append(item)
+        self.item_slot.append(slot)
+        item.handle = (slot, self.generations[slot])
+
+    def remove(self, item):
+        slot, _ = item.handle
+        index = self.slot_index[slot]
+        last = len(self.items) - 1
+        if index != last:
+            self.items[index] = self.items[last]
+            self.item_slot[index] = self.item_slot[last]
+            self.slot_index[self.item_slot[index]] = index
+        self.items.pop()
+        self.item_slot.pop()
+        self.slot_index[slot] = None
+        self.generations[slot] += 1
+        self.free_slots.append(slot)
+        item.handle = None
+
+    def get(self, handle):
+        '''
+        The item of handle, or None if it left the table.
+        '''
+        if handle is None:
+            return None
+        slot, generation = handle
+        if self.generations[slot] != generation:
+            return None
+        return self.items[self.slot_index[slot]]
@@ -0,0 +1,77 @@
+import numpy as np
+
+# pairs evaluated per NumPy call, bounds the (pairs, steps, 2) temporaries
+PAIR_CHUNK_SIZE = 16384
+
+
+class ClosestApproachPredictor:
+    '''
+    Collision prediction over the Kalman Filter means of a whole fleet at once.
+    Each car's trajectory over the look-ahead window is sampled at `steps` equal sub-horizons, moving every mean by
+    cached powers of the model's A matrix for one sub-horizon, and taken as piecewise linear between the samples.
+    The first conflict is then solved in closed form on each piece, for every candidate pair.
+    '''
+    def __init__(self, A_step, look_ahead_time: float, steps: int = 10):
+        '''
+        :param A_step: state transition matrix over look_ahead_time / steps
+        '''
+        if steps < 1:
+            raise ValueError(f"steps must be at least 1, got {steps}")
+        self.look_ahead_time = look_ahead_time
+        self.steps = steps
+        self.step_time = look_ahead_time / steps
+        # A_step ** k for k = 0..steps, stacked as (steps + 1, d, d)
+        powers = [np.identity(len(A_step))]
+        for _ in range(steps):
+            powers.append(A_step @ powers[-1])
+        self.A_powers = np.stack(powers)
+        self.A_powers.setflags(write=False)
+
+    def trajectories(self, means, position_rows=(0, 3)):
+        '''
+        :param means: (n, d, 1) Kalman Filter means
+        :return: (n, steps + 1, 2) predicted positions at each sub-horizon, the first being the current one
+        '''
+        positions = self.A_powers[:, position_rows, :]
+        return np.einsum('kpd,nd->nkp', positions, means[:, :, 0])
+
+    def pieces(self, trajectories, pairs):
+        '''
+        Relative position of j seen from i at the start of each piece, and its change over the piece.
+        '''
+        relative = trajectories[pairs[:, 1]] - trajectories[pairs[:, 0]]
+        return relative[:, :-1], np.diff(relative, axis=1)
+
+    def conflict_times(self, trajectories, pairs, radii):
+        '''
+        Earliest time each car comes within its own radius of another car, inf if it never does in the window.
+        :param pairs: (p, 2) array of row indices
+        :param radii: (n,) distance below which a car considers itself in conflict
+        '''
+        conflict = np.full(len(trajectories), np.inf)
+        for start in range(0, len(pairs), PAIR_CHUNK_SIZE):
+            chunk = pairs[start:start + PAIR_CHUNK_SIZE]
+            d0, e = self.pieces(trajectories, chunk)
+            ee = np.einsum('pkc,pkc->pk', e, e)
+            de = np.einsum('pkc,pkc->pk', d0, e)
+            dd = np.einsum('pkc,pkc->pk', d0, d0)
+            # both cars of a pair may use a different radius
+            for side in (0, 1):
+                rows = chunk[:, side]
+                times = self.entry_times(ee, de, dd, radii[rows])
+                np.minimum.at(conflict, rows, times)
+        return conflict
+
+    def entry_times(self, ee, de, dd, radii):
+        '''
+        First time |d0 + s e| < radius, s in [0, 1], over the pieces of each pair; inf where it never happens.
+        '''
+        r2 = (radii * radii)[:, np.newaxis]
+        inside = dd < r2
+        discriminant = de * de - ee * (dd - r2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            s = (-de - np.sqrt(np.maximum(discriminant, 0))) / ee
+        enters = (ee > 0) & (discriminant >= 0) & (s >= 0) & (s <= 1)
+        s = np.where(inside, 0, np.where(enters, s, np.inf))
+        times = (np.arange(self.steps) + s) * self.step_time
+        return times.min(axis=1)
@@ -0,0 +1,81 @@
+import time
+import numpy as np
+from collections import deque
+
+
+class FrameProfiler:
+    '''
+    Times the phases of each frame and keeps rolling percentiles over the last `window` frames.
+    A frame starts with begin_frame(), and every mark(phase) charges the time since the previous mark to that phase.
+    When disabled, every method returns right away.
+    '''
+    def __init__(self, enabled=False, window=200, trace_file=None):
+        self.enabled = enabled
+        self.window = window
+        self.phases = dict()
+        self.frame = None
+        self.current = dict()
+        self.last_mark = None
+        self.trace = None
+        if enabled and trace_file:
+            self.trace = open(trace_file, 'w')
+            self.trace.write("frame,phase,ms\n")
+
+    @classmethod
+    def from_config(cls, config: dict):
+        if config is None:
+            return cls()
+        return cls(enabled=config['enabled'], window=config['window'], trace_file=config['trace_file'])
+
+    def begin_frame(self, frame):
+        if not self.enabled:
+            return
+        self.end_frame()
+        self.frame = frame
+        self.last_mark = time.perf_counter()
+
+    def mark(self, phase):
+        if not self.enabled or self.last_mark is None:
+            return
+        now = time.perf_counter()
+        self.current[phase] = self.current.get(phase, 0) + now - self.last_mark
+        self.last_mark = now
+
+    def skip(self):
+        '''
+        Restart the clock without charging the time since the last mark to any phase, e.g. time spent idle.
+        '''
+        if not self.enabled or self.last_mark is None:
+            return
+        self.last_mark = time.perf_counter()
+
+    def end_frame(self):
+        if not self.enabled or self.last_mark is None:
+            return
+        for phase, elapsed in self.current.items():
+            if phase not in self.phases:
+                self.phases[phase] = deque(maxlen=self.window)
+            self.phases[phase].append(elapsed)
+        if self.trace is not None:
+            self.write_trace()
+        self.current = dict()
+        self.last_mark = None
+
+    def write_trace(self):
+        # one CSV line per phase of every frame
+        for phase, elapsed in self.current.items():
+            self.trace.write(f"{self.frame},{phase},{elapsed * 1e3:.4f}\n")
+
+    def get_report(self):
+        if not self.enabled or len(self.phases) == 0:
+            return
+        print(f"frame phases over the last {self.window} frames (ms):")
+        for phase, times in self.phases.items():
+            p50, p95 = np.percentile(times, (50, 95)) * 1e3
+            print(f"\t{phase:<20} p50: {p50:8.3f}\t p95: {p95:8.3f}\t max: {max(times) * 1e3:8.3f}")
+
+    def close(self):
+        self.end_frame()
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
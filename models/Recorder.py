@@ -0,0 +1,177 @@
+import os
+import json
+import numpy as np
+
+from models.CarManager import Car
+from models.World import World
+
+# one row per car per frame. Vectors in kf state order: (x, vx, ax, y, vy, ay)
+RECORD_DTYPE = np.dtype([
+    ('frame', np.int64),
+    ('car_id', np.int64),
+    ('color', np.int8),
+    ('x', np.float64),
+    ('y', np.float64),
+    ('rotation_angle', np.float64),
+    ('crashed', np.bool_),
+    ('measured', np.float64, (6,)),
+    ('kf_mean', np.float64, (6,)),
+    ('kf_var', np.float64, (6,)),
+    ('future_position', np.float64, (2,)),
+    ('is_braking', np.bool_),
+])
+
+
+def fill_records(rows, env):
+    '''
+    Write the state of every car of env, in car_mngs order, to rows: a RECORD_DTYPE array of len(env.car_mngs) rows.
+    '''
+    car_mngs = env.car_mngs
+    if len(car_mngs) == 0:
+        return
+    rows['frame'] = env.frame
+    rows['car_id'] = [car_mng.id for car_mng in car_mngs]
+    rows['color'] = [Car.color_options.index(car_mng.car.color) for car_mng in car_mngs]
+    rows['x'] = [car_mng.car.position.x for car_mng in car_mngs]
+    rows['y'] = [car_mng.car.position.y for car_mng in car_mngs]
+    rows['rotation_angle'] = [car_mng.car.rotation_angle for car_mng in car_mngs]
+    rows['crashed'] = [car_mng.car.crashed for car_mng in car_mngs]
+    rows['measured'] = [car_mng.kalman_filter.get_state_from_measure(car_mng.sensor.get_last())[:, 0]
+                        for car_mng in car_mngs]
+    rows['kf_mean'] = [car_mng.kalman_filter.kf.last_mean[:, 0] for car_mng in car_mngs]
+    rows['kf_var'] = [np.diagonal(car_mng.kalman_filter.kf.last_sigma) for car_mng in car_mngs]
+    rows['future_position'] = [getattr(car_mng, 'future_position', None) or (np.nan, np.nan)
+                               for car_mng in car_mngs]
+    rows['is_braking'] = [car_mng.car.is_braking for car_mng in car_mngs]
+
+
+class Recorder:
+    '''
+    Streams per-frame car state into a directory of .npy chunks of RECORD_DTYPE rows, plus a meta.json index.
+    Rows are buffered and a chunk is written every chunk_size rows.
+    '''
+    def __init__(self, path: str, world=None, chunk_size: int = 65536, overwrite=False):
+        '''
+        :param overwrite: record over a recording already in path, refused otherwise
+        '''
+        if not overwrite and os.path.exists(os.path.join(path, 'meta.json')):
+            raise ValueError(f"{path} already holds a recording, set overwrite to record over it")
+        self.path = path
+        self.world = world
+        self.chunk_size = chunk_size
+        self.buffer = np.zeros(chunk_size, dtype=RECORD_DTYPE)
+        self.buffered = 0
+        self.chunks = []
+        os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config: dict, world=None):
+        if config is None or not config['path']:
+            return None
+        return cls(config['path'], world=world, chunk_size=config['chunk_size'], overwrite=config['overwrite'])
+
+    def record(self, env):
+        n = len(env.car_mngs)
+        if n == 0:
+            return
+        if self.buffered + n > self.chunk_size:
+            self.flush()
+        if n > self.chunk_size:
+            self.buffer = np.zeros(n, dtype=RECORD_DTYPE)
+            self.chunk_size = n
+
+        fill_records(self.buffer[self.buffered:self.buffered + n], env)
+        self.buffered += n
+
+    def flush(self):
+        if self.buffered == 0:
+            return
+        rows = self.buffer[:self.buffered]
+        name = f"chunk_{len(self.chunks):05d}.npy"
+        np.save(os.path.join(self.path, name), rows)
+        self.chunks.append({'file': name, 'rows': int(self.buffered),
+                            'first_frame': int(rows['frame'][0]), 'last_frame': int(rows['frame'][-1])})
+        self.buffered = 0
+        self.write_meta()
+
+    def write_meta(self):
+        meta = {'chunks': self.chunks}
+        if self.world is not None:
+            meta['world'] = {'window_size': list(self.world.window_size), 'scale': self.world.scale,
+                             'interval': self.world.interval}
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    def close(self):
+        self.flush()
+        self.write_meta()
+
+
+class Replay:
+    '''
+    Read-only access to a Recorder directory. Chunks are memory-mapped, so any frame range can be read without
+    loading the whole run.
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.chunks = [np.load(os.path.join(path, chunk['file']), mmap_mode='r') for chunk in self.meta['chunks']]
+
+    def world(self, config: dict):
+        '''
+        World the run was recorded in, the config's for recordings that don't have it.
+        '''
+        world = self.meta.get('world')
+        if world is None:
+            return World.from_config(config)
+        return World(window_size=tuple(world['window_size']), scale=world['scale'], interval=world['interval'])
+
+    @property
+    def first_frame(self):
+        return self.meta['chunks'][0]['first_frame'] if self.chunks else None
+
+    @property
+    def last_frame(self):
+        return self.meta['chunks'][-1]['last_frame'] if self.chunks else None
+
+    def rows(self, start=None, end=None):
+        '''
+        All rows with start <= frame <= end, as one structured array.
+        '''
+        start = self.first_frame if start is None else start
+        end = self.last_frame if end is None else end
+        parts = []
+        for info, chunk in zip(self.meta['chunks'], self.chunks):
+            if info['last_frame'] < start or info['first_frame'] > end:
+                continue
+            first = np.searchsorted(chunk['frame'], start, side='left')
+            last = np.searchsorted(chunk['frame'], end, side='right')
+            parts.append(chunk[first:last])
+        if len(parts) == 0:
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        return np.concatenate(parts)
+
+    def frames(self, start=None, end=None):
+        '''
+        Yields (frame, rows of that frame) over a frame range.
+        '''
+        rows = self.rows(start, end)
+        if len(rows) == 0:
+            return
+        boundaries = np.flatnonzero(np.diff(rows['frame'])) + 1
+        for frame_rows in np.split(rows, boundaries):
+            yield int(frame_rows['frame'][0]), frame_rows
+
+    def get_report(self, start=None, end=None):
+        rows = self.rows(start, end)
+        if len(rows) == 0:
+            print("No recorded frames in range")
+            return
+        position = np.stack((rows['x'], rows['y']), axis=1)
+        kf_error = rows['kf_mean'][:, [0, 3]] - position
+        measurement_error = rows['measured'][:, [0, 3]] - position
+        print(f"frames: {rows['frame'][0]}-{rows['frame'][-1]}\t rows: {len(rows)}\t "
+              f"cars: {len(np.unique(rows['car_id']))}\t braking: {rows['is_braking'].mean():.1%}")
+        print(f"position RMS error, measurement: {np.sqrt(np.mean(measurement_error ** 2)):.3f}\t "
+              f"kalman filter: {np.sqrt(np.mean(kf_error ** 2)):.3f}")
@@ -1,15 +1,209 @@
 import numpy as np
 from models.Basics import GameObject
 
+MASK_64 = (1 << 64) - 1
+
+
+def splitmix64(x):
+    '''
+    SplitMix64 finalizer over a uint64 array: a bijective mix where every input bit affects every output bit.
+    '''
+    # arithmetic is modulo 2 ** 64 by design
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def counter_normals(seed, keys, counter):
+    '''
+    Two standard normal numbers for each key, a function of (seed, key, counter) only: unlike draws from a Generator
+    they do not depend on how many keys are drawn for, nor in which order.
+    :param keys: (n,) non-negative integers, e.g. car ids
+    :return: (n, 2) array
+    '''
+    base = splitmix64(np.uint64((seed or 0) & MASK_64))
+    key = splitmix64(splitmix64(base ^ np.asarray(keys, dtype=np.uint64)) ^ np.uint64(counter & MASK_64))
+    # 53 random bits to a uniform in (0, 1], then Box-Muller
+    u1 = ((splitmix64(key ^ np.uint64(1)) >> np.uint64(11)) + 1) * 2.0 ** -53
+    u2 = (splitmix64(key ^ np.uint64(2)) >> np.uint64(11)) * 2.0 ** -53
+    radius = np.sqrt(-2 * np.log(u1))
+    return np.column_stack((radius * np.cos(2 * np.pi * u2), radius * np.sin(2 * np.pi * u2)))
+
+
+class SensorBank:
+    '''
+    Measures a whole fleet at once. The last three measurements of every sensor are kept in one (N, 3, 2) ring buffer
+    and the noise for all of them is drawn in a single call from a seeded Generator.
+    The live sensors always occupy the first `size` rows: removing one moves the last row into its place, and the
+    arrays only grow (doubling) when they are full.
+    '''
+    row_arrays = ('measurements', 'counts', 'noise', 'last_position', 'last_velocity', 'last_acceleration')
+
+    def __init__(self, capacity: int = 16, seed=None, counter_noise=False):
+        '''
+        :param counter_noise: draw the noise of each measurement from counter_normals(seed, key, frame) with keys
+            given to measure(), instead of the Generator: the noise of an object is then the same whatever the rows
+            it is measured with
+        '''
+        self.seed = seed
+        self.counter_noise = counter_noise
+        self.rng = np.random.default_rng(seed)
+        self.size = 0
+        # ring position of the newest measurement, shared by every row since all are measured together
+        self.head = 0
+        self.measurements = np.zeros((capacity, 3, 2))
+        self.counts = np.zeros(capacity, dtype=int)
+        self.noise = np.zeros(capacity)
+        self.last_position = np.zeros((capacity, 2))
+        self.last_velocity = np.zeros((capacity, 2))
+        self.last_acceleration = np.zeros((capacity, 2))
+        self.owners = [None] * capacity
+
+    @property
+    def capacity(self):
+        return len(self.owners)
+
+    def _grow(self):
+        capacity = 2 * self.capacity
+        for name in self.row_arrays:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+        self.owners.extend([None] * (capacity - len(self.owners)))
+
+    def add(self, owner):
+        '''
+        Add a sensor to the bank. The owner's `bank_row` attribute is kept pointing at its row.
+        '''
+        if self.size == self.capacity:
+            self._grow()
+        row = self.size
+        for name in self.row_arrays:
+            getattr(self, name)[row] = 0
+        self.noise[row] = owner.measurement_noise
+        self.owners[row] = owner
+        owner.bank_row = row
+        self.size += 1
+        return row
+
+    def remove(self, row):
+        last = self.size - 1
+        owner = self.owners[row]
+        if row != last:
+            for name in self.row_arrays:
+                array = getattr(self, name)
+                array[row] = array[last]
+            self.owners[row] = self.owners[last]
+            self.owners[row].bank_row = row
+        self.owners[last] = None
+        owner.bank_row = None
+        self.size = last
+
+    def get_row(self, row):
+        '''
+        State of a row, with its measurements from newest to oldest, to move it to another bank with set_row().
+        '''
+        state = {name: getattr(self, name)[row].copy() for name in self.row_arrays}
+        state['measurements'] = state['measurements'][(self.head - np.arange(3)) % 3]
+        return state
+
+    def set_row(self, row, state):
+        for name in self.row_arrays:
+            getattr(self, name)[row] = state[name]
+        self.measurements[row, (self.head - np.arange(3)) % 3] = state['measurements']
+
+    def measure(self, true_positions, keys=None, frame=0):
+        '''
+        Vectorized ObjectSensor.measure() over every live row.
+        :param true_positions: (size, 2) array of the measured objects' positions, in row order
+        :param keys: (size,) key of each row, in counter_noise mode
+        :param frame: counter of this measurement, in counter_noise mode
+        :return: position, velocity and acceleration, each as a (size, 2) array
+        '''
+        n = self.size
+        if self.counter_noise:
+            if keys is None:
+                raise ValueError("SensorBank in counter_noise mode needs the keys of the measured rows")
+            noise = counter_normals(self.seed, keys, frame)
+        else:
+            noise = self.rng.normal(size=(n, 2))
+        measured_position = true_positions + noise * self.noise[:n, np.newaxis]
+
+        self.head = (self.head + 1) % 3
+        self.measurements[:n, self.head] = measured_position
+        counts = np.minimum(self.counts[:n] + 1, 3)
+        self.counts[:n] = counts
+
+        # calculate velocity and acceleration, once there are enough measurements
+        previous_position = self.measurements[:n, self.head - 1]
+        last_velocity = self.last_velocity[:n]
+        velocity = np.where((counts >= 2)[:, np.newaxis], measured_position - previous_position, last_velocity)
+        accel = np.where((counts >= 3)[:, np.newaxis], velocity - last_velocity, self.last_acceleration[:n])
+
+        # update state
+        self.last_position[:n] = measured_position
+        self.last_velocity[:n] = velocity
+        self.last_acceleration[:n] = accel
+        return measured_position, velocity, accel
+
 
 class ObjectSensor:
     def __init__(self, obj: GameObject, measurement_noise: float):
         self.obj = obj
         self.measurement_noise = measurement_noise
         self.measurements = []
-        self.last_position = np.array([0, 0])
-        self.last_velocity = np.array([0, 0])
-        self.last_acceleration = np.array([0, 0])
+        self.bank: SensorBank = None
+        self.bank_row: int = None
+        self.reset()
+
+    # readings come from the SensorBank row while attached to one
+    @property
+    def last_position(self):
+        return self.bank.last_position[self.bank_row] if self.bank is not None else self.own_position
+
+    @last_position.setter
+    def last_position(self, value):
+        self.own_position = value
+
+    @property
+    def last_velocity(self):
+        return self.bank.last_velocity[self.bank_row] if self.bank is not None else self.own_velocity
+
+    @last_velocity.setter
+    def last_velocity(self, value):
+        self.own_velocity = value
+
+    @property
+    def last_acceleration(self):
+        return self.bank.last_acceleration[self.bank_row] if self.bank is not None else self.own_acceleration
+
+    @last_acceleration.setter
+    def last_acceleration(self, value):
+        self.own_acceleration = value
+
+    def reset(self):
+        self.measurements = []
+        self.own_position = np.array([0, 0])
+        self.own_velocity = np.array([0, 0])
+        self.own_acceleration = np.array([0, 0])
+
+    def attach(self, bank: SensorBank):
+        bank.add(self)
+        self.bank = bank
+
+    def detach(self):
+        '''
+        Leave the SensorBank, keeping the last readings.
+        '''
+        if self.bank is None:
+            return
+        readings = self.get_last()
+        self.bank.remove(self.bank_row)
+        self.bank = None
+        self.own_position, self.own_velocity, self.own_acceleration = (reading.copy() for reading in readings)
 
     def measure(self):
         noise = np.array([np.random.normal(0, self.measurement_noise),
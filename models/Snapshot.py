@@ -0,0 +1,57 @@
+import threading
+from dataclasses import dataclass
+import numpy as np
+
+from models.Recorder import RECORD_DTYPE, fill_records
+
+
+@dataclass(frozen=True)
+class FrameSnapshot:
+    '''
+    State of every car at the end of a frame, as read-only RECORD_DTYPE rows.
+    '''
+    frame: int
+    rows: np.ndarray
+
+
+class SnapshotBuffer:
+    '''
+    Triple buffer of FrameSnapshots between one writer (the simulation) and one reader (the renderer).
+    The writer fills the back buffer and swaps it with the middle one, the reader swaps the middle buffer with the front
+    one when a newer snapshot is there. Neither ever waits for the other beyond the swap, the reader always gets the
+    latest complete frame and the arrays are reused instead of allocated every frame.
+    '''
+    def __init__(self, capacity: int = 16):
+        self.lock = threading.Lock()
+        self.buffers = [np.zeros(capacity, dtype=RECORD_DTYPE) for _ in range(3)]
+        self.middle, self.front = None, None
+        self.back_index, self.middle_index, self.front_index = 0, 1, 2
+        self.fresh = False
+
+    def publish(self, env):
+        '''
+        Snapshot the cars of env. Writer side.
+        '''
+        n = len(env.car_mngs)
+        buffer = self.buffers[self.back_index]
+        if n > len(buffer):
+            buffer = self.buffers[self.back_index] = np.zeros(max(n, 2 * len(buffer)), dtype=RECORD_DTYPE)
+        fill_records(buffer[:n], env)
+        rows = buffer[:n].view()
+        rows.setflags(write=False)
+        with self.lock:
+            self.middle = FrameSnapshot(env.frame, rows)
+            self.middle_index, self.back_index = self.back_index, self.middle_index
+            self.fresh = True
+
+    def latest(self):
+        '''
+        The latest published snapshot, None before the first one. Reader side: the snapshot stays valid until the
+        next call.
+        '''
+        with self.lock:
+            if self.fresh:
+                self.front, self.middle = self.middle, self.front
+                self.front_index, self.middle_index = self.middle_index, self.front_index
+                self.fresh = False
+            return self.front
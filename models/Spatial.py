@@ -0,0 +1,251 @@
+import math
+import bisect
+import itertools
+from collections import defaultdict
+
+# Half of the 3x3 neighbourhood of a cell: visiting only these offsets finds every pair of neighbouring cells once
+HALF_NEIGHBOURHOOD = ((1, 0), (1, 1), (0, 1), (-1, 1))
+
+
+def half_extents(car, rotated=False):
+    '''
+    Half width and half height of a box around a car covering it both at its size and at the size it takes once
+    crashed, since that can change in the middle of a collision pass.
+    :param rotated: cover the car turned by its rotation_angle, as tested by oriented_box_collisions()
+    '''
+    if not rotated:
+        return max(car.size[0], car.crash_size[0]) / 2, max(car.size[1], car.crash_size[1]) / 2
+    # the length of a car points along its rotation angle, and its width across it
+    cos, sin = abs(math.cos(car.rotation_angle)), abs(math.sin(car.rotation_angle))
+    return (max((length * cos + width * sin) / 2 for width, length in (car.size, car.crash_size)),
+            max((length * sin + width * cos) / 2 for width, length in (car.size, car.crash_size)))
+
+
+def brute_force_pairs(n):
+    for i in range(n):
+        for j in range(i+1, n):
+            yield i, j
+
+
+class UniformGrid:
+    '''
+    Uniform grid over car centers, used as collision broadphase.
+    The cell size is the largest width or height of the boxes of half_extents() around the cars. Two overlapping cars
+    are then always in the same or in neighbouring cells.
+    The grid is rebuilt from scratch on every call.
+    '''
+    def __init__(self, rotated=False):
+        '''
+        :param rotated: size the cells for the cars turned by their rotation angles, as oriented_box_collisions()
+            tests them
+        '''
+        self.rotated = rotated
+        self.cell_size = None
+        self.cells = defaultdict(list)
+
+    def rebuild(self, cars):
+        self.cells.clear()
+        if len(cars) == 0:
+            return
+        self.cell_size = 2 * max(max(half_extents(car, self.rotated)) for car in cars)
+        for i, car in enumerate(cars):
+            self.cells[self.cell_of(car.position.x, car.position.y)].append(i)
+
+    def cell_of(self, x, y):
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    def candidate_pairs(self, cars):
+        '''
+        Pairs of indices (i, j), i < j, of cars that may be in collision, sorted as the brute force would visit them.
+        '''
+        self.rebuild(cars)
+        pairs = []
+        for (cx, cy), members in self.cells.items():
+            for a in range(len(members)):
+                for b in range(a+1, len(members)):
+                    pairs.append((members[a], members[b]))
+            for dx, dy in HALF_NEIGHBOURHOOD:
+                neighbours = self.cells.get((cx + dx, cy + dy))
+                if neighbours is None:
+                    continue
+                for i in members:
+                    for j in neighbours:
+                        pairs.append((i, j) if i < j else (j, i))
+        pairs.sort()
+        return pairs
+
+
+# kinds of box endpoints, a low end sorting before a high end of the same value so that touching boxes overlap
+LOW, HIGH = 0, 1
+
+
+class SweepAndPrune:
+    '''
+    Kinetic sweep-and-prune collision broadphase, keeping its state from one frame to the next.
+    Each car has a box around its center, of half_extents(). The ends of all boxes are kept sorted on x and on y, with
+    the set of pairs of boxes overlapping on both axes.
+    Every frame the ends move to the cars' new positions and are sorted again by insertion sort, which is close to
+    O(n) since cars only move a little. Each swap of a low end and a high end of two boxes is where they start or stop
+    overlapping on that axis, and updates the pair set. Boxes of new cars are then inserted at their place, pairing
+    them with the boxes found around it, and cars that are gone are taken out with their pairs.
+    '''
+    def __init__(self, rotated=False):
+        '''
+        :param rotated: size the boxes for the cars turned by their rotation angles, as oriented_box_collisions()
+            tests them
+        '''
+        self.rotated = rotated
+        # [low x, high x, low y, high y] of every box, by key
+        self.boxes = {}
+        # per axis, [value, key, kind] of every box end, in sorted order
+        self.ends = ([], [])
+        self.pairs = set()
+        self.partners = {}
+        # widest box seen on x, bounding how far before a box the low ends of the boxes overlapping it can be
+        self.max_width = 0
+
+    def candidate_pairs(self, cars, keys):
+        '''
+        Pairs of indices (i, j), i < j, of cars that may be in collision, sorted as the brute force would visit them.
+        :param keys: identity of each car from one frame to the next, e.g. the ids of their managers, in ascending order
+        '''
+        index = {key: i for i, key in enumerate(keys)}
+        gone = self.boxes.keys() - index.keys()
+        if gone:
+            self.remove(gone)
+
+        new_keys = []
+        for key, car in zip(keys, cars):
+            half_width, half_height = half_extents(car, self.rotated)
+            self.max_width = max(self.max_width, 2 * half_width)
+            x, y = car.position.get()
+            bounds = [x - half_width, x + half_width, y - half_height, y + half_height]
+            box = self.boxes.get(key)
+            if box is None:
+                self.boxes[key] = bounds
+                new_keys.append(key)
+            else:
+                box[:] = bounds
+
+        for axis in (0, 1):
+            for end in self.ends[axis]:
+                end[0] = self.boxes[end[1]][2 * axis + end[2]]
+            self.sort(axis)
+        for key in new_keys:
+            self.insert(key)
+
+        return sorted((index[a], index[b]) if index[a] < index[b] else (index[b], index[a]) for a, b in self.pairs)
+
+    def overlap(self, a, b):
+        box_a, box_b = self.boxes[a], self.boxes[b]
+        return box_a[0] <= box_b[1] and box_b[0] <= box_a[1] and box_a[2] <= box_b[3] and box_b[2] <= box_a[3]
+
+    def sort(self, axis):
+        ends = self.ends[axis]
+        for i in range(1, len(ends)):
+            end = ends[i]
+            value, key, kind = end
+            j = i - 1
+            while j >= 0:
+                other = ends[j]
+                if other[0] < value or (other[0] == value and other[2] <= kind):
+                    break
+                # end moves before other: the only changes of order between the ends of two boxes
+                if kind == LOW and other[2] == HIGH:
+                    if self.overlap(key, other[1]):
+                        self.add_pair(key, other[1])
+                elif kind == HIGH and other[2] == LOW:
+                    self.remove_pair(key, other[1])
+                ends[j + 1] = other
+                j -= 1
+            ends[j + 1] = end
+
+    def insert(self, key):
+        '''
+        Add the ends of the box of key at their place, and pair it with the boxes it overlaps.
+        '''
+        box = self.boxes[key]
+        self.partners[key] = set()
+        for axis in (0, 1):
+            for kind in (LOW, HIGH):
+                bisect.insort(self.ends[axis], [box[2 * axis + kind], key, kind], key=lambda end: (end[0], end[2]))
+
+        ends = self.ends[0]
+        start = bisect.bisect_left(ends, box[0] - self.max_width, key=lambda end: end[0])
+        for other in itertools.islice(ends, start, None):
+            if other[0] > box[1]:
+                break
+            if other[2] == LOW and other[1] != key and self.overlap(key, other[1]):
+                self.add_pair(key, other[1])
+
+    def add_pair(self, a, b):
+        self.pairs.add((a, b) if a < b else (b, a))
+        self.partners[a].add(b)
+        self.partners[b].add(a)
+
+    def remove_pair(self, a, b):
+        self.pairs.discard((a, b) if a < b else (b, a))
+        self.partners[a].discard(b)
+        self.partners[b].discard(a)
+
+    def remove(self, keys):
+        for key in keys:
+            for partner in list(self.partners[key]):
+                self.remove_pair(key, partner)
+            del self.partners[key]
+            del self.boxes[key]
+        self.ends = tuple([end for end in ends if end[1] not in keys] for ends in self.ends)
+
+
+def segment_bbox(segment, margin=0):
+    ((x1, y1), (x2, y2)) = segment
+    return min(x1, x2) - margin, min(y1, y2) - margin, max(x1, x2) + margin, max(y1, y2) + margin
+
+
+class SegmentGrid:
+    '''
+    Uniform grid over the bounding boxes of segments, e.g. predicted car trajectories.
+    Each segment is registered in every cell its bounding box touches. The cell size follows the average bounding box
+    extent, but is never smaller than min_cell_size.
+    '''
+    def __init__(self):
+        self.cell_size = None
+        self.cells = defaultdict(list)
+        self.items = []
+        self.bboxes = []
+
+    def rebuild(self, items, segments, min_cell_size=1):
+        self.cells.clear()
+        self.items = items
+        self.bboxes = [segment_bbox(segment) for segment in segments]
+        if len(items) == 0:
+            return
+
+        mean_extent = sum(max(x2 - x1, y2 - y1) for x1, y1, x2, y2 in self.bboxes) / len(self.bboxes)
+        self.cell_size = max(mean_extent, min_cell_size)
+        for index, bbox in enumerate(self.bboxes):
+            for cell in self.cells_of(bbox):
+                self.cells[cell].append(index)
+
+    def cells_of(self, bbox):
+        x1, y1, x2, y2 = bbox
+        for cx in range(math.floor(x1 / self.cell_size), math.floor(x2 / self.cell_size) + 1):
+            for cy in range(math.floor(y1 / self.cell_size), math.floor(y2 / self.cell_size) + 1):
+                yield cx, cy
+
+    def query(self, segment, margin=0):
+        '''
+        Items whose segment bounding box overlaps the bounding box of segment, grown by margin.
+        '''
+        if len(self.items) == 0:
+            return []
+        qx1, qy1, qx2, qy2 = segment_bbox(segment, margin)
+        found = set()
+        for cell in self.cells_of((qx1, qy1, qx2, qy2)):
+            for index in self.cells.get(cell, ()):
+                if index in found:
+                    continue
+                x1, y1, x2, y2 = self.bboxes[index]
+                if x1 <= qx2 and qx1 <= x2 and y1 <= qy2 and qy1 <= y2:
+                    found.add(index)
+        return [self.items[index] for index in sorted(found)]
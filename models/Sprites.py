@@ -0,0 +1,124 @@
+import math
+import pygame
+from collections import OrderedDict
+
+
+class RotationCache:
+    '''
+    Pre-rotated copies of one sprite, built lazily at a fixed angular resolution (degrees).
+    At most max_entries rotations are kept, the least recently used one is dropped first.
+    '''
+    def __init__(self, surface, resolution: float = 1, max_entries: int = 360):
+        '''
+        :param resolution: must divide 360, so that the last step wraps around to the first one
+        '''
+        steps = round(360 / resolution)
+        if steps == 0 or not math.isclose(steps * resolution, 360):
+            raise ValueError(f"Rotation resolution must divide 360 degrees: {resolution}")
+        self.surface = surface
+        self.resolution = resolution
+        self.steps = steps
+        self.max_entries = max_entries
+        self.rotations = OrderedDict()
+
+    def get(self, degrees: float):
+        step = round(degrees / self.resolution) % self.steps
+        rotated = self.rotations.get(step)
+        if rotated is not None:
+            self.rotations.move_to_end(step)
+            return rotated
+
+        rotated = pygame.transform.rotate(self.surface, step * self.resolution)
+        self.rotations[step] = rotated
+        if len(self.rotations) > self.max_entries:
+            self.rotations.popitem(last=False)
+        return rotated
+
+
+class AssetCache:
+    '''
+    Process-wide cache of the scaled sprite surfaces, keyed by (asset, scale).
+    Surfaces are loaded on first use, or up front with preload(), and shared by every car.
+    '''
+    # sprite size, in multiples of the scale
+    asset_sizes = {
+        'blue_car': (3, 5),
+        'green_car': (3, 5),
+        'pink_car': (3, 5),
+        'red_car': (3, 5),
+        'yellow_car': (3, 5),
+        'brake': (4, 4),
+        'crash': (8, 8),
+    }
+
+    def __init__(self, rotation_resolution: float = 1, rotation_cache_size: int = 360):
+        self.surfaces = {}
+        self.rotation_caches = {}
+        self.rotation_resolution = rotation_resolution
+        self.rotation_cache_size = rotation_cache_size
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, asset: str, scale):
+        key = (asset, scale)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.hits += 1
+            return surface
+
+        self.misses += 1
+        width, height = self.asset_sizes[asset]
+        surface = pygame.image.load(f"assets/{asset}.png").convert_alpha()
+        surface = pygame.transform.scale(surface, (width*scale, height*scale))
+        self.surfaces[key] = surface
+        return surface
+
+    def get_rotations(self, asset: str, scale) -> RotationCache:
+        key = (asset, scale)
+        rotation_cache = self.rotation_caches.get(key)
+        if rotation_cache is None:
+            rotation_cache = RotationCache(self.get(asset, scale), self.rotation_resolution, self.rotation_cache_size)
+            self.rotation_caches[key] = rotation_cache
+        return rotation_cache
+
+    def preload(self, scale, assets=None):
+        for asset in assets if assets is not None else self.asset_sizes:
+            if (asset, scale) not in self.surfaces:
+                self.get(asset, scale)
+
+    def get_report(self):
+        print(f"sprite cache: {len(self.surfaces)} surfaces\t hits: {self.hits}\t misses: {self.misses}")
+
+
+asset_cache = AssetCache()
+
+
+class CarSprite:
+    '''
+    Pygame rendering of a Car. Cars are pure math, the renderer attaches one of these to each car it draws.
+    '''
+    def __init__(self, color: str, scale=10):
+        self.img = asset_cache.get_rotations(f"{color}_car", scale)
+        self.brake_sprite = asset_cache.get('brake', scale)
+        self.crash_sprite = asset_cache.get_rotations('crash', scale)
+
+    def draw(self, surface, car):
+        return self.draw_at(surface, car.position.x, car.position.y, car.rotation_angle, car.size, car.crashed,
+                            car.is_braking)
+
+    def draw_at(self, surface, x, y, rotation_angle, size, crashed=False, is_braking=False):
+        '''
+        :return: the rects drawn on
+        '''
+        rotations = self.crash_sprite if crashed else self.img
+        rot_img = rotations.get(math.degrees(-rotation_angle - math.pi/2))
+        rects = [surface.blit(rot_img, rot_img.get_rect(center=(x, y)))]
+        if is_braking:
+            rects.append(self.draw_brake_symbol(surface, x, y, size))
+        return rects
+
+    def draw_brake_symbol(self, surface, x, y, size):
+        return surface.blit(self.brake_sprite, (
+            x - size[0] / 2,
+            y - size[1] / 2,
+        ))
@@ -0,0 +1,40 @@
+import numpy as np
+
+
+class StreamingCovariance:
+    '''
+    Online mean and covariance of d-dimensional samples, fed in batches and never stored.
+    Each batch is summarized by its count, mean and sum of squared deviations, and merged into the running ones with
+    the pairwise form of Welford's update (Chan et al.), which stays accurate over long streams.
+    '''
+    def __init__(self, dimension: int):
+        self.count = 0
+        self.mean = np.zeros(dimension)
+        self.m2 = np.zeros((dimension, dimension))
+
+    def add(self, samples):
+        '''
+        :param samples: (n, d) batch of samples
+        '''
+        samples = np.asarray(samples, dtype=float)
+        n = len(samples)
+        if n == 0:
+            return
+        batch_mean = samples.mean(axis=0)
+        deviations = samples - batch_mean
+        batch_m2 = deviations.T @ deviations
+
+        total = self.count + n
+        delta = batch_mean - self.mean
+        self.mean = self.mean + delta * (n / total)
+        self.m2 = self.m2 + batch_m2 + np.outer(delta, delta) * (self.count * n / total)
+        self.count = total
+
+    @property
+    def covariance(self):
+        '''
+        Unbiased sample covariance, as np.cov(samples, rowvar=False) would give.
+        '''
+        if self.count < 2:
+            raise ValueError(f"Covariance needs at least 2 samples, got {self.count}")
+        return self.m2 / (self.count - 1)
@@ -0,0 +1,83 @@
+import numpy as np
+import pygame
+
+
+class TrailBuffer:
+    '''
+    Ring buffer holding the last `length` points of one trail.
+    '''
+    def __init__(self, length: int):
+        self.points = np.zeros((length, 2))
+        self.head = 0
+        self.count = 0
+
+    def append(self, point):
+        self.points[self.head] = point
+        self.head = (self.head + 1) % len(self.points)
+        self.count = min(self.count + 1, len(self.points))
+
+    @property
+    def last(self):
+        return self.points[self.head - 1]
+
+    def ordered(self):
+        '''
+        Points from oldest to newest.
+        '''
+        if self.count < len(self.points):
+            return self.points[:self.count]
+        return np.concatenate((self.points[self.head:], self.points[:self.head]))
+
+
+class TrailLayer:
+    '''
+    Per-car trails drawn incrementally on a persistent transparent surface: each new point only draws the segment
+    joining it to the previous one. Every `length` frames the layer is redrawn from the ring buffers, which drops
+    points older than that and the trails of cars that are gone, so a trail shows between `length` and twice as many
+    points.
+    '''
+    def __init__(self, size, color, length: int = 200, width: int = 3):
+        self.surface = pygame.Surface(size, pygame.SRCALPHA)
+        self.color = color
+        self.length = length
+        self.width = width
+        self.buffers = dict()
+        self.frames_since_rebuild = 0
+
+    def update(self, points: dict):
+        '''
+        :param points: newest point of every live trail, by car id
+        :return: the rects of the layer that changed, or None if it was redrawn from scratch
+        '''
+        rects = []
+        for car_id, point in points.items():
+            buffer = self.buffers.get(car_id)
+            if buffer is None:
+                buffer = self.buffers[car_id] = TrailBuffer(self.length)
+            elif buffer.count > 0:
+                rects.append(pygame.draw.line(self.surface, self.color, buffer.last, point, self.width))
+            buffer.append(point)
+
+        self.frames_since_rebuild += 1
+        if self.frames_since_rebuild >= self.length:
+            self.rebuild(points.keys())
+            return None
+        return rects
+
+    def rebuild(self, live_ids):
+        self.buffers = {car_id: self.buffers[car_id] for car_id in live_ids if car_id in self.buffers}
+        self.surface.fill((0, 0, 0, 0))
+        for buffer in self.buffers.values():
+            if buffer.count > 1:
+                pygame.draw.lines(self.surface, self.color, False, buffer.ordered(), self.width)
+        self.frames_since_rebuild = 0
+
+    def draw(self, surface, areas=None):
+        '''
+        :param areas: only draw the layer inside these rects, all of it if None
+        '''
+        if areas is None:
+            surface.blit(self.surface, (0, 0))
+            return
+        for area in areas:
+            surface.blit(self.surface, area, area)
@@ -0,0 +1,17 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class World:
+    '''
+    Display-free description of the simulated space, shared by the Environment and everything it spawns.
+    '''
+    window_size: tuple = (1200, 800)
+    scale: float = 8
+    interval: float = 0.05
+
+    @classmethod
+    def from_config(cls, config: dict):
+        return cls(window_size=tuple(config['game']['windowSize']),
+                   scale=config['game']['scale'],
+                   interval=config['game']['interval'])
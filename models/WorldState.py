@@ -0,0 +1,190 @@
+import math
+import numpy as np
+
+
+class WorldState:
+    '''
+    Structure-of-arrays store for the physics state of many GameObjects.
+    Each object owns one row of the columns below. Live objects always occupy the first `size` rows: removing one moves
+    the last row into its place, and the columns only grow (doubling) when they are full.
+    '''
+    float_columns = ('x', 'y', 'vx', 'vy', 'speed', 'accel', 'rotation_angle', 'steering_angle', 'friction_coef')
+
+    def __init__(self, capacity: int = 16):
+        self.size = 0
+        self.columns = {name: np.zeros(capacity) for name in self.float_columns}
+        self.columns['reverse'] = np.zeros(capacity, dtype=bool)
+        self.owners = [None] * capacity
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    @property
+    def capacity(self):
+        return len(self.owners)
+
+    def _grow(self):
+        capacity = 2 * self.capacity
+        for name, old in self.columns.items():
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            self.columns[name] = new
+        self.owners.extend([None] * (capacity - len(self.owners)))
+
+    def add(self, owner):
+        '''
+        Reserve a row for owner. The owner's `row` attribute is kept pointing at it.
+        '''
+        if self.size == self.capacity:
+            self._grow()
+        row = self.size
+        for column in self.columns.values():
+            column[row] = 0
+        self.owners[row] = owner
+        owner.row = row
+        self.size += 1
+        return row
+
+    def remove(self, row):
+        last = self.size - 1
+        owner = self.owners[row]
+        if row != last:
+            for column in self.columns.values():
+                column[row] = column[last]
+            self.owners[row] = self.owners[last]
+            self.owners[row].row = row
+        self.owners[last] = None
+        owner.row = None
+        self.size = last
+
+    def step(self):
+        '''
+        Vectorized GameObject.update() over every live row.
+        '''
+        n = self.size
+        x, y, vx, vy = (self.columns[name][:n] for name in ('x', 'y', 'vx', 'vy'))
+        speed, accel = self.columns['speed'][:n], self.columns['accel'][:n]
+        rotation_angle, steering_angle = self.columns['rotation_angle'][:n], self.columns['steering_angle'][:n]
+        friction_coef, reverse = self.columns['friction_coef'][:n], self.columns['reverse'][:n]
+
+        x += vx
+        y += vy
+        speed[:] = np.sqrt(vx * vx + vy * vy) * np.where(reverse, -1, 1)
+        speed += accel
+        speed *= 1 - friction_coef
+        vx[:] = speed * np.cos(rotation_angle)
+        vy[:] = speed * np.sin(rotation_angle)
+        rotation_angle += steering_angle * speed
+        accel *= 0.9
+        steering_angle *= 0.7
+
+
+class StateVector2:
+    '''
+    Vector2 look-alike reading and writing two WorldState columns of its owner's row.
+    '''
+    def __init__(self, owner, x_column, y_column):
+        self.owner = owner
+        self.x_column = x_column
+        self.y_column = y_column
+
+    @property
+    def x(self):
+        return float(self.owner.state[self.x_column][self.owner.row])
+
+    @x.setter
+    def x(self, value):
+        self.owner.state[self.x_column][self.owner.row] = value
+
+    @property
+    def y(self):
+        return float(self.owner.state[self.y_column][self.owner.row])
+
+    @y.setter
+    def y(self, value):
+        self.owner.state[self.y_column][self.owner.row] = value
+
+    def __repr__(self):
+        return f"StateVector2(x={self.x}, y={self.y})"
+
+    def __eq__(self, other):
+        return self.get() == (other.x, other.y)
+
+    def get(self):
+        return self.x, self.y
+
+    @property
+    def abs(self):
+        return math.sqrt(self.x * self.x + self.y * self.y)
+
+
+def state_column(name, cast=float):
+    def getter(self):
+        return cast(self.state[name][self.row])
+
+    def setter(self, value):
+        self.state[name][self.row] = value
+
+    return property(getter, setter)
+
+
+class StateBacked:
+    '''
+    Mixin for GameObject subclasses that keeps the physics fields in a WorldState row instead of on the instance.
+    Instances take the WorldState as first argument, and must be released when they leave the simulation.
+    '''
+    speed = state_column('speed')
+    accel = state_column('accel')
+    rotation_angle = state_column('rotation_angle')
+    steering_angle = state_column('steering_angle')
+    friction_coef = state_column('friction_coef')
+    reverse = state_column('reverse', cast=bool)
+
+    def __init__(self, state: WorldState, *args, **kwargs):
+        self.state = state
+        self.row = None
+        self.released = False
+        self._position = StateVector2(self, 'x', 'y')
+        self._velocity = StateVector2(self, 'vx', 'vy')
+        state.add(self)
+        super().__init__(*args, **kwargs)
+
+    @property
+    def position(self):
+        return self._position
+
+    @position.setter
+    def position(self, value):
+        self.state['x'][self.row], self.state['y'][self.row] = value.x, value.y
+
+    @property
+    def velocity(self):
+        return self._velocity
+
+    @velocity.setter
+    def velocity(self, value):
+        self.state['vx'][self.row], self.state['vy'][self.row] = value.x, value.y
+
+    def acquire(self, state: WorldState):
+        '''
+        Join state again after release(), e.g. when a retired car is reused. The values start at zero.
+        '''
+        if not self.released:
+            return
+        self.released = False
+        self.state = state
+        state.add(self)
+
+    def release(self):
+        '''
+        Leave the shared WorldState, keeping the current values in a private one-row store.
+        '''
+        if self.released:
+            return
+        self.released = True
+        values = {name: column[self.row] for name, column in self.state.columns.items()}
+        self.state.remove(self.row)
+        self.state = WorldState(capacity=1)
+        self.state.add(self)
+        for name, value in values.items():
+            self.state[name][self.row] = value
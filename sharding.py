@@ -0,0 +1,489 @@
+'''
+Sharded headless simulation: the world is split in a grid of tiles, each stepped by its own worker process that holds
+the physics, sensors and Kalman Filters of the cars inside it.
+Shards publish their cars to one table in shared memory, which the others read the cars near their tile from (the
+"halo"). A frame runs in three phases, each shard working in parallel and the coordinator in between:
+- collide: each shard lists the pairs of cars, at least one of them its own, close enough to collide. The coordinator
+  tests them in (lower id, higher id) order, as a single Environment would, and tells the shards which cars crashed
+- update: retirement, physics, sensors and Kalman Filters of every car, then each shard publishes its cars
+- react: collision predictions, with the halo's self-driving cars as ghosts, then cars that left their shard's tile
+  migrate to their new one
+Spawn positions are drawn by the coordinator and the sensor noise of a car only depends on the seed, its id and the
+frame (sim.sensor_noise: counter), so a sharded run gives the same collisions and reports as a single process.
+'''
+import time
+import random
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+from models.Basics import GameObject, Vector2
+from models.CarManager import Car, CarManager, SelfDrivingCarManager
+from models.Environment import Environment
+
+TABLE_COLUMNS = ('id', 'x', 'y', 'rotation_angle', 'width', 'height', 'scale', 'crashed', 'retired', 'self_driving',
+                 'future_x', 'future_y', 'conflict_distance', 'low_x', 'low_y', 'high_x', 'high_y',
+                 'mean_0', 'mean_1', 'mean_2', 'mean_3', 'mean_4', 'mean_5')
+COLUMN = {name: index for index, name in enumerate(TABLE_COLUMNS)}
+MEAN = slice(COLUMN['mean_0'], COLUMN['mean_5'] + 1)
+# pairs of cars further apart than their crash sizes (their diagonals, when tested rotated), plus this, can't collide
+COLLISION_TOLERANCE = 1e-6
+
+
+class Tiling:
+    '''
+    Grid of columns x rows equal tiles over the window. The tiles on the border extend to infinity outwards, so that
+    every position has a tile.
+    '''
+    def __init__(self, window_size, columns: int, rows: int):
+        if columns < 1 or rows < 1:
+            raise ValueError(f"Tiling needs at least one column and one row, got {columns} x {rows}")
+        self.columns = columns
+        self.rows = rows
+        self.x_edges = np.arange(1, columns) * window_size[0] / columns
+        self.y_edges = np.arange(1, rows) * window_size[1] / rows
+
+    def __len__(self):
+        return self.columns * self.rows
+
+    def tile_of(self, x, y):
+        return int(np.searchsorted(self.x_edges, x, side='right') +
+                   self.columns * np.searchsorted(self.y_edges, y, side='right'))
+
+    def bounds(self, tile):
+        '''
+        :return: (low_x, low_y), (high_x, high_y) of tile
+        '''
+        column, row = tile % self.columns, tile // self.columns
+        x_edges = np.concatenate(([-np.inf], self.x_edges, [np.inf]))
+        y_edges = np.concatenate(([-np.inf], self.y_edges, [np.inf]))
+        return (x_edges[column], y_edges[row]), (x_edges[column + 1], y_edges[row + 1])
+
+
+def close_pairs(points, reach):
+    '''
+    Index pairs (i, j), i < j, of the points within reach of each other on both axes, as a (p, 2) array.
+    Points are hashed into cells of size reach, and each cell is matched against itself and half of its neighbours.
+    '''
+    n = len(points)
+    if n < 2:
+        return np.empty((0, 2), dtype=int)
+    cells = np.floor(points / reach).astype(np.int64)
+    cell_y = cells[:, 1] - cells[:, 1].min() + 1
+    stride = int(cell_y.max()) + 2
+    keys = cells[:, 0] * stride + cell_y
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    pairs = []
+    for dx, dy in ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1)):
+        target = keys + dx * stride + dy
+        start = np.searchsorted(sorted_keys, target, side='left')
+        counts = np.searchsorted(sorted_keys, target, side='right') - start
+        total = counts.sum()
+        if total == 0:
+            continue
+        first = np.cumsum(counts) - counts
+        i = np.repeat(np.arange(n), counts)
+        j = order[np.arange(total) - np.repeat(first - start, counts)]
+        keep = i < j if (dx, dy) == (0, 0) else np.ones(total, dtype=bool)
+        pairs.append(np.column_stack((i[keep], j[keep])))
+    if not pairs:
+        return np.empty((0, 2), dtype=int)
+    pairs = np.concatenate(pairs)
+    distance = np.abs(points[pairs[:, 0]] - points[pairs[:, 1]])
+    pairs = pairs[np.all(distance <= reach, axis=1)]
+    return np.sort(pairs, axis=1)
+
+
+def table_car(row):
+    '''
+    Footprint of a published car: a Car with its position, rotation, size and crash state, for collision tests.
+    '''
+    car = Car(Vector2(row[COLUMN['x']], row[COLUMN['y']]), Vector2(0, 0), rotation_angle=row[COLUMN['rotation_angle']],
+              scale=row[COLUMN['scale']], color=Car.color_options[0])
+    car.size = (row[COLUMN['width']], row[COLUMN['height']])
+    car.crashed = bool(row[COLUMN['crashed']])
+    return car
+
+
+class Ghost:
+    '''
+    A self-driving car of another shard, as published in the table: what the collision predictions of the cars of
+    this shard read from their neighbours.
+    '''
+    def __init__(self, row):
+        self.id = int(row[COLUMN['id']])
+        self.car = table_car(row)
+        self.future_position = (row[COLUMN['future_x']], row[COLUMN['future_y']])
+        self.kf_mean = row[MEAN, np.newaxis].copy()
+        self.conflict_distance = row[COLUMN['conflict_distance']]
+
+
+def export_car(env: Environment, car_mng: CarManager):
+    '''
+    Everything import_car() needs to rebuild car_mng in another shard's Environment.
+    '''
+    car = car_mng.car
+    kwargs = {'interval': car_mng.kalman_filter.dt, 'measurement_noise': car_mng.sensor.measurement_noise}
+    if isinstance(car_mng, SelfDrivingCarManager):
+        kwargs['look_ahead_time'] = car_mng.predictor_kf.dt
+    return {
+        'class': type(car_mng),
+        'id': car_mng.id,
+        'kwargs': kwargs,
+        'spawn': (Vector2(*car.position.get()), Vector2(*car.velocity.get()), car.accel, car.steering_angle,
+                  car.color),
+        'physics': {name: getattr(car, name) for name in ('speed', 'rotation_angle', 'friction_coef', 'reverse')},
+        'crash': (car.crashed, car.crashed_frame, car.size, car.is_braking),
+        'sensor': env.sensor_bank.get_row(car_mng.sensor.bank_row),
+        'kf': env.kf_bank.get_row(car_mng.kalman_filter.bank_slot),
+        'future_position': getattr(car_mng, 'future_position', None),
+    }
+
+
+def import_car(env: Environment, record):
+    car_mng = env.make_car_mng(record['class'], spawn=record['spawn'], **record['kwargs'])
+    env.add_car_mng(car_mng, car_id=record['id'])
+    car = car_mng.car
+    for name, value in record['physics'].items():
+        setattr(car, name, value)
+    car.crashed, car.crashed_frame, car.size, car.is_braking = record['crash']
+
+    env.sensor_bank.set_row(car_mng.sensor.bank_row, record['sensor'])
+    kf_state = record['kf']
+    env.kf_bank.set_row(car_mng.kalman_filter.bank_slot, kf_state)
+    car_mng.kalman_filter.started = bool(kf_state['started'])
+    car_mng.kalman_filter.set_state(kf_state['means'], kf_state['sigmas'])
+    if isinstance(car_mng, SelfDrivingCarManager):
+        car_mng.future_position = record['future_position']
+    return car_mng
+
+
+class Shard:
+    '''
+    The cars of one tile, stepped by an Environment of their own. Its methods are the phases of a frame, called by
+    the coordinator through run_shard().
+    '''
+    def __init__(self, config: dict, seed, tile: int, tiling: Tiling, table: np.ndarray):
+        self.env = Environment.from_config(config, seed=seed)
+        self.tile = tile
+        self.tiling = tiling
+        self.table = table
+        # rows of this shard's cars in the table, as of the last publish()
+        self.published = slice(0, 0)
+        reach = np.array(Car.size_for(self.env.world.scale, crashed=True))
+        if self.env.narrow_phase == 'obb':
+            reach = np.full(2, np.hypot(*reach))
+        self.reach = reach + COLLISION_TOLERANCE
+
+    def own_rows(self, size):
+        '''
+        Mask of the table rows of this shard's cars.
+        '''
+        own_ids = np.array([car_mng.id for car_mng in self.env.car_mngs], dtype=float)
+        return np.isin(self.table[:size, COLUMN['id']], own_ids)
+
+    def collide(self, frame, immigrants, spawns, size):
+        '''
+        Take in the cars that moved or spawned into the tile, and list the pairs that may collide this frame.
+        :param immigrants: records from export_car()
+        :param spawns: (id, class, kwargs) of the cars spawned in the tile, already in the table
+        :param size: rows of the table in use
+        :return: (p, 2) array of (lower id, higher id) pairs, and the number of cars of the shard
+        '''
+        env = self.env
+        env.frame = frame
+        for record in immigrants:
+            import_car(env, record)
+        for car_id, cls, kwargs in spawns:
+            env.add_car_mng(env.make_car_mng(cls, **kwargs), car_id=car_id)
+
+        n = len(env.car_mngs)
+        if n == 0:
+            return np.empty((0, 2), dtype=int), 0
+        ids = np.array([car_mng.id for car_mng in env.car_mngs])
+        points = np.array([car_mng.car.position.get() for car_mng in env.car_mngs])
+
+        # cars of the other shards within collision reach of the tile, the retired ones are gone since
+        rows = self.table[:size]
+        (low_x, low_y), (high_x, high_y) = self.tiling.bounds(self.tile)
+        halo = ~self.own_rows(size) & (rows[:, COLUMN['retired']] == 0) & \
+            (rows[:, COLUMN['x']] >= low_x - self.reach[0]) & (rows[:, COLUMN['x']] <= high_x + self.reach[0]) & \
+            (rows[:, COLUMN['y']] >= low_y - self.reach[1]) & (rows[:, COLUMN['y']] <= high_y + self.reach[1])
+        ids = np.concatenate((ids, rows[halo, COLUMN['id']].astype(int)))
+        points = np.concatenate((points, rows[halo][:, [COLUMN['x'], COLUMN['y']]]))
+
+        pairs = close_pairs(points, self.reach)
+        # pairs of two halo cars are left to their own shards
+        pairs = pairs[pairs[:, 0] < n]
+        return np.sort(ids[pairs], axis=1), n
+
+    def update(self, crashed_ids, offset):
+        '''
+        Crash the cars the coordinator found in collision, step every car and publish them at row offset.
+        :return: number of cars retired, and of those that left the window
+        '''
+        env = self.env
+        crashed_ids = set(crashed_ids)
+        left_window_count = env.left_window_count
+        for car_mng in env.car_mngs:
+            if car_mng.id in crashed_ids:
+                car_mng.car.update_collision(env.frame)
+        if len(env.car_mngs) > 0:
+            env.update_cars()
+        self.publish(offset)
+        return len(env.retired), env.left_window_count - left_window_count
+
+    def publish(self, offset):
+        env = self.env
+        car_mngs = list(env.car_mngs)
+        self.published = slice(offset, offset + len(car_mngs))
+        rows = self.table[self.published]
+        rows[:] = np.nan
+        if len(car_mngs) == 0:
+            return
+        rows[:, COLUMN['id']] = [car_mng.id for car_mng in car_mngs]
+        rows[:, [COLUMN['x'], COLUMN['y']]] = [car_mng.car.position.get() for car_mng in car_mngs]
+        rows[:, COLUMN['rotation_angle']] = [car_mng.car.rotation_angle for car_mng in car_mngs]
+        rows[:, [COLUMN['width'], COLUMN['height']]] = [car_mng.car.size for car_mng in car_mngs]
+        rows[:, COLUMN['scale']] = [car_mng.car.scale for car_mng in car_mngs]
+        rows[:, COLUMN['crashed']] = [car_mng.car.crashed for car_mng in car_mngs]
+        rows[:, COLUMN['retired']] = [car_mng.retired for car_mng in car_mngs]
+        slots = [car_mng.kalman_filter.bank_slot for car_mng in car_mngs]
+        rows[:, MEAN] = env.kf_bank.means[slots, :, 0]
+
+        self_driving = np.array([isinstance(car_mng, SelfDrivingCarManager) for car_mng in car_mngs])
+        rows[:, COLUMN['self_driving']] = self_driving
+        driving_mngs = [car_mng for car_mng in car_mngs if isinstance(car_mng, SelfDrivingCarManager)]
+        if not driving_mngs:
+            return
+        driving_rows = rows[self_driving]
+        driving_rows[:, [COLUMN['future_x'], COLUMN['future_y']]] = [car_mng.future_position
+                                                                     for car_mng in driving_mngs]
+        driving_rows[:, COLUMN['conflict_distance']] = [car_mng.conflict_distance for car_mng in driving_mngs]
+        # bounding box of the predicted path, that the predictions of the neighbours select ghosts by
+        if env.collision_prediction == 'closest_approach':
+            trajectories = env.predict_trajectories(driving_mngs, env.kf_bank.means)
+            low, high = trajectories.min(axis=1), trajectories.max(axis=1)
+        else:
+            ends = driving_rows[:, [[COLUMN['x'], COLUMN['y']], [COLUMN['future_x'], COLUMN['future_y']]]]
+            low, high = ends.min(axis=1), ends.max(axis=1)
+        driving_rows[:, [COLUMN['low_x'], COLUMN['low_y']]] = low
+        driving_rows[:, [COLUMN['high_x'], COLUMN['high_y']]] = high
+        rows[self_driving] = driving_rows
+
+    def ghosts(self, size):
+        '''
+        Self-driving cars of the other shards whose predicted paths come within conflict distance of the predicted
+        paths of this shard's self-driving cars.
+        '''
+        own = self.table[self.published]
+        own = own[own[:, COLUMN['self_driving']] == 1]
+        if len(own) == 0:
+            return []
+        margin = own[:, COLUMN['conflict_distance']].max()
+        low = own[:, [COLUMN['low_x'], COLUMN['low_y']]].min(axis=0) - margin
+        high = own[:, [COLUMN['high_x'], COLUMN['high_y']]].max(axis=0) + margin
+
+        rows = self.table[:size]
+        near = ~self.own_rows(size) & (rows[:, COLUMN['self_driving']] == 1) & \
+            np.all(rows[:, [COLUMN['high_x'], COLUMN['high_y']]] >= low, axis=1) & \
+            np.all(rows[:, [COLUMN['low_x'], COLUMN['low_y']]] <= high, axis=1)
+        return [Ghost(row) for row in rows[near]]
+
+    def react(self, size):
+        '''
+        Collision predictions and reactions of every car, then hand over the cars that left the tile.
+        :return: (tile, record) of each car leaving the shard
+        '''
+        env = self.env
+        if len(env.car_mngs) > 0:
+            env.ghosts = self.ghosts(size)
+            env.react_all()
+            env.ghosts = []
+        env.remove_retired()
+
+        emigrants = []
+        for car_mng in list(env.car_mngs):
+            tile = self.tiling.tile_of(*car_mng.car.position.get())
+            if tile != self.tile:
+                emigrants.append((tile, export_car(env, car_mng)))
+                env.remove_car_mng(car_mng)
+        return emigrants
+
+
+def run_shard(connection, config: dict, seed, tile: int, tiling: Tiling, table_name: str, capacity: int):
+    '''
+    Worker process of a shard: runs the commands sent by the coordinator until told to close.
+    '''
+    shared = shared_memory.SharedMemory(name=table_name)
+    table = np.ndarray((capacity, len(TABLE_COLUMNS)), buffer=shared.buf)
+    shard = Shard(config, seed, tile, tiling, table)
+    while True:
+        command, *args = connection.recv()
+        if command == 'close':
+            break
+        connection.send(getattr(shard, command)(*args))
+    del table, shard
+    shared.close()
+
+
+class ShardedSimulation:
+    '''
+    Coordinator of the shards: spawns cars, resolves collisions and keeps the stats, in an Environment without cars
+    of its own.
+    '''
+    def __init__(self, config: dict, seed=None):
+        sim_config = config['sim']
+        if sim_config['sensor_noise'] != 'counter':
+            raise ValueError("Sharding needs sim.sensor_noise: counter, the noise of a car must not depend on its shard")
+        if config.get('recorder') and config['recorder']['path']:
+            raise ValueError("Sharded runs can't be recorded")
+        self.env = Environment.from_config(config, seed=seed)
+        self.sim_config = sim_config
+        self.tiling = Tiling(self.env.world.window_size, *config['sharding']['tiles'])
+
+        # at most target_n_cars are alive, and as many can be spawned in a frame
+        self.capacity = 2 * sim_config['target_n_cars'] + 16
+        self.shared = shared_memory.SharedMemory(create=True, size=self.capacity * len(TABLE_COLUMNS) * 8)
+        self.table = np.ndarray((self.capacity, len(TABLE_COLUMNS)), buffer=self.shared.buf)
+        # rows in use, and cars waiting to enter each shard next frame
+        self.size = 0
+        self.immigrants = [[] for _ in range(len(self.tiling))]
+
+        self.connections, self.workers = [], []
+        for tile in range(len(self.tiling)):
+            connection, worker_connection = multiprocessing.Pipe()
+            # the coordinator profiles the phases of each frame, shards don't
+            worker = multiprocessing.Process(target=run_shard, daemon=True,
+                                             args=(worker_connection, {**config, 'profiler': None}, seed, tile,
+                                                   self.tiling, self.shared.name, self.capacity))
+            worker.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    def command(self, name, *args_per_shard):
+        '''
+        Run a phase on every shard in parallel, one argument tuple per shard.
+        :return: the replies, by shard
+        '''
+        for connection, args in zip(self.connections, args_per_shard):
+            connection.send((name, *args))
+        return [connection.recv() for connection in self.connections]
+
+    def spawn(self):
+        '''
+        Draw the cars to spawn this frame, in id order as Environment.step() does, and add them to the table.
+        :return: (id, class, kwargs) of the spawned cars, by shard
+        '''
+        env, sim_config = self.env, self.sim_config
+        spawns = [[] for _ in range(len(self.tiling))]
+        n_cars = env.target_n_cars - env.alive_cars_count
+        if env.frame % sim_config['spawn_frame_interval'] != 0 or n_cars <= 0:
+            return spawns
+        if self.size + n_cars > self.capacity:
+            raise ValueError(f"Shared car table full: {self.size + n_cars} rows needed, {self.capacity} available")
+
+        cls = SelfDrivingCarManager if sim_config['enable_collision_avoidance'] else CarManager
+        width, height = Car.size_for(env.world.scale)
+        rows = self.table[self.size:self.size + n_cars]
+        rows[:] = np.nan
+        for row, _ in zip(rows, range(n_cars)):
+            spawn = CarManager.draw_spawn(env.world, sim_config['randomize'])
+            position = spawn[0]
+            car_id = env.next_car_id
+            env.next_car_id += 1
+            kwargs = {'spawn': spawn, 'measurement_noise': sim_config['measurement_noise']}
+            spawns[self.tiling.tile_of(position.x, position.y)].append((car_id, cls, kwargs))
+            # cars spawn with the default rotation angle
+            row[[COLUMN['id'], COLUMN['x'], COLUMN['y'], COLUMN['rotation_angle'], COLUMN['width'], COLUMN['height'],
+                 COLUMN['scale'], COLUMN['crashed'], COLUMN['retired']]] = (car_id, position.x, position.y,
+                                                                            GameObject.rotation_angle, width, height,
+                                                                            env.world.scale, 0, 0)
+        self.size += n_cars
+        env.alive_cars_count += n_cars
+        env.total_cars_count += n_cars
+        return spawns
+
+    def resolve_collisions(self, pairs):
+        '''
+        Test the candidate pairs of car ids in order, as Environment.check_collisions() would.
+        :return: ids of the cars crashed by this pass
+        '''
+        if len(pairs) == 0:
+            return []
+        car_ids = np.unique(pairs)
+        table_ids = self.table[:self.size, COLUMN['id']]
+        order = np.argsort(table_ids)
+        rows = order[np.searchsorted(table_ids, car_ids, sorter=order)]
+        cars = [table_car(row) for row in self.table[rows]]
+        crashed = [car.crashed for car in cars]
+        self.env.resolve_collisions(cars, np.searchsorted(car_ids, pairs).tolist())
+        return [int(car_id) for car_id, car, was_crashed in zip(car_ids, cars, crashed)
+                if car.crashed and not was_crashed]
+
+    def step(self):
+        env = self.env
+        env.frame += 1
+        env.profiler.begin_frame(env.frame)
+        spawns = self.spawn()
+        env.profiler.mark('spawn')
+        if env.frame % self.sim_config['report_frame_interval'] == 0:
+            env.get_report()
+            env.profiler.get_report()
+            env.profiler.mark('report')
+
+        replies = self.command('collide', *((env.frame, self.immigrants[tile], spawns[tile], self.size)
+                                            for tile in range(len(self.tiling))))
+        self.immigrants = [[] for _ in range(len(self.tiling))]
+        # sorted and without the pairs found by both shards of a boundary
+        pairs = np.unique(np.concatenate([pairs for pairs, _ in replies]), axis=0)
+        crashed_ids = self.resolve_collisions(pairs)
+        env.profiler.mark('check_collisions')
+
+        counts = [count for _, count in replies]
+        offsets = np.cumsum([0] + counts[:-1]).tolist()
+        replies = self.command('update', *((crashed_ids, offset) for offset in offsets))
+        for retired_count, left_window_count in replies:
+            env.alive_cars_count -= retired_count
+            env.left_window_count += left_window_count
+        self.size = sum(counts)
+        env.profiler.mark('update')
+
+        for emigrants in self.command('react', *((self.size,) for _ in range(len(self.tiling)))):
+            for tile, record in emigrants:
+                self.immigrants[tile].append(record)
+        env.profiler.mark('react')
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(('close',))
+        for worker in self.workers:
+            worker.join()
+        del self.table
+        self.shared.close()
+        self.shared.unlink()
+        self.env.close()
+
+
+def run_sharded(config: dict, frames: int, seed=None):
+    '''
+    run_headless() with the world split in the config's sharding.tiles.
+    :return: the coordinator's Environment, which holds the stats, and the achieved frames per second
+    '''
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+    simulation = ShardedSimulation(config, seed=seed)
+    try:
+        start = time.perf_counter()
+        for _ in range(frames):
+            simulation.step()
+        elapsed = time.perf_counter() - start
+    finally:
+        simulation.close()
+
+    fps = frames / elapsed if elapsed > 0 else float('inf')
+    return simulation.env, fps
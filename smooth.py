@@ -0,0 +1,409 @@
+'''
+Offline Kalman filtering and Rauch-Tung-Striebel smoothing of recorded measurement logs.
+A log is a stream of rows, in frame order, each with the frame, a car id and the measured state
+(x, vx, ax, y, vy, ay) of that car. It can be:
+- a Recorder directory (recorder.path), whose 'measured' rows are what each car's filter got online
+- a .npy file of such rows, as a structured array with fields frame, car_id and either measured or x, vx, ax, y, vy, ay
+- a .csv file with those columns, named in a header line
+The log is read in chunks of rows. A forward pass filters every car present in a frame at once and writes the filtered
+tracks to the output .npy file. The backward pass then reads that file back, memory-mapped, frame by frame from the
+end, and writes the smoothed tracks to it. Only the state of the cars of the current frame is held in memory.
+The covariances and gains of a filter only depend on the number of frames since it started (its age), so they are
+computed once for every age by covariance_schedule() and shared by all cars.
+A car's track restarts when it is missing from a frame.
+'''
+import csv
+import os
+import argparse
+import itertools
+import numpy as np
+
+from main import load_config
+from kalman import CarSystemKF, covariance_schedule
+from models.Recorder import Replay
+from models.Statistics import StreamingCovariance
+
+MEASUREMENT_FIELDS = ('x', 'vx', 'ax', 'y', 'vy', 'ay')
+
+LOG_DTYPE = np.dtype([
+    ('frame', np.int64),
+    ('car_id', np.int64),
+    ('measured', np.float64, (6,)),
+    # true (x, y) when the log has it, as Recorder directories do, nan otherwise
+    ('true_position', np.float64, (2,)),
+])
+
+# one row per log row, in the same order. Vectors in kf state order: (x, vx, ax, y, vy, ay)
+TRACK_DTYPE = np.dtype([
+    ('frame', np.int64),
+    ('car_id', np.int64),
+    # frames since the car's track started
+    ('age', np.int64),
+    ('measured', np.float64, (6,)),
+    ('filtered', np.float64, (6,)),
+    ('filtered_var', np.float64, (6,)),
+    ('smoothed', np.float64, (6,)),
+    ('smoothed_var', np.float64, (6,)),
+    # measurement minus predicted measurement, and its normalized squared norm
+    ('innovation', np.float64, (6,)),
+    ('nis', np.float64),
+    ('true_position', np.float64, (2,)),
+])
+
+# frame of cars that have no state yet, never next to a real one
+NO_FRAME = -2 ** 62
+
+
+def log_rows(path):
+    '''
+    :return: the number of rows of the log at path
+    '''
+    if os.path.isdir(path):
+        return sum(chunk['rows'] for chunk in Replay(path).meta['chunks'])
+    if path.endswith('.npy'):
+        return len(np.load(path, mmap_mode='r'))
+    with open(path) as f:
+        return sum(1 for _ in f) - 1
+
+
+def read_log(path, chunk_rows: int):
+    '''
+    Yields the rows of the log at path as LOG_DTYPE arrays of at most chunk_rows rows.
+    '''
+    if os.path.isdir(path):
+        sources = Replay(path).chunks
+    elif path.endswith('.npy'):
+        sources = [np.load(path, mmap_mode='r')]
+    else:
+        sources = read_csv(path, chunk_rows)
+
+    for source in sources:
+        for start in range(0, len(source), chunk_rows):
+            rows = source[start:start + chunk_rows]
+            block = np.empty(len(rows), dtype=LOG_DTYPE)
+            block['frame'] = rows['frame']
+            block['car_id'] = rows['car_id']
+            if 'measured' in rows.dtype.names:
+                block['measured'] = rows['measured']
+                block['true_position'] = np.column_stack((rows['x'], rows['y'])) \
+                    if 'x' in rows.dtype.names else np.nan
+            else:
+                block['measured'] = np.column_stack([rows[name] for name in MEASUREMENT_FIELDS])
+                block['true_position'] = np.nan
+            yield block
+
+
+def read_csv(path, chunk_rows: int):
+    '''
+    Yields the rows of a CSV log as structured arrays of at most chunk_rows rows.
+    '''
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = [name.strip() for name in next(reader)]
+        missing = {'frame', 'car_id', *MEASUREMENT_FIELDS} - set(header)
+        if missing:
+            raise ValueError(f"{path} has no column {', '.join(sorted(missing))}")
+        dtype = np.dtype([(name, np.float64) for name in header])
+        while True:
+            lines = list(itertools.islice(reader, chunk_rows))
+            if not lines:
+                return
+            values = np.array(lines, dtype=np.float64)
+            yield np.rec.fromarrays(values.T, dtype=dtype)
+
+
+def frame_groups(blocks):
+    '''
+    Regroup consecutive (indices, rows) blocks into whole frames: yields (frame, indices, rows) for each frame, rows
+    of a frame being contiguous in the stream.
+    '''
+    carry = None
+    for indices, rows in blocks:
+        if carry is not None:
+            indices, rows = np.concatenate((carry[0], indices)), np.concatenate((carry[1], rows))
+        boundaries = np.flatnonzero(np.diff(rows['frame'])) + 1
+        starts = np.concatenate(([0], boundaries))
+        ends = np.concatenate((boundaries, [len(rows)]))
+        # the last frame of the block may go on in the next one
+        for start, end in zip(starts[:-1], ends[:-1]):
+            yield int(rows['frame'][start]), indices[start:end], rows[start:end]
+        carry = indices[starts[-1]:], rows[starts[-1]:]
+    if carry is not None and len(carry[1]) > 0:
+        yield int(carry[1]['frame'][0]), carry[0], carry[1]
+
+
+class TrackTable:
+    '''
+    State carried from frame to frame for each car, in rows that are reused once a car's track ended.
+    Car ids are kept sorted, with their rows, so the rows of a frame's cars are found with one binary search.
+    '''
+    def __init__(self, fields: dict, capacity: int = 16):
+        '''
+        :param fields: shape of the state of a car, by name. A 'frame' and an 'age' field are always kept.
+        '''
+        self.fields = {'frame': (), 'age': (), **fields}
+        self.arrays = {name: np.zeros((capacity,) + shape, dtype=np.int64 if name in ('frame', 'age') else float)
+                       for name, shape in self.fields.items()}
+        self.car_ids = np.empty(0, dtype=np.int64)
+        self.car_rows = np.empty(0, dtype=int)
+        self.free_rows = np.arange(capacity)
+
+    def __len__(self):
+        return len(self.car_ids)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def _grow(self, needed):
+        capacity = len(self.arrays['frame'])
+        new_capacity = max(2 * capacity, capacity + needed)
+        for name, old in self.arrays.items():
+            new = np.zeros((new_capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:capacity] = old
+            self.arrays[name] = new
+        self.free_rows = np.concatenate((self.free_rows, np.arange(capacity, new_capacity)))
+
+    def rows(self, car_ids):
+        '''
+        Rows of car_ids, new cars getting one with frame NO_FRAME.
+        '''
+        positions = np.searchsorted(self.car_ids, car_ids)
+        found = positions < len(self.car_ids)
+        found[found] = self.car_ids[positions[found]] == car_ids[found]
+        rows = np.empty(len(car_ids), dtype=int)
+        rows[found] = self.car_rows[positions[found]]
+
+        new = ~found
+        count = np.count_nonzero(new)
+        if count:
+            if count > len(self.free_rows):
+                self._grow(count - len(self.free_rows))
+            new_rows = self.free_rows[:count]
+            self.free_rows = self.free_rows[count:]
+            self.arrays['frame'][new_rows] = NO_FRAME
+            rows[new] = new_rows
+            car_ids = np.concatenate((self.car_ids, car_ids[new]))
+            order = np.argsort(car_ids, kind='stable')
+            self.car_ids = car_ids[order]
+            self.car_rows = np.concatenate((self.car_rows, new_rows))[order]
+        return rows
+
+    def drop(self, frame):
+        '''
+        Free the rows of the cars that were not in frame.
+        '''
+        keep = self.arrays['frame'][self.car_rows] == frame
+        self.free_rows = np.concatenate((self.free_rows, self.car_rows[~keep]))
+        self.car_ids = self.car_ids[keep]
+        self.car_rows = self.car_rows[keep]
+
+
+class BatchSmoother:
+    '''
+    The Kalman Filter of CarSystemKF for a measurement noise and dt, run over whole logs and followed by a
+    Rauch-Tung-Striebel smoother.
+    '''
+    def __init__(self, dt: float, measurement_noise: float, chunk_rows: int = 65536, calibration=None):
+        '''
+        :param calibration: path of a file written by calibrate.py, see CarSystemKF.get_model()
+        '''
+        self.chunk_rows = chunk_rows
+        A, B, H, P, Q, R = CarSystemKF.get_model(dt, measurement_noise, calibration)
+        self.A, self.H = A, H
+        predicted_sigmas, gains, updated_sigmas = covariance_schedule(A, H, Q, R, P)
+        # by age, the last entries holding for every older track
+        self.predicted_sigmas = predicted_sigmas
+        self.gains = gains
+        self.updated_sigmas = updated_sigmas
+        self.innovation_precisions = np.linalg.inv(H @ predicted_sigmas @ H.transpose() + R)
+        # smoother gain of age k, from the predicted covariance of age k + 1
+        next_predicted = np.concatenate((predicted_sigmas[1:], predicted_sigmas[-1:]))
+        self.smoother_gains = updated_sigmas @ A.transpose() @ np.linalg.inv(next_predicted)
+        self.next_predicted_sigmas = next_predicted
+
+    def schedule_index(self, age):
+        return np.minimum(age, len(self.gains) - 1)
+
+    def run(self, log_path: str, output_path: str):
+        '''
+        Filter and smooth the log at log_path into a .npy file of TRACK_DTYPE rows at output_path.
+        :return: innovation statistics and, for logs with the true positions, RMS position errors
+        '''
+        tracks = np.lib.format.open_memmap(output_path, mode='w+', dtype=TRACK_DTYPE, shape=(log_rows(log_path),))
+        stats = self.forward(read_log(log_path, self.chunk_rows), tracks)
+        tracks.flush()
+        smoothed_error = self.backward(tracks)
+        tracks.flush()
+        if 'position_rms_error' in stats:
+            stats['position_rms_error']['smoothed'] = smoothed_error
+        return stats
+
+    def forward(self, blocks, tracks):
+        '''
+        Filter the LOG_DTYPE blocks into tracks.
+        :return: dict of innovation statistics and RMS position errors of the measurements and filtered tracks
+        '''
+        A, H = self.A, self.H
+        state = TrackTable({'mean': (6,)})
+        innovations = StreamingCovariance(6)
+        nis_sum = 0
+        squared_errors = {name: 0 for name in ('measured', 'filtered')}
+        error_count = 0
+        last_frame = None
+
+        offset = 0
+
+        def indexed(blocks):
+            nonlocal offset
+            for block in blocks:
+                yield np.arange(offset, offset + len(block)), block
+                offset += len(block)
+
+        for frame, indices, rows in frame_groups(indexed(blocks)):
+            if last_frame is not None and frame < last_frame:
+                raise ValueError(f"Log rows must be in frame order, frame {frame} comes after {last_frame}")
+            last_frame = frame
+
+            z = rows['measured']
+            car_rows = state.rows(rows['car_id'])
+            continuing = state['frame'][car_rows] == frame - 1
+            age = np.where(continuing, state['age'][car_rows] + 1, 0)
+            # filters start from their first measurement, as CarSystemKF does
+            prior = np.where(continuing[:, np.newaxis], state['mean'][car_rows], z)
+            k = self.schedule_index(age)
+
+            predicted = prior @ A.transpose()
+            innovation = z - predicted @ H.transpose()
+            filtered = predicted + np.einsum('nij,nj->ni', self.gains[k], innovation)
+            nis = np.einsum('ni,nij,nj->n', innovation, self.innovation_precisions[k], innovation)
+
+            state['mean'][car_rows] = filtered
+            state['frame'][car_rows] = frame
+            state['age'][car_rows] = age
+
+            out = np.zeros(len(rows), dtype=TRACK_DTYPE)
+            out['frame'] = frame
+            out['car_id'] = rows['car_id']
+            out['age'] = age
+            out['measured'] = z
+            out['filtered'] = filtered
+            out['filtered_var'] = np.diagonal(self.updated_sigmas[k], axis1=1, axis2=2)
+            out['innovation'] = innovation
+            out['nis'] = nis
+            out['true_position'] = rows['true_position']
+            tracks[indices[0]:indices[-1] + 1] = out
+
+            innovations.add(innovation)
+            nis_sum += nis.sum()
+            known = np.all(np.isfinite(rows['true_position']), axis=1)
+            if known.any():
+                true_position = rows['true_position'][known]
+                squared_errors['measured'] += np.sum((z[known][:, [0, 3]] - true_position) ** 2)
+                squared_errors['filtered'] += np.sum((filtered[known][:, [0, 3]] - true_position) ** 2)
+                error_count += 2 * known.sum()
+            # only the cars of this frame can go on in the next one
+            if len(state) > 2 * len(rows) + 1024:
+                state.drop(frame)
+
+        stats = {'rows': innovations.count, 'innovation_mean': innovations.mean,
+                 'innovation_covariance': innovations.covariance if innovations.count > 1 else None,
+                 # the normalized innovation squared of a consistent filter averages to the measurement dimension
+                 'nis_mean': nis_sum / innovations.count if innovations.count else None}
+        if error_count:
+            stats['position_rms_error'] = {name: np.sqrt(total / error_count)
+                                           for name, total in squared_errors.items()}
+        return stats
+
+    def backward(self, tracks):
+        '''
+        Smooth the filtered tracks in place, from the last frame back.
+        :return: RMS error of the smoothed positions against the true ones, None if the tracks don't have them
+        '''
+        A = self.A
+        squared_error, error_count = 0, 0
+        state = TrackTable({'mean': (6,), 'sigma': (6, 6), 'filtered': (6,)})
+
+        def reversed_blocks():
+            for end in range(len(tracks), 0, -self.chunk_rows):
+                start = max(end - self.chunk_rows, 0)
+                yield np.arange(end - 1, start - 1, -1), tracks[start:end][::-1]
+
+        for frame, indices, rows in frame_groups(reversed_blocks()):
+            age = rows['age']
+            filtered = rows['filtered']
+            car_rows = state.rows(rows['car_id'])
+            # the car's next row, if it continues the same track
+            has_next = (state['frame'][car_rows] == frame + 1) & (state['age'][car_rows] == age + 1)
+            k = self.schedule_index(age)
+            updated_sigma = self.updated_sigmas[k]
+
+            smoothed = filtered.copy()
+            smoothed_sigma = updated_sigma.copy()
+            if has_next.any():
+                next_rows = car_rows[has_next]
+                G = self.smoother_gains[k[has_next]]
+                predicted = filtered[has_next] @ A.transpose()
+                smoothed[has_next] += np.einsum('nij,nj->ni', G, state['mean'][next_rows] - predicted)
+                smoothed_sigma[has_next] += G @ (state['sigma'][next_rows] - self.next_predicted_sigmas[k[has_next]]) \
+                    @ G.transpose(0, 2, 1)
+
+            state['mean'][car_rows] = smoothed
+            state['sigma'][car_rows] = smoothed_sigma
+            state['frame'][car_rows] = frame
+            state['age'][car_rows] = age
+
+            first, last = indices[-1], indices[0]
+            tracks['smoothed'][first:last + 1] = smoothed[::-1]
+            tracks['smoothed_var'][first:last + 1] = np.diagonal(smoothed_sigma, axis1=1, axis2=2)[::-1]
+
+            known = np.all(np.isfinite(rows['true_position']), axis=1)
+            if known.any():
+                squared_error += np.sum((smoothed[known][:, [0, 3]] - rows['true_position'][known]) ** 2)
+                error_count += 2 * known.sum()
+            if len(state) > 2 * len(rows) + 1024:
+                state.drop(frame)
+        return np.sqrt(squared_error / error_count) if error_count else None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Collision predictor smoothing',
+        description='Kalman filter and RTS smooth a measurement log, and report innovation statistics'
+    )
+    parser.add_argument('log', help='Recorder directory, .npy or .csv measurement log')
+    parser.add_argument('-o', '--output', required=True, help='.npy file to write the filtered and smoothed tracks to')
+    parser.add_argument('-c', '--config', help='config merged over default.yaml, for the model and the chunk size')
+    parser.add_argument('--dt', type=float, help="filter time step, defaults to the Recorder's or game.interval")
+    parser.add_argument('--measurement-noise', type=float, help='defaults to sim.measurement_noise')
+    args = parser.parse_args()
+
+    if log_rows(args.log) == 0:
+        print("No measurements in the log")
+        return
+
+    config = load_config(args.config)
+    dt = args.dt
+    if dt is None and os.path.isdir(args.log):
+        dt = Replay(args.log).meta.get('world', {}).get('interval')
+    if dt is None:
+        dt = config['game']['interval']
+    measurement_noise = args.measurement_noise
+    if measurement_noise is None:
+        measurement_noise = config['sim']['measurement_noise']
+
+    smoother = BatchSmoother(dt, measurement_noise, chunk_rows=config['smoothing']['chunk_rows'],
+                             calibration=config['sim']['kf_calibration'])
+    stats = smoother.run(args.log, args.output)
+
+    np.set_printoptions(precision=3, suppress=True)
+    print(f"rows: {stats['rows']}\t mean NIS: {stats['nis_mean']:.3f} (6 for a consistent filter)")
+    print(f"innovation mean: {stats['innovation_mean']}\ninnovation covariance:\n{stats['innovation_covariance']}")
+    if 'position_rms_error' in stats:
+        errors = stats['position_rms_error']
+        print(f"position RMS error, measurement: {errors['measured']:.3f}\t kalman filter: {errors['filtered']:.3f}\t "
+              f"smoother: {errors['smoothed']:.3f}")
+    print(f"Tracks written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import io
+import csv
+import sys
+import copy
+import json
+import yaml
+import argparse
+import itertools
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+from main import load_config
+from headless import run_headless
+
+
+def set_option(config: dict, key: str, value):
+    '''
+    Set a nested config option given as a dotted key, e.g. "sim.measurement_noise".
+    '''
+    *path, name = key.split('.')
+    for k in path:
+        config = config.setdefault(k, dict())
+    config[name] = value
+
+
+def expand_grid(grid: dict):
+    '''
+    Every combination of a {dotted key: list of values} grid, as a list of {dotted key: value} dicts.
+    '''
+    keys = list(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+
+
+def run_one(base_config: dict, params: dict, frames: int, seed: int):
+    config = copy.deepcopy(base_config)
+    for key, value in params.items():
+        set_option(config, key, value)
+
+    # the simulation reports to stdout, keep the workers quiet
+    with contextlib.redirect_stdout(io.StringIO()):
+        env, fps = run_headless(config, frames, seed=seed)
+
+    result = dict(params)
+    result.update({
+        'seed': seed,
+        'frames': frames,
+        'collisions': env.collision_count,
+        'cars_spawned': env.total_cars_count,
+        'cars_left_window': env.left_window_count,
+        'fps': fps,
+    })
+    return result
+
+
+def write_results(results, path):
+    if path.endswith('.json'):
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+            writer.writeheader()
+            writer.writerows(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Collision predictor sweep',
+        description='Run a grid of headless simulations in parallel'
+    )
+    parser.add_argument('-c', '--config', help='base config, merged over default.yaml')
+    parser.add_argument('-g', '--grid', help='YAML file mapping dotted config keys to lists of values')
+    parser.add_argument('-p', '--param', action='append', default=[],
+                        help='grid entry as key=v1,v2,..., e.g. sim.measurement_noise=0,1,5 (repeatable)')
+    parser.add_argument('--frames', type=int, default=1000, help='frames per run')
+    parser.add_argument('--repeats', type=int, default=1, help='runs per combination, each with its own seed')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the first repeat, the others count up from it. Every combination runs with the '
+                             'same seeds so they are compared on the same random draws')
+    parser.add_argument('--workers', type=int, help='worker processes, defaults to the number of cores')
+    parser.add_argument('-o', '--output', default='sweep.csv', help='results file, .csv or .json')
+    args = parser.parse_args()
+
+    base_config = load_config(args.config)
+
+    grid = dict()
+    if args.grid:
+        with open(args.grid) as gf:
+            grid.update(yaml.safe_load(gf))
+    for param in args.param:
+        key, values = param.split('=', 1)
+        grid[key] = [yaml.safe_load(value) for value in values.split(',')]
+    if len(grid) == 0:
+        print("Empty parameter grid, use --grid or --param")
+        sys.exit()
+
+    runs = [(params, args.seed + repeat) for params in expand_grid(grid) for repeat in range(args.repeats)]
+    print(f"Running {len(runs)} simulations of {args.frames} frames")
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(run_one, base_config, params, args.frames, seed) for params, seed in runs]
+        results = []
+        for i, future in enumerate(futures):
+            results.append(future.result())
+            print(f"\r{i + 1}/{len(runs)} done", end='')
+    print()
+
+    write_results(results, args.output)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import os
+import math
+import random
+import yaml
+import numpy as np
+import pytest
+
+from models.Basics import Vector2, oriented_box_collisions
+from models.CarManager import Car
+from models.Environment import Environment
+from models.World import World
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def car(x, y, rotation_angle=0):
+    # scale 1: 3 wide, 5 long, 8 x 8 once crashed
+    return Car(Vector2(x, y), Vector2(0, 0), rotation_angle=rotation_angle, scale=1)
+
+
+def resolve(narrow_phase, cars, pairs):
+    env = Environment(World(), narrow_phase=narrow_phase)
+    env.resolve_collisions(cars, pairs)
+    return env.collision_count
+
+
+def test_oriented_box_collisions_hand_checked():
+    cars = [
+        # heading along x: x in [-2.5, 2.5], y in [-1.5, 1.5]
+        car(0, 0),
+        # nose to tail with car 0: x in [1.5, 6.5], 1 of overlap along x
+        car(4, 0),
+        # turned 45 degrees, reaching 2.5 + 2 * sqrt(2) from its center along x: 2.5 + 2 * sqrt(2) - 5 of overlap
+        car(5, 0, math.pi / 4),
+        # turned 45 degrees past the corner of car 0: their axis aligned bounding boxes overlap, the cars don't, with
+        # 2 * sqrt(2) + 2.5 < 4 * sqrt(2) between them along car 3's length
+        car(4, 4, math.pi / 4),
+    ]
+    centers = [c.position.get() for c in cars]
+    angles = [c.rotation_angle for c in cars]
+    sizes = [c.size for c in cars]
+
+    colliding, depth = oriented_box_collisions(centers, angles, sizes, [(0, 1), (0, 2), (0, 3)])
+
+    assert colliding.tolist() == [True, True, False]
+    assert depth == pytest.approx([1, 2.5 + 2 * math.sqrt(2) - 5, 0])
+
+
+def test_obb_finds_nose_to_tail_crash_aabb_misses():
+    # as unrotated boxes, 3 wide along x, the cars are 1 apart
+    assert resolve('aabb', [car(0, 0), car(4, 0)], [(0, 1)]) == 0
+    assert resolve('obb', [car(0, 0), car(4, 0)], [(0, 1)]) == 1
+
+
+def test_obb_pass_grows_crashed_cars_in_order():
+    # car 2 only reaches car 1 once car 1 has grown to its crash size: y in [-4, 4] against [3.5, 6.5]
+    cars = [car(0, 0), car(4, 0), car(4, 5)]
+    assert resolve('obb', cars, np.array([(0, 1), (1, 2)])) == 1
+    assert [c.crashed for c in cars] == [True, True, True]
+
+    # visited before car 1 crashes, the pair doesn't collide
+    cars = [car(0, 0), car(4, 0), car(4, 5)]
+    assert resolve('obb', cars, np.array([(1, 2), (0, 1)])) == 1
+    assert [c.crashed for c in cars] == [True, True, False]
+
+
+def crashes_by_frame(broadphase, narrow_phase, frames=200):
+    '''
+    Collision count and ids of the crashed cars after each frame of a seeded run of 60 cars.
+    '''
+    with open(os.path.join(ROOT, 'config', 'default.yaml')) as f:
+        config = yaml.safe_load(f)
+    config['sim'].update(target_n_cars=60, randomize=True, broadphase=broadphase, narrow_phase=narrow_phase)
+    random.seed(0)
+    np.random.seed(0)
+    env = Environment.from_config(config, seed=0)
+    crashes = []
+    for _ in range(frames):
+        env.step()
+        crashes.append((env.collision_count, sorted(car_mng.id for car_mng in env.car_mngs if car_mng.car.crashed)))
+    return crashes
+
+
+@pytest.mark.parametrize('narrow_phase', ['aabb', 'obb'])
+@pytest.mark.parametrize('broadphase', ['grid', 'sap'])
+def test_broadphase_finds_the_brute_force_collisions(broadphase, narrow_phase):
+    brute_force = crashes_by_frame('brute', narrow_phase)
+    assert brute_force[-1][0] > 0
+    assert crashes_by_frame(broadphase, narrow_phase) == brute_force
@@ -0,0 +1,18 @@
+from models.CarManager import CarManager
+from models.Environment import Environment
+from models.World import World
+
+
+def test_kf_repr_stays_with_its_car_when_one_retires():
+    env = Environment(World(), target_n_cars=6, seed=0)
+    env.spawn_cars(randomize=True)
+    env.update_all()
+    first = env.car_mngs[0]
+    first.car.position.x = -10 * env.world.window_size[0]
+    env.update_all()
+
+    assert first not in list(env.car_mngs)
+    assert len(env.car_mngs) == 5
+    for car_mng in env.car_mngs:
+        kf = car_mng.kalman_filter.kf
+        assert (car_mng.kf_center, car_mng.kf_rect) == CarManager.make_repr(kf.last_mean, kf.last_sigma)
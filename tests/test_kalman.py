@@ -0,0 +1,137 @@
+from types import SimpleNamespace
+import yaml
+import numpy as np
+
+from calibrate import calibrate
+from kalman import AxisDecoupledKalmanFilter, CarSystemKF, KalmanFilter, KalmanFilterBank
+from models.Environment import Environment
+from models.World import World
+
+
+def car_manager(measurement_noise):
+    return SimpleNamespace(sensor=SimpleNamespace(measurement_noise=measurement_noise))
+
+
+def write_calibration(path, dt, measurement_noise, seed=0):
+    P, Q, R, samples = calibrate(World(), measurement_noise, dt, cars=50, frames=30, seed=seed)
+    with open(path, 'w') as f:
+        yaml.safe_dump({'calibrations': [{'dt': dt, 'measurement_noise': measurement_noise, 'samples': samples,
+                                          'P': P.tolist(), 'Q': Q.tolist(), 'R': R.tolist()}]}, f)
+    return P, Q, R
+
+
+def measurements(measurement_noises, frames, seed=0):
+    '''
+    Noisy measurements of cars driving around the window, stacked as (n, 6, 1), frame after frame.
+    '''
+    rng = np.random.default_rng(seed)
+    n = len(measurement_noises)
+    position = rng.uniform(0, 1000, (n, 2))
+    velocity = rng.uniform(-5, 5, (n, 2))
+    for _ in range(frames):
+        position = position + velocity
+        velocity = velocity + rng.normal(0, 0.1, (n, 2))
+        state = np.column_stack((position[:, 0], velocity[:, 0], np.zeros(n),
+                                 position[:, 1], velocity[:, 1], np.zeros(n)))
+        yield (state + rng.normal(0, 1, (n, 6)) * measurement_noises[:, np.newaxis])[:, :, np.newaxis]
+
+
+def filled_bank(Rs, P, steadies=None, **kwargs):
+    A, B, H, _, Q, _ = CarSystemKF.get_model(0.05, 1)
+    bank = KalmanFilterBank(A, B, H, Q, **kwargs)
+    for i, R in enumerate(Rs):
+        bank.add(SimpleNamespace(started=False), np.zeros((6, 1)), P, R,
+                 steady=None if steadies is None else steadies[i])
+    return bank
+
+
+def step_alongside(bank, filters, P, frames):
+    '''
+    Step the bank and one filter per row through the same measurements, the filters started from their first one
+    like the bank's rows.
+    :return: the bank's means and the filters', frame after frame
+    '''
+    ut = np.zeros((1, 1))
+    for frame, zt in enumerate(frames):
+        means, _ = bank.step(ut, zt)
+        first = frame == 0
+        single = [kf.step(ut, z, last_mean=z if first else None, last_sigma=P if first else None)[0]
+                  for kf, z in zip(filters, zt)]
+        yield means, np.stack(single)
+
+
+def test_bank_matches_kalman_filter():
+    measurement_noises = np.tile([0.1, 1, 5], 6)
+    A, B, H, P, Q, _ = CarSystemKF.get_model(0.05, 1)
+    Rs = [CarSystemKF.get_model(0.05, measurement_noise)[5].copy() for measurement_noise in measurement_noises]
+    # x and y measured with correlated noise, which keeps the bank off its axis-decoupled path
+    for R in Rs:
+        R[0, 3] = R[3, 0] = R[0, 0] / 2
+    bank = filled_bank(Rs, P)
+    assert not bank.axis_decoupled
+
+    filters = [KalmanFilter(A, B, H, Q, R) for R in Rs]
+    for means, single in step_alongside(bank, filters, P, measurements(measurement_noises, 300)):
+        assert np.allclose(means, single, rtol=1e-9, atol=1e-9)
+
+
+def test_axis_decoupled_matches_kalman_filter():
+    measurement_noises = np.tile([0.1, 1, 5], 6)
+    A, B, H, P, Q, _ = CarSystemKF.get_model(0.05, 1)
+    Rs = [CarSystemKF.get_model(0.05, measurement_noise)[5] for measurement_noise in measurement_noises]
+    bank = filled_bank(Rs, P)
+    assert bank.axis_decoupled
+
+    filters = [KalmanFilter(A, B, H, Q, R) for R in Rs]
+    decoupled = [AxisDecoupledKalmanFilter(A, B, H, Q, R) for R in Rs]
+    frames = list(measurements(measurement_noises, 300))
+    for means, single in step_alongside(bank, filters, P, frames):
+        assert np.allclose(means, single, rtol=1e-9, atol=1e-9)
+    for means, single in step_alongside(filled_bank(Rs, P), decoupled, P, frames):
+        assert np.allclose(means, single, rtol=1e-9, atol=1e-9)
+    for kf, decoupled_kf in zip(filters, decoupled):
+        assert np.allclose(kf.last_sigma, decoupled_kf.last_sigma, rtol=1e-9, atol=1e-12)
+
+
+def test_steady_state_matches_full_recursion():
+    for dt, measurement_noise in ((0.05, 0.1), (0.05, 1), (0.05, 5), (1, 1)):
+        A, B, H, P, Q, R = CarSystemKF.get_model(dt, measurement_noise)
+        steady = CarSystemKF.get_steady_state(dt, measurement_noise)
+        full = KalmanFilterBank(A, B, H, Q)
+        fast = KalmanFilterBank(A, B, H, Q, steady_state=True)
+        for _ in range(50):
+            full.add(SimpleNamespace(started=False), np.zeros((6, 1)), P, R)
+            fast.add(SimpleNamespace(started=False), np.zeros((6, 1)), P, R, steady=steady)
+
+        for zt in measurements(np.full(50, measurement_noise), 400):
+            full_means, _ = full.step(np.zeros((1, 1)), zt)
+            fast_means, _ = fast.step(np.zeros((1, 1)), zt)
+            assert np.abs(full_means - fast_means).max() <= 1e-11
+        assert fast.converged[:fast.size].all()
+
+
+def test_calibrated_filter_keeps_axis_decoupled_path(tmp_path):
+    path = str(tmp_path / 'kf_calibration.yaml')
+    P, Q, R = write_calibration(path, 0.05, 1)
+    for matrix in (P, Q, R):
+        assert np.array_equal(matrix, matrix.T)
+        assert not matrix[:3, 3:].any() and not matrix[3:, :3].any()
+
+    car_kf = CarSystemKF(car_manager(1), dt=0.05, calibration=path)
+    assert np.array_equal(car_kf.kf.Q, Q)
+    assert isinstance(car_kf.kf, AxisDecoupledKalmanFilter)
+    bank = KalmanFilterBank(car_kf.kf.A, car_kf.kf.B, car_kf.kf.H, car_kf.kf.Q)
+    car_kf.attach(bank)
+    assert bank.axis_decoupled
+
+
+def test_calibration_stays_with_its_environment(tmp_path):
+    path = str(tmp_path / 'kf_calibration.yaml')
+    _, Q, _ = write_calibration(path, 0.05, 1)
+    calibrated = Environment(World(), kf_calibration=path)
+    Environment(World())
+
+    assert np.array_equal(CarSystemKF(car_manager(1), dt=0.05, calibration=calibrated.kf_calibration).kf.Q, Q)
+    built_in_Q = CarSystemKF(car_manager(1), dt=0.05).kf.Q
+    assert not np.array_equal(built_in_Q, Q)
+    assert np.array_equal(built_in_Q, CarSystemKF.get_model(0.05, 1)[4])
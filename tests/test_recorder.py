@@ -0,0 +1,41 @@
+import os
+import sys
+import yaml
+import pytest
+
+import main
+from game import Game
+from headless import run_headless
+from models.Recorder import Recorder, Replay
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_replay_leaves_the_recording_as_it_was(tmp_path, monkeypatch):
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setenv('SDL_VIDEODRIVER', 'dummy')
+    path = str(tmp_path / 'run')
+    config_path = str(tmp_path / 'config.yaml')
+    with open(config_path, 'w') as f:
+        yaml.safe_dump({'sim': {'target_n_cars': 5}, 'recorder': {'path': path, 'chunk_size': 16}}, f)
+    run_headless(main.load_config(config_path), 20, seed=0)
+    with open(os.path.join(path, 'meta.json')) as f:
+        recorded_meta = f.read()
+    recorded_frames = [frame for frame, _ in Replay(path).frames()]
+    assert len(Replay(path).meta['chunks']) > 1
+
+    play_back = Game.replay
+
+    def replay_and_quit(game, *args):
+        play_back(game, *args)
+        game.env.close()
+
+    monkeypatch.setattr(Game, 'replay', replay_and_quit)
+    monkeypatch.setattr(sys, 'argv', ['main.py', '-c', config_path, '--replay', path])
+    main.main()
+
+    with open(os.path.join(path, 'meta.json')) as f:
+        assert f.read() == recorded_meta
+    assert [frame for frame, _ in Replay(path).frames()] == recorded_frames
+    with pytest.raises(ValueError):
+        Recorder(path)
@@ -0,0 +1,30 @@
+from types import SimpleNamespace
+import numpy as np
+
+from models.Sensor import SensorBank, counter_normals
+
+
+def test_counter_noise_only_depends_on_seed_key_and_counter():
+    keys = np.array([3, 17, 42, 1000])
+    noise = counter_normals(7, keys, 12)
+    assert np.array_equal(counter_normals(7, keys, 12), noise)
+    # whatever the other keys drawn for, and their order
+    assert np.array_equal(counter_normals(7, keys[::-1], 12), noise[::-1])
+    assert np.array_equal(counter_normals(7, keys[2:3], 12), noise[2:3])
+    assert not np.any(counter_normals(7, keys, 13) == noise)
+    assert not np.any(counter_normals(8, keys, 12) == noise)
+
+
+def test_counter_noise_sensor_measures_the_same_alone_or_in_a_fleet():
+    def measured(keys, frames=5):
+        bank = SensorBank(seed=7, counter_noise=True)
+        for _ in keys:
+            bank.add(SimpleNamespace(measurement_noise=2))
+        positions = np.zeros((len(keys), 2))
+        return [bank.measure(positions, keys=np.array(keys, dtype=np.uint64), frame=frame)[0].copy()
+                for frame in range(frames)]
+
+    alone = measured([42])
+    in_fleet = measured([5, 42, 9])
+    for frame_alone, frame_in_fleet in zip(alone, in_fleet):
+        assert np.array_equal(frame_alone[0], frame_in_fleet[1])
@@ -0,0 +1,25 @@
+import os
+import copy
+import yaml
+
+from headless import run_headless
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def stats(env):
+    return env.alive_cars_count, env.total_cars_count, env.collision_count, env.left_window_count
+
+
+def test_sharded_run_matches_single_process():
+    with open(os.path.join(ROOT, 'config', 'default.yaml')) as f:
+        config = yaml.safe_load(f)
+    config['sim'].update(target_n_cars=60, randomize=True, enable_collision_avoidance=True, measurement_noise=1,
+                         sensor_noise='counter')
+    sharded_config = copy.deepcopy(config)
+    sharded_config['sharding']['tiles'] = [2, 2]
+
+    single, _ = run_headless(config, 200, seed=0)
+    sharded, _ = run_headless(sharded_config, 200, seed=0)
+    assert single.collision_count > 0
+    assert stats(sharded) == stats(single)
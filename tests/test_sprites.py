@@ -0,0 +1,18 @@
+import pygame
+import pytest
+
+from models.Sprites import RotationCache
+
+
+def test_rotation_buckets_wrap_at_360():
+    cache = RotationCache(pygame.Surface((3, 5)), resolution=7.5)
+    assert cache.get(359) is cache.get(0)
+    assert cache.get(-3) is cache.get(360)
+    assert cache.get(352.5) is not cache.get(0)
+    assert sorted(cache.rotations) == [0, 47]
+
+
+@pytest.mark.parametrize('resolution', [7, 0.7, 500])
+def test_rotation_resolution_must_divide_360(resolution):
+    with pytest.raises(ValueError):
+        RotationCache(pygame.Surface((3, 5)), resolution=resolution)
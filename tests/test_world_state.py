@@ -0,0 +1,35 @@
+import numpy as np
+
+from models.Basics import GameObject, Vector2
+from models.WorldState import StateBacked, WorldState
+
+
+class StateObject(StateBacked, GameObject):
+    pass
+
+
+def test_world_state_step_matches_game_object_update():
+    rng = np.random.default_rng(0)
+    state = WorldState()
+    pairs = []
+    for _ in range(50):
+        x, y, vx, vy, rotation_angle = rng.uniform(-5, 5, 5)
+        reverse = bool(rng.integers(2))
+        pairs.append((GameObject(Vector2(x, y), Vector2(vx, vy), rotation_angle=rotation_angle, reverse=reverse),
+                      StateObject(state, Vector2(x, y), Vector2(vx, vy), rotation_angle=rotation_angle,
+                                  reverse=reverse)))
+
+    for frame in range(300):
+        if frame % 20 == 0:
+            accels, steerings = rng.uniform(-0.5, 0.5, len(pairs)), rng.uniform(-0.05, 0.05, len(pairs))
+            for (plain, backed), accel, steering in zip(pairs, accels, steerings):
+                plain.accel = backed.accel = accel
+                plain.steering_angle = backed.steering_angle = steering
+        for plain, _ in pairs:
+            plain.update()
+        state.step()
+
+    for plain, backed in pairs:
+        assert plain.position.get() == backed.position.get()
+        assert plain.velocity.get() == backed.velocity.get()
+        assert (plain.speed, plain.rotation_angle) == (backed.speed, backed.rotation_angle)